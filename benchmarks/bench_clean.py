@@ -0,0 +1,50 @@
+"""Time `utils.clean` on flat, nested and large property dicts.
+
+Usage: python benchmarks/bench_clean.py [--number N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from lotus.utils import clean  # noqa: E402
+
+
+def payloads():
+    now = datetime(2023, 1, 1)
+    flat = {"region": "US", "count": 3, "cost": 0.25, "pro": True, "at": now}
+    nested = {
+        "region": "US",
+        "labels": {"tier": "pro", "shard": [1, 2], "limits": {"calls": 100}},
+        "items": [{"sku": "a", "qty": 1}, {"sku": "b", "qty": 2}],
+    }
+    large = {"field_%d" % n: n for n in range(500)}
+    large["rows"] = [{"id": n, "tags": ["x", "y"]} for n in range(100)]
+    return [
+        ("flat", flat),
+        ("flat+Decimal", dict(flat, cost=Decimal("0.25"))),
+        ("nested", nested),
+        ("nested+tuple", dict(nested, labels=dict(nested["labels"], shard=(1, 2)))),
+        ("large", large),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=10000)
+    args = parser.parse_args()
+
+    print("payload        us/call")
+    for name, payload in payloads():
+        number = max(args.number // 100, 1) if name == "large" else args.number
+        best = min(timeit.repeat(lambda: clean(payload), number=number, repeat=5))
+        print("%-13s  %7.2f" % (name, best / number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Compare the JSON codecs on real `track_event` bodies.
+
+Usage: python benchmarks/bench_codec.py [--events N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime
+from decimal import Decimal
+
+from dateutil.tz import tzutc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from lotus import Client, codec  # noqa: E402
+
+
+def bodies(events):
+    client = Client("api-key", send=False)
+    result = []
+    for n in range(events):
+        _, body = client.track_event(
+            customer_id="customer-%d" % n,
+            event_name="api_call",
+            time_created=datetime.now(tzutc()),
+            properties={
+                "region": "US",
+                "count": n,
+                "cost": Decimal("0.25"),
+                "seen_at": datetime.now(tzutc()),
+                "labels": {"tier": "pro", "shard": [n % 4, n % 8]},
+            },
+        )
+        result.append(body)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=10000)
+    args = parser.parse_args()
+
+    items = bodies(args.events)
+    print("codec     us/event")
+    for name in codec.available():
+        dumps = codec.get_codec(name).dumps
+        best = min(
+            timeit.repeat(lambda: [dumps(item) for item in items], number=1, repeat=5)
+        )
+        print("%-8s  %8.2f" % (name, best / len(items) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Throughput of `Client(thread=N)` with a simulated API round trip.
+
+Usage: python benchmarks/bench_consumers.py [--events N] [--latency SECONDS]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import lotus.consumer  # noqa: E402
+from lotus import Client  # noqa: E402
+
+
+def fake_send(latency):
+    def send(*args, **kwargs):
+        time.sleep(latency)
+
+    return send
+
+
+def run(threads, events, latency):
+    lotus.consumer.send = fake_send(latency)
+    client = Client(
+        "api-key", host="http://localhost", thread=threads, max_queue_size=events
+    )
+    start = time.perf_counter()
+    for n in range(events):
+        client.track_event(
+            customer_id="customer-%d" % (n % 1000),
+            event_name="api_call",
+            properties={"region": "US", "count": 1},
+        )
+    client.flush()
+    elapsed = time.perf_counter() - start
+    client.join()
+    return events / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    print("threads  events/sec")
+    for threads in (1, 2, 4, 8):
+        rate = run(threads, args.events, args.latency)
+        print("%7d  %10.0f" % (threads, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Enqueue cost of `Client.track_dataframe` against row by row tracking.
+
+Usage: python benchmarks/bench_dataframe.py [--rows N]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pandas as pd  # noqa: E402
+
+from lotus import Client  # noqa: E402
+
+
+def frame(rows):
+    return pd.DataFrame(
+        {
+            "customer_id": ["customer-%d" % (n % 1000) for n in range(rows)],
+            "event_name": "api_call",
+            "time_created": pd.Timestamp("2023-01-01", tz="UTC")
+            + pd.to_timedelta(range(rows), unit="s"),
+            "region": "US",
+            "count": range(rows),
+            "latency_ms": 12.5,
+        }
+    )
+
+
+def client(rows):
+    # consumers are not started, so that only enqueueing is measured
+    client = Client("api-key", send=False)
+    client.send = True
+    client.queue.maxsize = rows + 1
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    args = parser.parse_args()
+    df = frame(args.rows)
+
+    gc.collect()
+    start = time.perf_counter()
+    events = [
+        {
+            "customer_id": row.customer_id,
+            "event_name": row.event_name,
+            "time_created": row.time_created.to_pydatetime(),
+            "properties": {
+                "region": row.region,
+                "count": row.count,
+                "latency_ms": row.latency_ms,
+            },
+        }
+        for row in df.itertuples()
+    ]
+    rows_time = time.perf_counter() - start
+    looped = client(args.rows)
+    start = time.perf_counter()
+    for event in events:
+        looped.track_event(**event)
+    loop_time = rows_time + time.perf_counter() - start
+    del looped
+
+    gc.collect()
+    start = time.perf_counter()
+    client(args.rows).track_events(events)
+    bulk_time = rows_time + time.perf_counter() - start
+    del events
+
+    gc.collect()
+    start = time.perf_counter()
+    client(args.rows).track_dataframe(df, time_col="time_created")
+    frame_time = time.perf_counter() - start
+
+    print("rows + track_event   %6.2f us/row" % (loop_time / args.rows * 1e6))
+    print("rows + track_events  %6.2f us/row" % (bulk_time / args.rows * 1e6))
+    print("track_dataframe      %6.2f us/row" % (frame_time / args.rows * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""End to end benchmark of the client against a local stub of the API.
+
+Reports events/sec, enqueue latency, CPU time and peak memory for
+`track_event`, and calls/sec, latency and CPU time for blocking calls. The
+stub server runs in its own process so that its CPU time is not counted.
+
+Usage: python benchmarks/bench_e2e.py [--events N] [--calls N] [--latency SECONDS]
+           [--save PATH] [--compare PATH] [--tolerance FRACTION]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+from lotus import Client  # noqa: E402
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q / 100.0 * len(samples)))]
+
+
+def start_stub(latency):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "lotus.stub_server", "--latency", str(latency)],
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    return process, process.stdout.readline().strip()
+
+
+def track_events(client, events):
+    latencies = []
+    for n in range(events):
+        start = time.perf_counter()
+        client.track_event(
+            customer_id="customer-%d" % (n % 1000),
+            event_name="api_call",
+            properties={"region": "US", "count": 1},
+        )
+        latencies.append(time.perf_counter() - start)
+    client.flush()
+    return latencies
+
+
+def bench_track_event(url, events):
+    client = Client("api-key", host=url, max_queue_size=events)
+    cpu = time.process_time()
+    start = time.perf_counter()
+    latencies = track_events(client, events)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    client.join()
+
+    # a second run to measure memory, tracing slows everything down
+    client = Client("api-key", host=url, max_queue_size=events)
+    tracemalloc.start()
+    track_events(client, events)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    client.join()
+
+    return {
+        "events_per_sec": events / elapsed,
+        "enqueue_p50_us": percentile(latencies, 50) * 1e6,
+        "enqueue_p99_us": percentile(latencies, 99) * 1e6,
+        "cpu_us_per_event": cpu / events * 1e6,
+        "peak_memory_kb": peak / 1024.0,
+    }
+
+
+def bench_blocking(url, calls, name, **kwargs):
+    client = Client("api-key", host=url, sync_mode=True)
+    method = getattr(client, name)
+    latencies = []
+    cpu = time.process_time()
+    start = time.perf_counter()
+    for _ in range(calls):
+        call_start = time.perf_counter()
+        method(**kwargs)
+        latencies.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    return {
+        "calls_per_sec": calls / elapsed,
+        "latency_p50_us": percentile(latencies, 50) * 1e6,
+        "latency_p99_us": percentile(latencies, 99) * 1e6,
+        "cpu_us_per_call": cpu / calls * 1e6,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return a description of every result worse than `baseline`."""
+    regressions = []
+    for scenario, metrics in baseline.items():
+        for name, expected in metrics.items():
+            value = results.get(scenario, {}).get(name)
+            if value is None:
+                continue
+            if name.endswith("_per_sec"):
+                worse = value < expected * (1 - tolerance)
+            else:
+                worse = value > expected * (1 + tolerance)
+            if worse:
+                regressions.append(
+                    "%s %s: %.1f, baseline %.1f" % (scenario, name, value, expected)
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="fail on regressions against this file")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    stub, url = start_stub(args.latency)
+    try:
+        results = {"track_event": bench_track_event(url, args.events)}
+        results["get_customer"] = bench_blocking(
+            url, args.calls, "get_customer", customer_id="customer-1"
+        )
+        results["check_feature_access"] = bench_blocking(
+            url,
+            args.calls,
+            "check_feature_access",
+            customer_id="customer-1",
+            feature_id="feature-1",
+        )
+        results["create_credit"] = bench_blocking(
+            url,
+            args.calls,
+            "create_credit",
+            customer_id="customer-1",
+            amount=10,
+            currency_code="USD",
+        )
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    for scenario, metrics in results.items():
+        print(scenario)
+        for name, value in metrics.items():
+            print("  %-18s %12.1f" % (name, value))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("regression: " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
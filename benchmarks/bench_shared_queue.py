@@ -0,0 +1,88 @@
+"""Requests and CPU of forked workers, each uploading or sharing a queue.
+
+Usage: python benchmarks/bench_shared_queue.py [--workers N] [--rate N]
+           [--seconds N]
+
+Each worker tracks `rate` events per second for `seconds` seconds, as a
+web worker would under steady traffic, against a local stub server.
+"""
+
+import argparse
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from lotus import Client  # noqa: E402
+from lotus.shared_queue import SharedQueue  # noqa: E402
+from lotus.stub_server import StubServer  # noqa: E402
+
+
+def run(stub, workers, rate, seconds, shared):
+    queue = None
+    if shared:
+        queue = SharedQueue("lotus-bench-%s" % uuid.uuid4().hex[:8], create=True)
+    client = Client(
+        "api-key",
+        host=stub.url,
+        shared_queue=queue,
+        shared_queue_upload=shared,
+        flush_at=1000 if shared else 100,
+    )
+    start = time.perf_counter()
+    pids = []
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                for n in range(int(rate * seconds)):
+                    client.track_event(
+                        customer_id="customer-%d" % n,
+                        event_name="api_call",
+                        properties={"region": "US", "count": n},
+                    )
+                    time.sleep(1.0 / rate)
+                client.flush()
+                client.join()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    client.flush()
+    client.join()
+    elapsed = time.perf_counter() - start
+    if queue is not None:
+        queue.close()
+        queue.unlink()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=500)
+    parser.add_argument("--seconds", type=float, default=3)
+    args = parser.parse_args()
+
+    print("mode     requests  events/request  worker cpu s  seconds")
+    for shared in (False, True):
+        with StubServer() as stub:
+            before = os.times()
+            elapsed = run(stub, args.workers, args.rate, args.seconds, shared)
+            after = os.times()
+            requests = len(stub.requests)
+        cpu = (after.children_user + after.children_system) - (
+            before.children_user + before.children_system
+        )
+        events = args.workers * int(args.rate * args.seconds)
+        print(
+            "%-7s  %8d  %14.1f  %12.2f  %7.2f"
+            % ("shared" if shared else "own", requests, events / requests, cpu, elapsed)
+        )
+
+
+if __name__ == "__main__":
+    main()
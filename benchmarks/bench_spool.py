@@ -0,0 +1,56 @@
+"""Write and drain throughput of the on-disk `SpoolQueue`.
+
+Usage: python benchmarks/bench_spool.py [--events N] [--fsync]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from lotus.spool import SpoolQueue  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=200000)
+    parser.add_argument("--fsync", action="store_true")
+    args = parser.parse_args()
+
+    body = {
+        "$type": "track_event",
+        "customer_id": "customer-1",
+        "event_name": "api_call",
+        "idempotency_id": "7d5b5d36-0b9a-4c43-9d8e-2b43a1d1e5a5",
+        "time_created": "2023-01-01 00:00:00+00:00",
+        "properties": {"region": "US", "count": 1},
+        "library": "lotus-python",
+        "library_version": "0.12.0",
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        queue = SpoolQueue(os.path.join(directory, "queue.db"), fsync=args.fsync)
+
+        start = time.perf_counter()
+        for _ in range(args.events):
+            queue.put(body, block=False)
+        queue.sync()
+        elapsed = time.perf_counter() - start
+        print("put:   %10.0f events/sec" % (args.events / elapsed))
+
+        start = time.perf_counter()
+        rowids = []
+        for _ in range(args.events):
+            rowids.append(queue.get(block=False).rowid)
+            if len(rowids) == 100:
+                queue.ack(rowids)
+                rowids = []
+        queue.ack(rowids)
+        elapsed = time.perf_counter() - start
+        print("drain: %10.0f events/sec" % (args.events / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Enqueue cost of `track_events` and emitters against `track_event` calls.
+
+Usage: python benchmarks/bench_track_events.py [--events N] [--repeat N]
+
+Each variant runs `--repeat` times on a new client, the best run is reported.
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from lotus import Client  # noqa: E402
+
+
+def events(count):
+    return [
+        {
+            "customer_id": "customer-%d" % (n % 1000),
+            "event_name": "api_call",
+            "properties": {"region": "US", "count": n, "latency_ms": 12.5},
+        }
+        for n in range(count)
+    ]
+
+
+def client(events):
+    gc.collect()
+    client = Client("api-key", send=False)
+    client.send = True
+    client.queue.maxsize = events + 1
+    return client
+
+
+def best(run, events, repeat):
+    """Best time of `run(client)`, each time on a new client."""
+    times = []
+    for _ in range(repeat):
+        tracking = client(events)
+        start = time.perf_counter()
+        run(tracking)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    batch = events(args.events)
+
+    def loop(looped):
+        for event in batch:
+            looped.track_event(**event)
+
+    def bulk(bulk):
+        queued, errors = bulk.track_events(batch)
+        assert queued == args.events and not errors
+
+    def emit(emitting):
+        emit = emitting.emitter(
+            "api_call", schema={"region": str, "count": int, "latency_ms": float}
+        )
+        for event in batch:
+            emit(event["customer_id"], event["properties"])
+
+    loop_time = best(loop, args.events, args.repeat)
+    bulk_time = best(bulk, args.events, args.repeat)
+    emit_time = best(emit, args.events, args.repeat)
+
+    print("track_event loop  %6.2f us/event" % (loop_time / args.events * 1e6))
+    print("track_events      %6.2f us/event" % (bulk_time / args.events * 1e6))
+    print("emitter loop      %6.2f us/event" % (emit_time / args.events * 1e6))
+    print("speedup           %6.1fx" % (loop_time / bulk_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+from lotus.async_client import AsyncClient  # noqa: F401
 from lotus.client import Client
 from lotus.version import VERSION
 
@@ -0,0 +1,132 @@
+import time
+from threading import Lock
+
+import monotonic
+
+from .request import APIError
+
+
+class AdaptiveBatching(object):
+    """Tunes a consumer's batch size, linger and request rate as it runs.
+
+    The batch size (`flush_at`) doubles while the queue still holds a full
+    batch once one is taken, and shrinks by a quarter once the queue has
+    drained. The linger (`flush_interval`) halves when a batch closes on it
+    less than half full, since waiting longer only delays light traffic, and
+    grows back by a tenth of its maximum while batches fill up.
+
+    Requests are paced at `rate` per second, which follows AIMD: it grows
+    by `rate_step` after each request that succeeds, and is multiplied by
+    `decrease` after a 429, or a request taking over `latency_factor` times
+    the usual upload time (and at least `latency_floor` seconds).
+
+    Every setting stays within its `min_*` and `max_*` bounds.
+    """
+
+    def __init__(
+        self,
+        flush_at=100,
+        flush_interval=0.5,
+        min_flush_at=10,
+        max_flush_at=1000,
+        min_flush_interval=0.01,
+        max_flush_interval=1.0,
+        min_rate=1.0,
+        max_rate=100.0,
+        rate_step=1.0,
+        decrease=0.5,
+        latency_factor=3.0,
+        latency_floor=0.25,
+        metrics=None,
+    ):
+        for name, low, high in (
+            ("flush_at", min_flush_at, max_flush_at),
+            ("flush_interval", min_flush_interval, max_flush_interval),
+            ("rate", min_rate, max_rate),
+        ):
+            if not 0 < low <= high:
+                raise ValueError("Invalid %s bounds: %r, %r" % (name, low, high))
+        if not 0 < decrease < 1:
+            raise ValueError("decrease must be between 0 and 1, got %r" % decrease)
+        self.min_flush_at = min_flush_at
+        self.max_flush_at = max_flush_at
+        self.min_flush_interval = min_flush_interval
+        self.max_flush_interval = max_flush_interval
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_step = rate_step
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.latency_floor = latency_floor
+        self.metrics = metrics
+        self.flush_at = min(max(flush_at, min_flush_at), max_flush_at)
+        self.flush_interval = min(
+            max(flush_interval, min_flush_interval), max_flush_interval
+        )
+        self.rate = max_rate
+        # moving average of the upload time of successful requests
+        self.latency = None
+        self._next_request = 0
+        # the retry lane sends requests too
+        self._lock = Lock()
+
+    def batched(self, batch, queue_depth):
+        """Adjust the batch size and linger after `batch` was taken.
+
+        Empty batches, taken while the queue is idle, change nothing: the
+        linger would otherwise shrink to its minimum and the consumer poll
+        the queue in a busy loop.
+        """
+        if not len(batch):
+            return
+        if len(batch) >= self.flush_at or batch.full():
+            if queue_depth >= self.flush_at:
+                self.flush_at = min(self.flush_at * 2, self.max_flush_at)
+            self.flush_interval = min(
+                self.flush_interval + self.max_flush_interval / 10,
+                self.max_flush_interval,
+            )
+        elif len(batch) < self.flush_at / 2:
+            self.flush_interval = max(self.flush_interval / 2, self.min_flush_interval)
+        if not queue_depth:
+            self.flush_at = max(self.flush_at * 3 // 4, self.min_flush_at)
+
+    def wait(self):
+        """Wait for the next request to be due at the current rate."""
+        with self._lock:
+            now = monotonic.monotonic()
+            due = max(now, self._next_request)
+            self._next_request = due + 1.0 / self.rate
+        if due > now:
+            time.sleep(due - now)
+
+    def observe(self, seconds, error=None):
+        """Adjust the request rate after a request of `seconds` ended."""
+        throttled = isinstance(error, APIError) and error.status == 429
+        with self._lock:
+            latency = self.latency
+            slow = (
+                latency is not None
+                and seconds > self.latency_floor
+                and seconds > latency * self.latency_factor
+            )
+            if throttled or slow:
+                self.rate = max(self.rate * self.decrease, self.min_rate)
+                if self.metrics is not None:
+                    self.metrics.incr(
+                        "adaptive_throttled" if throttled else "adaptive_slow"
+                    )
+            elif error is None:
+                self.rate = min(self.rate + self.rate_step, self.max_rate)
+            if error is None:
+                # slow requests count too, so the average follows lasting changes
+                self.latency = (
+                    seconds if latency is None else latency * 0.9 + seconds * 0.1
+                )
+
+    def settings(self):
+        return {
+            "flush_at": self.flush_at,
+            "flush_interval": self.flush_interval,
+            "rate": self.rate,
+        }
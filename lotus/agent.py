@@ -0,0 +1,214 @@
+"""Run a local agent that uploads the events of other processes.
+
+Usage: python -m lotus.agent [--socket PATH] [--udp HOST:PORT]
+           [--api-key KEY] [--host URL] [--threads N] [--flush-at N]
+           [--flush-interval SECONDS] [--compression gzip|zstd]
+           [--spool-dir DIR] [--dead-letter PATH]
+
+Processes using `Client(transport="agent")` send each event as a datagram
+to the agent's Unix socket, or UDP port, without waiting for an answer.
+The agent queues them in a `Client` of its own, which batches, compresses,
+spools and uploads them like any other client.
+"""
+
+import argparse
+import errno
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import stat
+import sys
+import threading
+from queue import Full
+
+from .utils import runtime_dir
+
+log = logging.getLogger("lotus")
+
+DEFAULT_SOCKET = os.path.join(runtime_dir(create=False), "lotus-agent.sock")
+# the largest datagram received, events above MAX_MSG_SIZE are dropped later
+MAX_DATAGRAM = 64 << 10
+# seconds `AgentTransport.send` waits for room in the agent's socket buffer
+DEFAULT_TIMEOUT = 0.01
+
+
+class AgentTransport(object):
+    """Sends encoded events to an agent, dropping them if it cannot keep up.
+
+    `address` is the path of the agent's Unix socket, or a `(host, port)`
+    pair for UDP. No answer is awaited: when the agent is not running, or
+    its socket buffer stays full for `timeout` seconds, `send` returns False.
+    """
+
+    def __init__(self, address=None, timeout=DEFAULT_TIMEOUT):
+        self.address = address or DEFAULT_SOCKET
+        family = socket.AF_INET if isinstance(self.address, tuple) else socket.AF_UNIX
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        # Unix datagram sockets queue few datagrams, wait a little for room
+        # rather than drop the events of a burst
+        self.sock.settimeout(timeout)
+
+    def send(self, data):
+        try:
+            self.sock.sendto(data, self.address)
+        except OSError as e:
+            log.debug("error sending to the agent at %s: %s", self.address, e)
+            return False
+        return True
+
+    def close(self):
+        self.sock.close()
+
+
+class Agent(object):
+    """Receives events from local processes and queues them on `client`.
+
+    Listens on the Unix socket `socket_path`, and on UDP if `udp` is a
+    `(host, port)` pair. Each datagram is one JSON encoded `track_event`
+    body, which is queued as it was received; malformed ones are counted as
+    `agent_invalid` in the client's stats.
+
+    The default socket is in the user's `runtime_dir`. A socket left behind
+    by an agent that did not exit cleanly is replaced, but OSError is raised
+    if another agent is still listening on it.
+    """
+
+    def __init__(self, client, socket_path=DEFAULT_SOCKET, udp=None):
+        self.client = client
+        self.sockets = []
+        self.socket_path = socket_path
+        if socket_path:
+            if socket_path == DEFAULT_SOCKET:
+                runtime_dir()
+            _remove_stale_socket(socket_path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(socket_path)
+            self.sockets.append(sock)
+        self.udp_address = None
+        if udp:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(udp)
+            self.udp_address = sock.getsockname()
+            self.sockets.append(sock)
+        self._stopped = threading.Event()
+
+    def serve_forever(self, poll_interval=0.5):
+        for sock in self.sockets:
+            sock.setblocking(False)
+        while not self._stopped.is_set():
+            readable, _, _ = select.select(self.sockets, [], [], poll_interval)
+            for sock in readable:
+                # drain everything already received before waiting again
+                while True:
+                    try:
+                        data = sock.recv(MAX_DATAGRAM)
+                    except OSError:
+                        break
+                    self.handle(data)
+
+    def handle(self, data):
+        """Queue one received event, return whether it was queued."""
+        client = self.client
+        try:
+            body = json.loads(data)
+            customer_id = body["customer_id"]
+            if body.get("$type") != "track_event" or not body.get("event_name"):
+                raise ValueError("not a track_event body")
+        except (ValueError, TypeError, KeyError) as e:
+            log.warning("dropping an invalid event from a local process: %s", e)
+            client.metrics.incr("agent_invalid")
+            return False
+        try:
+            client._shard(customer_id).put(data, block=False)
+        except Full:
+            client.metrics.incr("dropped")
+            log.warning("queue is full")
+            return False
+        client.metrics.incr("enqueued")
+        return True
+
+    def stop(self):
+        self._stopped.set()
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+        if self.socket_path and os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def _remove_stale_socket(path):
+    try:
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(info.st_mode):
+        raise FileExistsError(errno.EEXIST, "not a socket", path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        # left behind by an agent that did not exit cleanly
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise OSError(errno.EADDRINUSE, "another agent is listening on %s" % path)
+
+
+def _udp_address(value):
+    host, _, port = value.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def main(argv=None):
+    from .client import Client
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    parser.add_argument("--udp", type=_udp_address, help="also listen on HOST:PORT")
+    parser.add_argument("--api-key", default=os.environ.get("LOTUS_API_KEY"))
+    parser.add_argument("--host", default=os.environ.get("LOTUS_HOST"))
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--flush-at", type=int, default=1000)
+    parser.add_argument("--flush-interval", type=float, default=0.5)
+    parser.add_argument("--compression", choices=("gzip", "zstd"))
+    parser.add_argument("--spool-dir")
+    parser.add_argument("--dead-letter")
+    args = parser.parse_args(argv)
+    logging.basicConfig()
+    if not args.api_key:
+        parser.error("--api-key or LOTUS_API_KEY is required")
+
+    client = Client(
+        args.api_key,
+        host=args.host,
+        thread=args.threads,
+        flush_at=args.flush_at,
+        flush_interval=args.flush_interval,
+        compression=args.compression,
+        spool_dir=args.spool_dir,
+        dead_letter=args.dead_letter,
+    )
+    try:
+        agent = Agent(client, socket_path=args.socket, udp=args.udp)
+    except OSError as e:
+        client.join()
+        parser.exit(1, "%s: %s\n" % (parser.prog, e))
+    signal.signal(signal.SIGTERM, lambda *_: agent.stop())
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent.close()
+        client.flush()
+        client.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
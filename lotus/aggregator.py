@@ -0,0 +1,152 @@
+import logging
+import numbers
+import os
+import time
+import uuid
+import weakref
+from datetime import datetime
+from threading import Event, Lock, Thread
+
+from dateutil.tz import tzutc
+
+# namespace of the idempotency ids of aggregated events
+AGGREGATE_NAMESPACE = uuid.UUID("1b4e28ba-2fa1-11d2-883f-0016d3cca427")
+
+_aggregators = weakref.WeakSet()
+
+REDUCERS = {
+    "sum": lambda a, b: a + b,
+    "max": max,
+}
+
+
+class Aggregator(object):
+    """Merges counter events before they reach the client's queue.
+
+    `rules` maps an event name to the properties to aggregate and how, eg.
+    `{"api_call": {"count": "sum", "latency_ms": "max"}}`. Events with the
+    same customer, event name and values for every other property are merged
+    within windows of `window` seconds, aligned to the epoch. Each window is
+    emitted through `emit` as one event whose idempotency id is derived from
+    its contents and a random token of this aggregator, so retries of the
+    event are never billed twice, while other processes aggregating the same
+    window get ids of their own.
+    """
+
+    log = logging.getLogger("lotus")
+
+    def __init__(self, emit, rules, window=1.0):
+        for event_name, properties in rules.items():
+            for name, reducer in properties.items():
+                if reducer not in REDUCERS:
+                    raise ValueError(
+                        "Unknown aggregation %r for %s.%s" % (reducer, event_name, name)
+                    )
+        self.emit = emit
+        self.rules = rules
+        self.window = window
+        self._buckets = {}
+        # how many times an open window was emitted early, by `flush()`
+        self._partials = {}
+        self._lock = Lock()
+        self.reseed()
+        _aggregators.add(self)
+        self._stopped = Event()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, customer_id, event_name, properties):
+        """Aggregate an event, return False if it has to be sent as is."""
+        rule = self.rules.get(event_name)
+        if rule is None:
+            return False
+        values = {}
+        group = []
+        for name, value in properties.items():
+            if name in rule:
+                if isinstance(value, bool) or not isinstance(value, numbers.Number):
+                    return False
+                values[name] = value
+            else:
+                group.append((name, value))
+        group.sort(key=lambda item: item[0])
+        window_start = time.time() // self.window * self.window
+        key = (window_start, customer_id, event_name, tuple(group))
+        try:
+            hash(key)
+        except TypeError:
+            # grouping by a list or a dict property
+            return False
+
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                self._buckets[key] = values
+            else:
+                for name, value in values.items():
+                    if name in bucket:
+                        bucket[name] = REDUCERS[rule[name]](bucket[name], value)
+                    else:
+                        bucket[name] = value
+        return True
+
+    def flush(self, everything=True):
+        """Emit aggregated events, only those of closed windows by default."""
+        closed = time.time() - self.window
+        buckets = []
+        with self._lock:
+            for key in list(self._buckets):
+                if key[0] <= closed:
+                    partial = self._partials.pop(key, 0)
+                elif everything:
+                    partial = self._partials.get(key, 0)
+                    self._partials[key] = partial + 1
+                else:
+                    continue
+                buckets.append((key, partial, self._buckets.pop(key)))
+            for key in [key for key in self._partials if key[0] <= closed]:
+                del self._partials[key]
+
+        for key, partial, values in buckets:
+            window_start, customer_id, event_name, group = key
+            properties = dict(group)
+            properties.update(values)
+            # later emissions of a window flushed early get their own id
+            name = repr((self._token, customer_id, event_name, group, window_start))
+            if partial:
+                name += "#%d" % partial
+            idempotency_id = uuid.uuid5(AGGREGATE_NAMESPACE, name)
+            try:
+                self.emit(
+                    customer_id=customer_id,
+                    event_name=event_name,
+                    properties=properties,
+                    time_created=datetime.fromtimestamp(window_start, tzutc()),
+                    idempotency_id=str(idempotency_id),
+                )
+            except Exception as e:
+                self.log.error("error emitting aggregated event: %s", e)
+
+    def reseed(self):
+        """Draw a new token for the idempotency ids."""
+        self._token = uuid.uuid4().hex
+
+    def stop(self):
+        """Emit every aggregated event and stop the flushing thread."""
+        self._stopped.set()
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(min(self.window, 1.0) / 2):
+            self.flush(everything=False)
+
+
+def _reseed_all():
+    # a forked child would otherwise emit its parent's ids
+    for aggregator in list(_aggregators):
+        aggregator.reseed()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reseed_all)
@@ -0,0 +1,254 @@
+import asyncio
+import atexit
+import functools
+import inspect
+
+import monotonic
+
+from .cache import MISSING, STALE
+from .client import Client, decode_response
+from .request import check_response, prepare_request
+from .utils import HTTPMethod
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+# public `Client` methods that make a request, or queue an event
+METHODS = (
+    "track_event",
+    "track_dataframe",
+    "list_customers",
+    "get_customer",
+    "create_customer",
+    "batch_create_customers",
+    "list_credits",
+    "create_credit",
+    "update_credit",
+    "void_credit",
+    "create_subscription",
+    "cancel_subscription",
+    "list_subscriptions",
+    "switch_subscription_plan",
+    "update_subscription",
+    "attach_addon",
+    "cancel_addon",
+    "list_plans",
+    "get_plan",
+    "get_customer_metric_access",
+    "check_metric_access",
+    "get_customer_feature_access",
+    "check_feature_access",
+)
+
+
+class AsyncClient(Client):
+    """Create a new Lotus client for asyncio applications.
+
+    Every public method of `Client` but `stats` and `emitter` is a coroutine
+    here, with the same arguments, validation and strict/non-strict response
+    handling. Emitters queue events without blocking; in sync mode, their
+    calls return an awaitable.
+    Requests are made over a pooled `httpx.AsyncClient`, while `track_event`
+    still hands events to the consumer threads.
+    """
+
+    def __init__(
+        self, api_key=None, max_connections=100, max_keepalive_connections=20, **kwargs
+    ):
+        if httpx is None:
+            raise ImportError("AsyncClient requires httpx, install lotus-python[async]")
+        if kwargs.get("aggregate") and kwargs.get("sync_mode"):
+            # aggregated events are emitted from a thread, where the
+            # requests of sync mode, coroutines here, would never be awaited
+            raise ValueError("AsyncClient cannot aggregate events in sync_mode")
+        Client.__init__(self, api_key, **kwargs)
+        self._refreshes = set()
+        # `join` is a coroutine here, exit through the blocking version
+        atexit.unregister(self.join)
+        if self.send and not self.sync_mode:
+            atexit.register(Client.join, self)
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        )
+        self._http = httpx.AsyncClient(
+            limits=self._limits, timeout=_timeout(self.timeout)
+        )
+
+    def _after_fork(self):
+        Client._after_fork(self)
+        # the pooled connections are the parent's
+        self._http = httpx.AsyncClient(
+            limits=self._limits, timeout=_timeout(self.timeout)
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.shutdown()
+        await self.aclose()
+
+    async def flush(self):
+        """Forces a flush from the internal queues to the server"""
+        await self._run_blocking(Client.flush)
+
+    async def join(self):
+        """Ends the consumer threads once the queues are empty."""
+        await self._run_blocking(Client.join)
+
+    async def shutdown(self):
+        """Flush all messages and cleanly shutdown the client"""
+        await self._run_blocking(Client.flush)
+        await self._run_blocking(Client.join)
+
+    async def prewarm(self, connections=1):
+        """Open `connections` pooled connections to the API ahead of time."""
+        endpoint_host, method = self._endpoint({"$type": "ping"})
+
+        async def ping():
+            try:
+                await self._send(endpoint_host, method, {}, None)
+            except Exception as e:
+                self.log.debug("error prewarming connection: %s", e)
+
+        await asyncio.gather(*[ping() for _ in range(connections)])
+
+    async def track_events(self, events):
+        """Queue many events at once, return `(queued, errors)`."""
+        if not (self.sync_mode or self.agent is not None):
+            return Client.track_events(self, events)
+        # each event is a request of its own in sync mode
+        queued = 0
+        errors = []
+        for index, event in enumerate(events):
+            try:
+                ret = Client.track_event(self, **event)
+                if inspect.isawaitable(ret):
+                    await ret
+            except Exception as e:
+                errors.append((index, e))
+            else:
+                queued += 1
+        return queued, errors
+
+    async def _run_blocking(self, method):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, method, self)
+
+    async def aclose(self):
+        """Close the pooled HTTP connections."""
+        await self._http.aclose()
+
+    def _request(self, body, query=None, endpoint_url=None):
+        endpoint_host, method = self._endpoint(body, endpoint_url)
+        return self._send(endpoint_host, method, body, query)
+
+    async def _send(self, endpoint_host, method, body, query):
+        url, headers, data = prepare_request(
+            endpoint_host,
+            self.api_key,
+            gzip=self.gzip,
+            body=body,
+            metrics=self.metrics,
+            compressor=self.compressor,
+        )
+        if method in (HTTPMethod.GET, HTTPMethod.DELETE):
+            data = None
+        limiter = self.rate_limiter
+        # the event loop must not block, so requests made after a pause do
+        # not wait for the first one's answer
+        wait = limiter.acquire(len(data or b""), block=False)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        started = monotonic.monotonic()
+        error = None
+        try:
+            response = await self._http.request(
+                method.value,
+                url,
+                headers=headers,
+                content=data,
+                params=query_params(query),
+            )
+            check_response(response)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.metrics.observe("request_seconds", monotonic.monotonic() - started)
+            limiter.release(error)
+        return decode_response(response)
+
+    async def _call(
+        self, model, body, query=None, endpoint_url=None, many=False, invalidate=False
+    ):
+        ret = self._enqueue(body, query=query, block=True, endpoint_url=endpoint_url)
+        if inspect.isawaitable(ret):
+            ret = await ret
+        self._invalidate(invalidate)
+        return self._parse(model, ret, many=many)
+
+    async def _cached(self, key, model, body, query=None):
+        cache = self.entitlement_cache
+        if cache is None:
+            return await self._call(model, body, query=query)
+        generation = cache.generation
+        state, value = cache.lookup(key[0], key)
+        if state == STALE:
+            # keep a reference, the event loop only holds weak ones to tasks
+            task = asyncio.ensure_future(
+                self._refresh(key, model, body, query, generation)
+            )
+            self._refreshes.add(task)
+            task.add_done_callback(self._refreshes.discard)
+        elif state == MISSING:
+            value = await self._call(model, body, query=query)
+            cache.store(key, value, generation)
+        return value
+
+    async def _refresh(self, key, model, body, query, generation):
+        try:
+            value = await self._call(model, body, query=query)
+        except Exception as e:
+            self.log.warning("error refreshing %s: %s", key[0], e)
+            self.entitlement_cache.release(key)
+        else:
+            self.entitlement_cache.store(key, value, generation)
+
+
+def _timeout(timeout):
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return httpx.Timeout(read, connect=connect)
+    return timeout
+
+
+def query_params(query):
+    """Encode `query` the way `requests` does, for use with httpx."""
+    params = []
+    for key, value in (query or {}).items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        for v in values:
+            if v is not None:
+                params.append((key, v if isinstance(v, str) else str(v)))
+    return params
+
+
+def _coroutine(name):
+    method = getattr(Client, name)
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        ret = method(self, *args, **kwargs)
+        if inspect.isawaitable(ret):
+            ret = await ret
+        return ret
+
+    return wrapper
+
+
+for _name in METHODS:
+    setattr(AsyncClient, _name, _coroutine(_name))
@@ -0,0 +1,106 @@
+import json
+from datetime import datetime
+
+import monotonic
+from dateutil.tz import tzutc
+
+from . import codec
+from .spool import SpoolEntry
+
+MAX_MSG_SIZE = 32 << 10
+
+# Our servers only accept batches less than 500KB. Here limit is set slightly
+# lower to leave space for extra data that will be added later, eg. "sentAt".
+BATCH_SIZE_LIMIT = 475000
+
+
+class Batch(object):
+    """A batch of queued items, encoded once as they are accepted.
+
+    Items may be dicts, already encoded JSON bytes, or `SpoolEntry` objects
+    read from a `SpoolQueue`, whose row ids are kept in `receipts`.
+    """
+
+    def __init__(self, max_msg_size=MAX_MSG_SIZE, max_size=BATCH_SIZE_LIMIT):
+        self.max_msg_size = max_msg_size
+        self.max_size = max_size
+        self.entries = []
+        self.parts = []
+        self.receipts = []
+        self.size = 0
+        # seconds spent encoding the items and the request body
+        self.serialize_time = 0.0
+        # upload attempts made so far
+        self.attempts = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    @property
+    def items(self):
+        """The batch's items as dicts, decoding those that arrived encoded."""
+        items = []
+        for entry, data in zip(self.entries, self.parts):
+            items.append(entry if isinstance(entry, dict) else json.loads(data))
+        return items
+
+    def add(self, item):
+        """Encode `item` and append it, return False if it is too large."""
+        if isinstance(item, SpoolEntry):
+            data = item.data
+        elif isinstance(item, bytes):
+            data = item
+        else:
+            started = monotonic.monotonic()
+            data = codec.dumps(item)
+            self.serialize_time += monotonic.monotonic() - started
+        if len(data) > self.max_msg_size:
+            return False
+        if isinstance(item, SpoolEntry):
+            self.receipts.append(item.rowid)
+        self.entries.append(item)
+        self.parts.append(data)
+        self.size += len(data)
+        return True
+
+    def split(self):
+        """Return two batches with the first and the second half of the items."""
+        middle = len(self.entries) // 2
+        halves = []
+        for entries, parts in (
+            (self.entries[:middle], self.parts[:middle]),
+            (self.entries[middle:], self.parts[middle:]),
+        ):
+            half = Batch(self.max_msg_size, self.max_size)
+            half.entries = entries
+            half.parts = parts
+            half.receipts = [e.rowid for e in entries if isinstance(e, SpoolEntry)]
+            half.size = sum(len(part) for part in parts)
+            halves.append(half)
+        return halves
+
+    def full(self):
+        """Whether the batch has reached its size limit."""
+        return self.size >= self.max_size
+
+    def chunks(self):
+        """Return the request body as a list of chunks, see `encode`."""
+        sent_at = datetime.utcnow().replace(tzinfo=tzutc()).isoformat()
+        chunks = [b'{"batch":[']
+        for n, part in enumerate(self.parts):
+            if n:
+                chunks.append(b",")
+            chunks.append(part)
+        chunks.append(b'],"sentAt":"' + sent_at.encode() + b'"}')
+        return chunks
+
+    def encode(self):
+        """Return the request body, joining the already encoded items.
+
+        The output is the same as `codec.dumps({"batch": items, "sentAt": ...})`
+        without serializing the items a second time.
+        """
+        return b"".join(self.chunks())
@@ -0,0 +1,141 @@
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import monotonic
+
+# seconds for which a cached response is served as fresh, by operation
+DEFAULT_TTLS = {
+    "check_feature_access": 30,
+    "check_metric_access": 5,
+}
+
+FRESH, STALE, MISSING = "fresh", "stale", "missing"
+
+
+class EntitlementCache(object):
+    """A bounded LRU of access check responses.
+
+    A response is fresh for the operation's TTL. For `stale_ttl` seconds
+    after that it is still returned, while a refresh runs in the background.
+    Older responses are fetched again before returning. `invalidate` drops
+    the responses of a customer, or all of them, and is called by the client
+    after every request that changes subscriptions. Each invalidation starts
+    a new `generation`; responses fetched during an older one are not
+    stored, since they may predate the change.
+
+    Cached responses are shared between callers and must not be modified.
+    """
+
+    log = logging.getLogger("lotus")
+
+    def __init__(self, ttls=None, stale_ttl=60, max_size=10000, refresh_workers=2):
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self.refresh_workers = refresh_workers
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        # bumped by `invalidate`
+        self.generation = 0
+        self._lock = Lock()
+        self._executor = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, operation, key):
+        """Return `(state, value)` for `key`.
+
+        A `STALE` state is only returned to the first caller, which is then
+        responsible for refreshing the entry through `store` or `release`;
+        later callers get `FRESH` with the same value until then.
+        """
+        now = monotonic.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING, None
+            value, fetched_at = entry
+            age = now - fetched_at
+            ttl = self.ttls.get(operation, 0)
+            if age >= ttl + self.stale_ttl:
+                return MISSING, None
+            self._entries.move_to_end(key)
+            if age < ttl or key in self._refreshing:
+                return FRESH, value
+            self._refreshing.add(key)
+            return STALE, value
+
+    def store(self, key, value, generation=None):
+        """Cache `value` for `key`, evicting the least recently used entry.
+
+        `generation` is the cache's `generation` when the fetch of `value`
+        started; the value is dropped if an invalidation happened since.
+        """
+        with self._lock:
+            self._refreshing.discard(key)
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (value, monotonic.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def release(self, key):
+        """Give up on refreshing `key`, the next stale lookup will retry."""
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def get(self, operation, key, fetch):
+        """Return the cached value for `key`, calling `fetch` as needed."""
+        generation = self.generation
+        state, value = self.lookup(operation, key)
+        if state == STALE:
+            self._submit(self._refresh, key, fetch, generation)
+        elif state == MISSING:
+            value = fetch()
+            self.store(key, value, generation)
+        return value
+
+    def invalidate(self, customer_id=None):
+        """Drop the responses of `customer_id`, or every response if None."""
+        with self._lock:
+            self.generation += 1
+            if customer_id is None:
+                self._entries.clear()
+                return
+            customer_id = str(customer_id)
+            for key in [key for key in self._entries if key[1] == customer_id]:
+                del self._entries[key]
+
+    def _refresh(self, key, fetch, generation):
+        try:
+            value = fetch()
+        except Exception as e:
+            self.log.warning("error refreshing %s: %s", key[0], e)
+            self.release(key)
+        else:
+            self.store(key, value, generation)
+
+    def _submit(self, fn, *args):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.refresh_workers
+                    )
+        self._executor.submit(fn, *args)
+
+
+def cache_key(operation, customer_id, target_id, subscription_filters=None):
+    """Build the cache key of an access check."""
+    filters = tuple(
+        sorted(
+            (str(f["property_name"]), str(f["value"]))
+            for f in subscription_filters or []
+        )
+    )
+    return (operation, str(customer_id), str(target_id), filters)
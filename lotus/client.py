@@ -1,16 +1,32 @@
 import atexit
 import logging
 import numbers
+import os
 import uuid
+import weakref
 from datetime import datetime
 from decimal import Decimal
-from queue import Full, Queue
+from functools import partial
+from queue import Full
+from threading import Thread
+
+import monotonic
 
 from dateutil.tz import tzutc
 from pydantic import parse_obj_as
 from six import string_types
 
+from . import codec
+from .adaptive import AdaptiveBatching
+from .aggregator import Aggregator
+from .batch import Batch
+from .cache import EntitlementCache, cache_key
+from .compression import DEFAULT_THRESHOLD, get_compressor
 from .consumer import Consumer
+from .dataframe import DEFAULT_CHUNK_SIZE, encode_frame
+from .dead_letter import DeadLetterStore
+from .emitter import Emitter
+from .metrics import Metrics, StatsReporter, TimedQueue
 from .models import (
     AddOnSubscriptionRecord,
     Customer,
@@ -22,8 +38,10 @@ from .models import (
     Plan,
     SubscriptionRecord,
 )
-from .request import send
-from .utils import HTTPMethod, clean
+from .ratelimit import RateLimiter
+from .request import DEFAULT_POOLSIZE, build_session, send
+from .spool import SpoolQueue, orphaned_spools, read_spool, remove_spool
+from .utils import HTTPMethod, clean, put_many, uuid4_strings
 from .version import VERSION
 
 # try:
@@ -34,6 +52,15 @@ from .version import VERSION
 
 ID_TYPES = (numbers.Number, string_types)
 
+# property values that `clean` returns as they are
+PLAIN_TYPES = frozenset((str, int, float, bool, type(None)))
+
+# live clients, rebuilt in forked children
+_clients = weakref.WeakSet()
+# SQLite connections inherited from the parent, never closed by the child:
+# closing one could delete the WAL the parent still uses
+_inherited = []
+
 
 class Client(object):
     """Create a new Lotus client."""
@@ -51,11 +78,35 @@ class Client(object):
         flush_at=100,
         flush_interval=0.5,
         gzip=False,
+        compression=None,
+        compression_level=None,
+        compression_threshold=DEFAULT_THRESHOLD,
         max_retries=3,
         sync_mode=False,
         strict=False,
         timeout=15,
         thread=1,
+        spool_dir=None,
+        spool_fsync=False,
+        aggregate=None,
+        aggregate_window=1.0,
+        entitlement_cache=None,
+        session=None,
+        pool_maxsize=None,
+        keep_alive=True,
+        connect_timeout=None,
+        prewarm=False,
+        stats_callback=None,
+        stats_interval=10,
+        dead_letter=None,
+        fork_inherit_queue=False,
+        shared_queue=None,
+        shared_queue_upload=False,
+        transport="queue",
+        agent_address=None,
+        adaptive=None,
+        requests_per_second=None,
+        bytes_per_second=None,
     ):
         require("api_key", api_key, string_types)
         self.operations = {
@@ -189,7 +240,42 @@ class Client(object):
             },
         }
 
-        self.queue = Queue(max_queue_size)
+        # one queue shard per consumer thread, see `_shard`
+        self.spool_dir = spool_dir
+        self.spool_fsync = spool_fsync
+        self.max_queue_size = max_queue_size
+        if spool_dir:
+            # events are kept on disk until they have been uploaded, and
+            # whatever a previous process left in `spool_dir` is replayed
+            os.makedirs(spool_dir, exist_ok=True)
+        # a `SharedQueue`, or its name, replaces the client's own queues: the
+        # client puts events on it, and uploads from it only in the process
+        # passing `shared_queue_upload`, see `lotus.shared_queue`
+        if isinstance(shared_queue, string_types):
+            from .shared_queue import SharedQueue
+
+            shared_queue = SharedQueue(shared_queue)
+        self.shared_queue = shared_queue
+        # with the "agent" transport, events are sent to a `lotus.agent`
+        # process listening on `agent_address`, and the client runs no
+        # queues or consumer threads of its own
+        if transport not in ("queue", "agent"):
+            raise ValueError("Unknown transport %r" % transport)
+        self.agent = None
+        if transport == "agent":
+            from .agent import AgentTransport
+
+            self.agent = AgentTransport(agent_address)
+            self.queues = []
+        elif shared_queue is not None:
+            self.queues = [shared_queue]
+        else:
+            self.queues = [self._make_queue(n) for n in range(max(thread, 1))]
+            if spool_dir:
+                self._replay_orphans()
+        self.queue = self.queues[0] if self.queues else None
+        self.consumers = []
+        self.metrics = Metrics()
         self.api_key = api_key
         self.on_error = on_error
         self.debug = debug
@@ -197,15 +283,61 @@ class Client(object):
         self.sync_mode = sync_mode
         self.host = host
         self.gzip = gzip
-        self.timeout = timeout
+        # "gzip" or "zstd", `gzip=True` is a shorthand for "gzip"
+        if compression is None and gzip:
+            compression = "gzip"
+        self.compressor = get_compressor(
+            compression, level=compression_level, threshold=compression_threshold
+        )
+        # a (connect, read) pair when the connect timeout is set separately
+        self.timeout = (connect_timeout, timeout) if connect_timeout else timeout
         self.strict = strict
+        # every request goes through `session`, the module's shared session
+        # if None, unless the pool is configured for this client
+        self._session_options = None
+        if session is None and (pool_maxsize is not None or not keep_alive):
+            self._session_options = {
+                "pool_maxsize": pool_maxsize or DEFAULT_POOLSIZE,
+                "keep_alive": keep_alive,
+            }
+            session = build_session(**self._session_options)
+        self.session = session
+        # paces the requests of the consumers and blocking calls, and holds
+        # them all when the API answers 429 with a Retry-After header
+        self._limiter_options = {
+            "requests_per_second": requests_per_second,
+            "bytes_per_second": bytes_per_second,
+        }
+        self.rate_limiter = RateLimiter(metrics=self.metrics, **self._limiter_options)
 
         if debug:
             self.log.setLevel(logging.DEBUG)
 
-        if sync_mode:
-            self.consumers = None
-        else:
+        # caches check_feature_access and check_metric_access responses, pass
+        # True for the default TTLs or an `EntitlementCache` to tune them
+        if entitlement_cache is True:
+            entitlement_cache = EntitlementCache()
+        elif entitlement_cache is False:
+            entitlement_cache = None
+        self.entitlement_cache = entitlement_cache
+
+        # keeps the events that could not be uploaded, pass the path of a
+        # SQLite database or a `DeadLetterStore`, see `lotus.replay`
+        if isinstance(dead_letter, string_types):
+            dead_letter = DeadLetterStore(dead_letter)
+        self.dead_letter = dead_letter
+
+        # merges counter events, see `Aggregator` for the format of `aggregate`
+        self.aggregator = None
+        if aggregate:
+            # bound through `Client` so that subclasses whose `track_event`
+            # is a coroutine still queue events synchronously; `AsyncClient`
+            # refuses to aggregate in sync mode, where it would not block
+            self.aggregator = Aggregator(
+                partial(Client.track_event, self), aggregate, window=aggregate_window
+            )
+
+        if not sync_mode and self.agent is None:
             # On program exit, allow the consumer thread to exit cleanly.
             # This prevents exceptions and a messy shutdown when the
             # interpreter is destroyed before the daemon thread finishes
@@ -214,27 +346,146 @@ class Client(object):
             # to call flush().
             if send:
                 atexit.register(self.join)
-            for n in range(thread):
-                self.consumers = []
-                if not host:
-                    host = "https://api.uselotus.io"
-                endpoint_host = host + "/api/track/"
-                consumer = Consumer(
-                    self.queue,
-                    api_key,
-                    host=endpoint_host,
-                    on_error=on_error,
-                    flush_at=flush_at,
-                    flush_interval=flush_interval,
-                    gzip=gzip,
-                    retries=max_retries,
-                    timeout=timeout,
-                )
-                self.consumers.append(consumer)
-
-                # if we've disabled sending, just don't start the consumer
-                if send:
-                    consumer.start()
+            self._consumer_options = {
+                "host": (host or "https://api.uselotus.io") + "/api/track/",
+                "on_error": on_error,
+                "flush_at": flush_at,
+                "flush_interval": flush_interval,
+                "gzip": gzip,
+                "retries": max_retries,
+            }
+            # tunes each consumer's batch size, linger and request rate,
+            # pass True for the default bounds or a dict of `AdaptiveBatching`
+            # arguments
+            self._adaptive_options = None
+            if adaptive:
+                self._adaptive_options = {} if adaptive is True else adaptive
+            if shared_queue is None or shared_queue_upload:
+                self._start_consumers()
+
+        # exports `stats()` every `stats_interval` seconds
+        self.stats_reporter = None
+        if stats_callback is not None:
+            self.stats_reporter = StatsReporter(self, stats_callback, stats_interval)
+            self.stats_reporter.start()
+
+        if prewarm and send:
+            thread = Thread(target=Client.prewarm, args=(self, len(self.consumers) + 1))
+            thread.daemon = True
+            thread.start()
+
+        # whether a forked child also uploads the events queued before the
+        # fork, which the parent uploads too, see `_after_fork`
+        self.fork_inherit_queue = fork_inherit_queue
+        self._emitters = weakref.WeakSet()
+        _clients.add(self)
+
+    def _make_queue(self, n, suffix=""):
+        if self.spool_dir:
+            path = os.path.join(self.spool_dir, "queue-%d%s.db" % (n, suffix))
+            return SpoolQueue(path, fsync=self.spool_fsync)
+        return TimedQueue(self.max_queue_size)
+
+    def _replay_orphans(self):
+        """Queue the events left in spool files that no shard reads."""
+        for n, path in orphaned_spools(self.spool_dir, len(self.queues)):
+            queue = self.queues[n % len(self.queues)]
+            count = 0
+            for items in read_spool(path):
+                put_many(queue, items, block=True)
+                count += len(items)
+            # on disk in our own spool before the child's is deleted
+            queue.sync()
+            remove_spool(path)
+            if count:
+                self.log.info("replaying %d spooled items from %s", count, path)
+
+    def _start_consumers(self):
+        for queue in self.queues:
+            adaptive = None
+            if self._adaptive_options is not None:
+                options = {
+                    "flush_at": self._consumer_options["flush_at"],
+                    "flush_interval": self._consumer_options["flush_interval"],
+                    "metrics": self.metrics,
+                }
+                options.update(self._adaptive_options)
+                adaptive = AdaptiveBatching(**options)
+            consumer = Consumer(
+                queue,
+                self.api_key,
+                timeout=self.timeout,
+                session=self.session,
+                metrics=self.metrics,
+                compressor=self.compressor,
+                dead_letter=self.dead_letter,
+                adaptive=adaptive,
+                limiter=self.rate_limiter,
+                **self._consumer_options,
+            )
+            self.consumers.append(consumer)
+
+            # if we've disabled sending, just don't start the consumer
+            if self.send:
+                consumer.start()
+
+    def _after_fork(self):
+        """Rebuild, in a forked child, what only the parent can use.
+
+        Threads do not survive a fork, and locks, sockets and SQLite
+        connections must not be shared with the parent. The child gets new
+        queues, consumers, metrics and sessions. Events queued or being
+        aggregated before the fork are the parent's to upload; with
+        `fork_inherit_queue`, queued events are copied to the child's queues
+        too, and uploaded by both. Spooled queues move to files of their
+        own, which the next client started on `spool_dir` replays once the
+        child has exited.
+        """
+        old_queues = self.queues
+        self.metrics = Metrics()
+        self.rate_limiter = RateLimiter(metrics=self.metrics, **self._limiter_options)
+        if self._session_options is not None:
+            self.session = build_session(**self._session_options)
+        elif self.session is not None:
+            # drop the pooled connections, the parent still uses them
+            self.session.close()
+        if self.dead_letter is not None:
+            _inherited.append(self.dead_letter)
+            self.dead_letter = DeadLetterStore(self.dead_letter.path)
+        if self.shared_queue is not None:
+            # the child keeps putting events on the shared queue, which is
+            # uploaded by the parent only
+            self.shared_queue.after_fork()
+            self.consumers = []
+        else:
+            suffix = "-%d" % os.getpid()
+            self.queues = [self._make_queue(n, suffix) for n in range(len(old_queues))]
+            self.queue = self.queues[0] if self.queues else None
+        if self.fork_inherit_queue and self.shared_queue is None:
+            for old, new in zip(old_queues, self.queues):
+                if not isinstance(old, SpoolQueue):
+                    # no other thread runs in the child, the lock may be held
+                    put_many(new, list(old.queue))
+        _inherited.extend(q for q in old_queues if isinstance(q, SpoolQueue))
+        if self.entitlement_cache is not None:
+            cache = self.entitlement_cache
+            self.entitlement_cache = EntitlementCache(
+                cache.ttls, cache.stale_ttl, cache.max_size, cache.refresh_workers
+            )
+        if self.aggregator is not None:
+            aggregator = self.aggregator
+            self.aggregator = Aggregator(
+                aggregator.emit, aggregator.rules, window=aggregator.window
+            )
+        if self.consumers:
+            self.consumers = []
+            self._start_consumers()
+        if self.stats_reporter is not None:
+            reporter = self.stats_reporter
+            self.stats_reporter = StatsReporter(
+                self, reporter.callback, reporter.interval
+            )
+            self.stats_reporter.start()
 
     def track_event(
         self,
@@ -245,7 +496,21 @@ class Client(object):
         time_created=None,
         idempotency_id=None,
     ):
+        """Queue an event, return `(success, body)`.
+
+        The queued body holds a copy of `properties`, nested lists and dicts
+        included, so the caller may change or reuse them once this returns.
+        """
         properties = properties or {}
+        if (
+            self.aggregator
+            and idempotency_id is None
+            and time_created is None
+            and isinstance(properties, dict)
+        ):
+            require("customer_id", customer_id, ID_TYPES)
+            if self.aggregator.add(stringify_id(customer_id), event_name, properties):
+                return True, None
         if idempotency_id is None:
             idempotency_id = str(uuid.uuid4())
         if time_created is None:
@@ -269,6 +534,207 @@ class Client(object):
 
         return self._enqueue(body)
 
+    def emitter(self, event_name, schema=None):
+        """Return a callable tracking events named `event_name`.
+
+        It takes `(customer_id, properties=None, time_created=None,
+        idempotency_id=None)` and is several times cheaper per call than
+        `track_event` for hot events. `schema` maps each property name to
+        its type, or a tuple of types, among str, int, float, bool and
+        `type(None)`; properties must then have exactly those fields.
+        """
+        # the blocking `track_event`, it is a coroutine on `AsyncClient`
+        fallback = partial(Client.track_event, self)
+        emitter = Emitter(self, event_name, schema=schema, fallback=fallback)
+        self._emitters.add(emitter)
+        return emitter
+
+    def track_events(self, events):
+        """Queue many events at once, return `(queued, errors)`.
+
+        `events` is an iterable of dicts with the arguments of `track_event`.
+        They are validated, cleaned, encoded and put on the queue in one
+        pass, taking each shard's lock once. `errors` lists the
+        `(index, exception)` of the events that were not queued, because
+        they are invalid or because the queue is full.
+        """
+        if self.sync_mode or self.agent is not None:
+            return self._track_each(events)
+
+        errors = []
+        shards = len(self.queues)
+        dumps = codec.dumps
+        # the encoded bodies for each shard, and the indexes of their events
+        bodies = [[] for _ in range(shards)]
+        indexes = [[] for _ in range(shards)]
+        merged = 0
+        aggregator = self.aggregator
+        ids = uuid4_strings()
+        now = str(datetime.now(tzutc()))
+        for index, event in enumerate(events):
+            try:
+                customer_id = event.get("customer_id")
+                event_name = event.get("event_name")
+                properties = event.get("properties") or {}
+                time_created = event.get("time_created")
+                idempotency_id = event.get("idempotency_id")
+                # the common types first, `ID_TYPES` checks are slow
+                if type(customer_id) is not str:
+                    require("customer_id", customer_id, ID_TYPES)
+                if type(event_name) is not str:
+                    require("event_name", event_name, string_types)
+                if type(properties) is not dict:
+                    require("properties", properties, dict)
+                if (
+                    aggregator
+                    and idempotency_id is None
+                    and time_created is None
+                    and aggregator.add(
+                        stringify_id(customer_id), event_name, properties
+                    )
+                ):
+                    merged += 1
+                    continue
+                if idempotency_id is None:
+                    idempotency_id = next(ids)
+                elif type(idempotency_id) is not str:
+                    require("idempotency_id", idempotency_id, ID_TYPES)
+                    idempotency_id = str(idempotency_id)
+                if time_created is None:
+                    time_created = now
+                elif type(time_created) is datetime:
+                    time_created = str(time_created)
+                else:
+                    require("time_created", time_created, string_types)
+                if not PLAIN_TYPES.issuperset(map(type, properties.values())):
+                    properties = clean(properties)
+                if type(customer_id) is not str:
+                    customer_id = str(customer_id)
+                # encoded right away, the queue holds no references to the
+                # caller's objects, and no containers for the GC to scan
+                body = dumps(
+                    {
+                        "$type": "track_event",
+                        "properties": properties,
+                        "time_created": time_created,
+                        "customer_id": customer_id,
+                        "event_name": event_name,
+                        "idempotency_id": idempotency_id,
+                        "library": "lotus-python",
+                        "library_version": VERSION,
+                    }
+                )
+            except Exception as e:
+                errors.append((index, e))
+                continue
+
+            # the same shard as `_shard` picks
+            shard = hash(customer_id) % shards if shards > 1 else 0
+            bodies[shard].append(body)
+            indexes[shard].append(index)
+
+        if not self.send:
+            return merged + sum(len(b) for b in bodies), errors
+
+        queued = 0
+        for queue, shard_bodies, shard_indexes in zip(self.queues, bodies, indexes):
+            count = put_many(queue, shard_bodies)
+            queued += count
+            if count < len(shard_bodies):
+                self.log.warning("queue is full")
+                self.metrics.incr("dropped", len(shard_bodies) - count)
+                errors.extend((index, Full()) for index in shard_indexes[count:])
+        self.metrics.incr("enqueued", queued)
+        errors.sort(key=lambda error: error[0])
+        return merged + queued, errors
+
+    def track_dataframe(
+        self,
+        frame,
+        customer_col="customer_id",
+        event_col="event_name",
+        time_col=None,
+        property_cols=None,
+        idempotency_col=None,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+    ):
+        """Queue one event per row of a pandas DataFrame or pyarrow Table.
+
+        Rows are validated and encoded a column at a time, see
+        `lotus.dataframe.encode_frame`, and queued as encoded events. Unlike
+        `track_event`, this waits for room when the queue is full, so that
+        a backfill is never dropped. Return the number of rows queued.
+        """
+        queued = 0
+        shards = len(self.queues)
+        for customer_ids, events in encode_frame(
+            frame,
+            customer_col=customer_col,
+            event_col=event_col,
+            time_col=time_col,
+            property_cols=property_cols,
+            idempotency_col=idempotency_col,
+            chunk_size=chunk_size,
+        ):
+            if not self.send:
+                queued += len(events)
+                continue
+            if self.sync_mode:
+                self._upload(events)
+                queued += len(events)
+                continue
+            if self.agent is not None:
+                sent = sum(self.agent.send(event) for event in events)
+                self.metrics.incr("dropped", len(events) - sent)
+                queued += sent
+                continue
+            if shards == 1:
+                queued += put_many(self.queue, events, block=True)
+                continue
+            buckets = [[] for _ in range(shards)]
+            for customer_id, event in zip(customer_ids, events):
+                buckets[hash(customer_id) % shards].append(event)
+            for queue, bucket in zip(self.queues, buckets):
+                queued += put_many(queue, bucket, block=True)
+        self.metrics.incr("enqueued", queued)
+        return queued
+
+    def _upload(self, events):
+        """Upload encoded events right away, in as many batches as needed."""
+        endpoint_host, method = self._endpoint({"$type": "track_event"})
+        batches = [Batch()]
+        for event in events:
+            if not batches[-1].add(event):
+                self.log.error("Item exceeds 32kb limit, dropping. (%s)", event)
+            elif batches[-1].full():
+                batches.append(Batch())
+        for batch in batches:
+            if len(batch):
+                send(
+                    endpoint_host,
+                    self.api_key,
+                    method=method,
+                    gzip=self.gzip,
+                    timeout=self.timeout,
+                    data=batch.encode(),
+                    session=self.session,
+                    metrics=self.metrics,
+                    compressor=self.compressor,
+                    limiter=self.rate_limiter,
+                )
+
+    def _track_each(self, events):
+        queued = 0
+        errors = []
+        for index, event in enumerate(events):
+            try:
+                Client.track_event(self, **event)
+            except Exception as e:
+                errors.append((index, e))
+            else:
+                queued += 1
+        return queued, errors
+
     def list_customers(
         self,
     ):
@@ -277,11 +743,7 @@ class Client(object):
             "$type": "list_customers",
         }
 
-        ret = self._enqueue(body, block=True)
-        if self.strict:
-            return [x.dict() for x in parse_obj_as(list[Customer], ret)]
-        else:
-            return [Customer.construct(**x).dict() for x in ret]
+        return self._call(Customer, body, many=True)
 
     def get_customer(
         self,
@@ -295,11 +757,7 @@ class Client(object):
             "$append_to_url": customer_id,
         }
 
-        ret = self._enqueue(body, block=True)
-        if self.strict:
-            return parse_obj_as(Customer, ret).dict()
-        else:
-            return Customer.construct(**ret).dict()
+        return self._call(Customer, body)
 
     def create_customer(
         self,
@@ -334,11 +792,7 @@ class Client(object):
         if payment_provider_id:
             body["payment_provider_id"] = payment_provider_id
 
-        ret = self._enqueue(body, block=True)
-        if self.strict:
-            return parse_obj_as(Customer, ret).dict()
-        else:
-            return Customer.construct(**ret).dict()
+        return self._call(Customer, body, invalidate=customer_id)
 
     def list_credits(
         self,
@@ -389,13 +843,7 @@ class Client(object):
             ], "Invalid status"
             body["status"] = status
 
-        ret = self._enqueue(body, block=True, query=query)
-        if self.strict:
-            return [
-                x.dict() for x in parse_obj_as(list[CustomerBalanceAdjustment], ret)
-            ]
-        else:
-            return [CustomerBalanceAdjustment.construct(**x).dict() for x in ret]
+        return self._call(CustomerBalanceAdjustment, body, query=query, many=True)
 
     def create_credit(
         self,
@@ -437,11 +885,7 @@ class Client(object):
             )
             body["amount_paid_currency_code"] = amount_paid_currency_code
 
-        ret = self._enqueue(body, block=True)
-        if self.strict:
-            return parse_obj_as(CustomerBalanceAdjustment, ret).dict()
-        else:
-            return CustomerBalanceAdjustment.construct(**ret).dict()
+        return self._call(CustomerBalanceAdjustment, body)
 
     def update_credit(
         self,
@@ -462,11 +906,7 @@ class Client(object):
             require("expires_at", expires_at, datetime)
             body["expires_at"] = expires_at
 
-        ret = self._enqueue(body, block=True)
-        if self.strict:
-            return parse_obj_as(CustomerBalanceAdjustment, ret).dict()
-        else:
-            return CustomerBalanceAdjustment.construct(**ret).dict()
+        return self._call(CustomerBalanceAdjustment, body)
 
     def void_credit(
         self,
@@ -479,11 +919,7 @@ class Client(object):
             "$append_to_url": credit_id,
         }
 
-        ret = self._enqueue(body, block=True)
-        if self.strict:
-            return parse_obj_as(CustomerBalanceAdjustment, ret).dict()
-        else:
-            return CustomerBalanceAdjustment.construct(**ret).dict()
+        return self._call(CustomerBalanceAdjustment, body)
 
     def batch_create_customers(
         self,
@@ -506,7 +942,7 @@ class Client(object):
             "behavior_on_existing": behavior_on_existing,
         }
 
-        return self._enqueue(body, block=True)
+        return self._call(None, body)
 
     def create_subscription(
         self,
@@ -561,11 +997,7 @@ class Client(object):
         if metadata:
             body["metadata"] = metadata
 
-        ret = self._enqueue(body, block=True)
-        if self.strict:
-            return parse_obj_as(SubscriptionRecord, ret).dict()
-        else:
-            return SubscriptionRecord.construct(**ret).dict()
+        return self._call(SubscriptionRecord, body, invalidate=customer_id)
 
     def cancel_subscription(
         self,
@@ -604,18 +1036,13 @@ class Client(object):
             body["invoicing_behavior"] = invoicing_behavior
         query = {}
 
-        if subscription_id:
-            ret = self._enqueue(
-                body,
-                query=query,
-                block=True,
-                endpoint_url=f"/api/subscriptions/{subscription_id}/cancel/",
-            )
-
-        if self.strict:
-            return parse_obj_as(SubscriptionRecord, ret).dict()
-        else:
-            return SubscriptionRecord.construct(**ret)
+        return self._call(
+            SubscriptionRecord,
+            body,
+            query=query,
+            endpoint_url=f"/api/subscriptions/{subscription_id}/cancel/",
+            invalidate=True,
+        )
 
     def list_subscriptions(
         self,
@@ -656,11 +1083,7 @@ class Client(object):
         if range_start is not None:
             query["range_start"] = range_start
 
-        ret = self._enqueue(body, query=query, block=True)
-        if self.strict:
-            return [x.dict() for x in parse_obj_as(list[SubscriptionRecord], ret)]
-        else:
-            return [SubscriptionRecord.construct(**x).dict() for x in ret]
+        return self._call(SubscriptionRecord, body, query=query, many=True)
 
     def switch_subscription_plan(
         self,
@@ -696,15 +1119,12 @@ class Client(object):
         if usage_behavior:
             body["usage_behavior"] = usage_behavior
 
-        ret = self._enqueue(
+        return self._call(
+            SubscriptionRecord,
             body,
-            block=True,
             endpoint_url=f"/api/subscriptions/{subscription_id}/switch_plan/",
+            invalidate=True,
         )
-        if self.strict:
-            return parse_obj_as(SubscriptionRecord, ret).dict()
-        else:
-            return SubscriptionRecord.construct(**ret)
 
     def update_subscription(
         self,
@@ -733,17 +1153,13 @@ class Client(object):
         if end_date:
             body["end_date"] = end_date
 
-        ret = self._enqueue(
+        return self._call(
+            SubscriptionRecord,
             body,
-            block=True,
             endpoint_url=f"/api/subscriptions/{subscription_id}/update/",
+            invalidate=True,
         )
 
-        if self.strict:
-            return parse_obj_as(SubscriptionRecord, ret).dict()
-        else:
-            return SubscriptionRecord.construct(**ret)
-
     def attach_addon(
         self,
         *,
@@ -789,11 +1205,9 @@ class Client(object):
 
         endpoint_url = f"/api/subscriptions/{subscription_id}/addons/attach/"
 
-        ret = self._enqueue(body, block=True, endpoint_url=endpoint_url)
-        if self.strict:
-            return parse_obj_as(AddOnSubscriptionRecord, ret).dict()
-        else:
-            return AddOnSubscriptionRecord.construct(**ret).dict()
+        return self._call(
+            AddOnSubscriptionRecord, body, endpoint_url=endpoint_url, invalidate=True
+        )
 
     def cancel_addon(
         self,
@@ -852,11 +1266,9 @@ class Client(object):
         else:
             raise ValueError("Either addon_id or addon_version_id must be provided")
 
-        ret = self._enqueue(body, block=True, endpoint_url=endpoint_url)
-        if self.strict:
-            return parse_obj_as(AddOnSubscriptionRecord, ret).dict()
-        else:
-            return AddOnSubscriptionRecord.construct(**ret).dict()
+        return self._call(
+            AddOnSubscriptionRecord, body, endpoint_url=endpoint_url, invalidate=True
+        )
 
     def list_plans(
         self,
@@ -925,11 +1337,7 @@ class Client(object):
         if version_status is not None:
             query["version_status"] = version_status
 
-        ret = self._enqueue(body, block=True)
-        if self.strict:
-            return [x.dict() for x in parse_obj_as(list[Plan], ret)]
-        else:
-            return [Plan.construct(**x).dict() for x in ret]
+        return self._call(Plan, body, many=True)
 
     def get_plan(
         self,
@@ -942,11 +1350,7 @@ class Client(object):
             "$type": "get_plan",
             "$append_to_url": plan_id,
         }
-        ret = self._enqueue(body, block=True)
-        if self.strict:
-            return parse_obj_as(Plan, ret).dict()
-        else:
-            return Plan.construct(**ret).dict()
+        return self._call(Plan, body)
 
     def get_customer_metric_access(
         self,
@@ -975,11 +1379,7 @@ class Client(object):
             "subscription_filters": subscription_filters,
         }
 
-        ret = self._enqueue(body, query=query, block=True)
-        if self.strict:
-            return [x.dict() for x in parse_obj_as(list[GetEventAccess], ret)]
-        else:
-            return [GetEventAccess.construct(**x).dict() for x in ret]
+        return self._call(GetEventAccess, body, query=query, many=True)
 
     def check_metric_access(
         self,
@@ -1002,11 +1402,10 @@ class Client(object):
             "subscription_filters": subscription_filters,
         }
 
-        ret = self._enqueue(body, query=query, block=True)
-        if self.strict:
-            return parse_obj_as(MetricAccessResponse, ret).dict()
-        else:
-            return MetricAccessResponse.construct(**ret).dict()
+        key = cache_key(
+            "check_metric_access", customer_id, metric_id, subscription_filters
+        )
+        return self._cached(key, MetricAccessResponse, body, query=query)
 
     def get_customer_feature_access(
         self,
@@ -1025,11 +1424,7 @@ class Client(object):
             "feature_name": feature_name,
         }
 
-        ret = self._enqueue(body, query=query, block=True)
-        if self.strict:
-            return [x.dict() for x in parse_obj_as(list[GetFeatureAccess], ret)]
-        else:
-            return [GetFeatureAccess.construct(**x).dict() for x in ret]
+        return self._call(GetFeatureAccess, body, query=query, many=True)
 
     def check_feature_access(
         self,
@@ -1052,11 +1447,10 @@ class Client(object):
             "subscription_filters": subscription_filters,
         }
 
-        ret = self._enqueue(body, query=query, block=True)
-        if self.strict:
-            return parse_obj_as(FeatureAccessResponse, ret).dict()
-        else:
-            return FeatureAccessResponse.construct(**ret).dict()
+        key = cache_key(
+            "check_feature_access", customer_id, feature_id, subscription_filters
+        )
+        return self._cached(key, FeatureAccessResponse, body, query=query)
 
     def _enqueue(self, body, query=None, block=False, endpoint_url=None):
         """Push a new `body` onto the queue, return `(success, body)`"""
@@ -1068,7 +1462,9 @@ class Client(object):
         if "customer_id" in body:
             body["customer_id"] = stringify_id(body.get("customer_id", None))
 
-        body = clean(body)
+        # queued bodies must not share the lists and dicts of the caller's
+        # arguments, which may be changed before they are uploaded
+        body = clean(body, copy=True)
         self.log.debug("queueing: %s", body)
 
         # if send is False, return body as if it was successfully queued
@@ -1076,23 +1472,52 @@ class Client(object):
             return True, body
 
         if self.sync_mode or block:
-            operation = body["$type"]
-            if endpoint_url is None:
-                endpoint_url = self.operations[operation]["url"]
-                if "$append_to_url" in body:
-                    endpoint_url = endpoint_url + body["$append_to_url"] + "/"
-            body.pop("$append_to_url", None)
-            if self.host:
-                endpoint_host = self.host + endpoint_url
-            else:
-                endpoint_host = "https://api.uselotus.io" + endpoint_url
-            if operation == "update_credit":
-                endpoint_host = endpoint_host + "update/"
-            elif operation == "void_credit":
-                endpoint_host = endpoint_host + "void/"
-            self.log.debug(
-                "enqueued body to %s with blocking %s.", endpoint_host, body["$type"]
-            )
+            return self._request(body, query=query, endpoint_url=endpoint_url)
+
+        if self.agent is not None:
+            if not self.agent.send(codec.dumps(body)):
+                self.metrics.incr("dropped")
+                self.log.warning("could not send the event to the agent")
+                return False, body
+            self.metrics.incr("enqueued")
+            return True, body
+
+        try:
+            self._shard(body.get("customer_id")).put(body, block=False)
+            self.metrics.incr("enqueued")
+            self.log.debug("enqueued %s.", body["$type"])
+            return True, body
+        except Full:
+            self.metrics.incr("dropped")
+            self.log.warning("queue is full")
+            return False, body
+
+    def _endpoint(self, body, endpoint_url=None):
+        """Return the url and HTTP method of a blocking request for `body`."""
+        operation = body["$type"]
+        if endpoint_url is None:
+            endpoint_url = self.operations[operation]["url"]
+            if "$append_to_url" in body:
+                endpoint_url = endpoint_url + body["$append_to_url"] + "/"
+        body.pop("$append_to_url", None)
+        if self.host:
+            endpoint_host = self.host + endpoint_url
+        else:
+            endpoint_host = "https://api.uselotus.io" + endpoint_url
+        if operation == "update_credit":
+            endpoint_host = endpoint_host + "update/"
+        elif operation == "void_credit":
+            endpoint_host = endpoint_host + "void/"
+        self.log.debug(
+            "enqueued body to %s with blocking %s.", endpoint_host, body["$type"]
+        )
+        return endpoint_host, self.operations[operation]["method"]
+
+    def _request(self, body, query=None, endpoint_url=None):
+        """Send `body` right away, return the decoded response."""
+        endpoint_host, method = self._endpoint(body, endpoint_url)
+        started = monotonic.monotonic()
+        try:
             response = send(
                 endpoint_host,
                 api_key=self.api_key,
@@ -1100,43 +1525,149 @@ class Client(object):
                 timeout=self.timeout,
                 body=body,
                 query=query,
-                method=self.operations[operation]["method"],
+                method=method,
+                session=self.session,
+                metrics=self.metrics,
+                compressor=self.compressor,
+                limiter=self.rate_limiter,
             )
+        finally:
+            self.metrics.observe("request_seconds", monotonic.monotonic() - started)
+        return decode_response(response)
+
+    def _call(
+        self, model, body, query=None, endpoint_url=None, many=False, invalidate=False
+    ):
+        """Make a blocking request, return the response parsed as `model`.
+
+        `invalidate` drops cached access checks once the request is done: those
+        of one customer if it is a customer id, or all of them if it is True.
+        """
+        ret = self._enqueue(body, query=query, block=True, endpoint_url=endpoint_url)
+        self._invalidate(invalidate)
+        return self._parse(model, ret, many=many)
+
+    def _cached(self, key, model, body, query=None):
+        """Make a blocking access check, through the entitlement cache if any."""
+        cache = self.entitlement_cache
+        if cache is None:
+            return self._call(model, body, query=query)
+        return cache.get(key[0], key, partial(self._call, model, body, query=query))
+
+    def _invalidate(self, invalidate):
+        if self.entitlement_cache is None or invalidate is False:
+            return
+        if invalidate is True:
+            self.entitlement_cache.invalidate()
+        else:
+            self.entitlement_cache.invalidate(invalidate)
+
+    def _parse(self, model, ret, many=False):
+        """Parse a response into `model` dicts, validating them if strict."""
+        if model is None:
+            return ret
+        if many:
+            if self.strict:
+                return [x.dict() for x in parse_obj_as(list[model], ret)]
+            else:
+                return [model.construct(**x).dict() for x in ret]
+        if self.strict:
+            return parse_obj_as(model, ret).dict()
+        else:
+            return model.construct(**ret).dict()
+
+    def prewarm(self, connections=1):
+        """Open `connections` connections to the API ahead of time.
 
+        They are kept alive in the session's pool, so the first uploads and
+        blocking calls don't pay for the TCP and TLS handshakes.
+        """
+        endpoint_host, _ = self._endpoint({"$type": "ping"})
+
+        def ping():
             try:
-                data = response.json()
-            except Exception:
-                data = response.text
+                send(
+                    endpoint_host,
+                    self.api_key,
+                    method=HTTPMethod.GET,
+                    timeout=self.timeout,
+                    session=self.session,
+                )
+            except Exception as e:
+                self.log.debug("error prewarming connection: %s", e)
 
-            return data
+        threads = [Thread(target=ping) for _ in range(connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-        try:
-            self.queue.put(body, block=False)
-            self.log.debug("enqueued %s.", body["$type"])
-            return True, body
-        except Full:
-            self.log.warning("queue is full")
-            return False, body
+    def _shard(self, customer_id):
+        """Return the queue shard for `customer_id`.
+
+        Events of one customer always land on the same shard, so they are
+        uploaded in the order they were tracked.
+        """
+        queues = self.queues
+        if len(queues) == 1:
+            return queues[0]
+        return queues[hash(customer_id) % len(queues)]
+
+    def stats(self):
+        """Return a snapshot of the client's ingestion metrics.
+
+        Counters (`enqueued`, `dropped`, `retries`, ...) are totals since the
+        client was created, histograms (`batch_events`, `batch_bytes`,
+        `serialize_seconds`, `compress_seconds`, `upload_seconds`,
+        `request_seconds`) are dicts with a count, sum and percentiles.
+        """
+        stats = self.metrics.snapshot()
+        # emitters count the events they queue themselves
+        enqueued = sum(emitter.enqueued() for emitter in list(self._emitters))
+        if enqueued:
+            stats["enqueued"] = stats.get("enqueued", 0) + enqueued
+        ages = [queue.oldest_age() for queue in self.queues]
+        ages = [age for age in ages if age is not None]
+        stats["queue_depth"] = sum(queue.qsize() for queue in self.queues)
+        stats["oldest_event_age"] = max(ages) if ages else None
+        stats["retry_depth"] = sum(len(c.retry_lane) for c in self.consumers)
+        adaptive = [c.adaptive.settings() for c in self.consumers if c.adaptive]
+        if adaptive:
+            stats["adaptive"] = adaptive
+        return stats
 
     def flush(self):
-        """Forces a flush from the internal queue to the server"""
-        queue = self.queue
-        size = queue.qsize()
-        queue.join()
+        """Forces a flush from the internal queues to the server"""
+        if self.aggregator:
+            self.aggregator.flush()
+        size = sum(queue.qsize() for queue in self.queues)
+        for queue in self.queues:
+            queue.join()
         # Note that this message may not be precise, because of threading.
         self.log.debug("successfully flushed about %s items.", size)
 
     def join(self):
-        """Ends the consumer thread once the queue is empty.
+        """Ends the consumer threads once the queues are empty.
         Blocks execution until finished
         """
+        if self.aggregator:
+            self.aggregator.stop()
+        # pause every consumer first so that they wind down concurrently
         for consumer in self.consumers:
             consumer.pause()
+        for consumer in self.consumers:
             try:
                 consumer.join()
             except RuntimeError:
                 # consumer thread has not started
                 pass
+        for queue in self.queues:
+            if isinstance(queue, SpoolQueue):
+                queue.sync()
+        if self.stats_reporter:
+            # one last report, with the final counts
+            self.stats_reporter.stop()
+            self.stats_reporter.report()
 
     def shutdown(self):
         """Flush all messages and cleanly shutdown the client"""
@@ -1144,6 +1675,18 @@ class Client(object):
         self.join()
 
 
+def _after_fork():
+    for client in list(_clients):
+        try:
+            client._after_fork()
+        except Exception:
+            client.log.exception("error restarting the client after a fork")
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
 def require(name, field, data_type):
     """Require that the named `field` has the right `data_type`"""
     if not isinstance(field, data_type):
@@ -1151,6 +1694,14 @@ def require(name, field, data_type):
         raise AssertionError(body)
 
 
+def decode_response(response):
+    """Return the JSON payload of `response`, or its text if it has none."""
+    try:
+        return response.json()
+    except Exception:
+        return response.text
+
+
 def stringify_id(val):
     if val is None:
         return None
@@ -0,0 +1,112 @@
+"""JSON encoding for request bodies.
+
+Bodies are encoded to compact UTF-8 JSON bytes. When `orjson` is installed it
+is used, otherwise the stdlib `json` module is. Both backends produce the same
+bytes for the payloads the client builds: strings, integers, plain floats,
+datetimes, dates, Decimals and nested dicts/lists of those. The only
+differences are in the spelling of floats in exponent notation (`1e+16` vs
+`1e16`) and in NaN/Infinity, which are not valid JSON to begin with.
+
+`ujson` and `msgspec` are not offered as backends: the former has no hook for
+datetimes, and the latter formats UTC offsets as `Z`, so neither produces the
+same output as the stdlib encoder.
+"""
+
+import json
+import logging
+from datetime import date, datetime
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+log = logging.getLogger("lotus")
+
+
+def _default(obj):
+    if isinstance(obj, (date, datetime)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(
+        "Object of type {0} is not JSON serializable".format(type(obj).__name__)
+    )
+
+
+class DatetimeSerializer(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, (date, datetime, Decimal)):
+            return _default(obj)
+
+        return json.JSONEncoder.default(self, obj)
+
+
+class JSONCodec(object):
+    """Encodes with the stdlib `json` module."""
+
+    name = "json"
+
+    def __init__(self):
+        self._encoder = DatetimeSerializer(separators=(",", ":"), ensure_ascii=False)
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj).encode("utf-8")
+
+
+class OrjsonCodec(JSONCodec):
+    """Encodes with `orjson`, falling back to `json` for what it rejects."""
+
+    name = "orjson"
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("orjson is not installed")
+        JSONCodec.__init__(self)
+        self._option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj):
+        try:
+            return orjson.dumps(obj, default=_default, option=self._option)
+        except orjson.JSONEncodeError:
+            # eg. integers over 64 bits, which the stdlib encoder accepts
+            return JSONCodec.dumps(self, obj)
+
+
+CODECS = {
+    "json": JSONCodec,
+    "orjson": OrjsonCodec,
+}
+
+
+def available():
+    """Return the names of the codecs that can be used."""
+    names = ["json"]
+    if orjson is not None:
+        names.insert(0, "orjson")
+    return names
+
+
+def get_codec(name=None):
+    """Return a codec instance, the fastest available one if `name` is None."""
+    if name is None:
+        name = available()[0]
+    if name not in CODECS:
+        raise ValueError("Unknown JSON codec: " + name)
+    return CODECS[name]()
+
+
+def set_codec(name):
+    """Switch the codec used by `dumps`."""
+    global _codec
+    _codec = get_codec(name)
+    log.debug("using %s codec", _codec.name)
+
+
+def dumps(obj):
+    """Encode `obj` to compact JSON bytes."""
+    return _codec.dumps(obj)
+
+
+_codec = get_codec()
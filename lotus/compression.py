@@ -0,0 +1,119 @@
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+from .metrics import RATIO_BOUNDS, SIZE_BOUNDS
+
+# request bodies smaller than this are not worth compressing
+DEFAULT_THRESHOLD = 1024
+
+# weight of the latest measurement in the running compression ratio
+RATIO_WEIGHT = 0.2
+# share of the estimated ratio batches are packed to, in case it drops
+RATIO_MARGIN = 0.8
+# batches are never packed to more than this many times the wire limit
+MAX_RATIO = 20
+
+
+class Compressor(object):
+    """Compresses request bodies as they are encoded.
+
+    `compress` feeds the body's chunks to a streaming compressor one at a
+    time, so the uncompressed body is never joined into a single buffer.
+    Bodies under `threshold` bytes are sent as they are.
+
+    `ratio` is a moving average of the compression ratios measured so far,
+    used by `max_batch_size` to pack batches up to the wire limit.
+
+    Subclasses set the `encoding` they send, and define `compressobj`, which
+    returns a new streaming compressor for each body.
+    """
+
+    encoding = None
+
+    def __init__(self, level=None, threshold=DEFAULT_THRESHOLD):
+        self.level = level
+        self.threshold = threshold
+        self.ratio = 1.0
+
+    def max_batch_size(self, wire_limit):
+        """Uncompressed bytes expected to compress to under `wire_limit`."""
+        ratio = min(max(self.ratio * RATIO_MARGIN, 1.0), MAX_RATIO)
+        return int(wire_limit * ratio)
+
+    def compress(self, chunks, metrics=None):
+        """Return `(encoding, data)` for a body made of `chunks`.
+
+        `encoding` is None when the body was too small to compress.
+        """
+        if isinstance(chunks, bytes):
+            chunks = (chunks,)
+        size = sum(len(chunk) for chunk in chunks)
+        if size < self.threshold:
+            if metrics is not None:
+                metrics.incr("compression_skipped")
+            return None, b"".join(chunks)
+
+        started = time.thread_time()
+        compressor = self.compressobj()
+        out = [compressor.compress(chunk) for chunk in chunks]
+        out.append(compressor.flush())
+        data = b"".join(out)
+        ratio = size / len(data)
+        # shared by every consumer, a lost update between threads is harmless
+        self.ratio += RATIO_WEIGHT * (ratio - self.ratio)
+        if metrics is not None:
+            metrics.observe("compress_seconds", time.thread_time() - started)
+            metrics.observe("compression_ratio", ratio, RATIO_BOUNDS)
+            metrics.observe("compressed_bytes", len(data), SIZE_BOUNDS)
+        return self.encoding, data
+
+
+class GzipCompressor(Compressor):
+    encoding = "gzip"
+
+    def compressobj(self):
+        level = zlib.Z_DEFAULT_COMPRESSION if self.level is None else self.level
+        # wbits=31 writes a gzip header and trailer
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+class ZstdCompressor(Compressor):
+    encoding = "zstd"
+
+    def __init__(self, level=None, threshold=DEFAULT_THRESHOLD):
+        if zstandard is None:
+            raise ImportError("zstd compression requires zstandard")
+        Compressor.__init__(self, level, threshold)
+
+    def compressobj(self):
+        # a ZstdCompressor must not be shared between threads
+        level = 3 if self.level is None else self.level
+        return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+COMPRESSORS = {
+    "gzip": GzipCompressor,
+    "zstd": ZstdCompressor,
+}
+
+# used when only `gzip=True` is passed, compresses every body like it used to
+GZIP = GzipCompressor(threshold=0)
+
+
+def get_compressor(name, level=None, threshold=DEFAULT_THRESHOLD):
+    """Return the compressor registered as `name`, or None if it is None."""
+    if name is None:
+        return None
+    try:
+        cls = COMPRESSORS[name]
+    except KeyError:
+        raise ValueError(
+            "Unknown compression %r, expected one of %s"
+            % (name, ", ".join(sorted(COMPRESSORS)))
+        )
+    return cls(level=level, threshold=threshold)
@@ -1,12 +1,17 @@
-import json
+import heapq
+import itertools
 import logging
 from queue import Empty
-from threading import Thread
+from threading import Condition, Thread, current_thread
 
 import backoff
 import monotonic
 
-from .request import APIError, DatetimeSerializer, send
+from .batch import BATCH_SIZE_LIMIT, MAX_MSG_SIZE, Batch  # noqa: F401
+from .compression import GZIP
+from .metrics import SIZE_BOUNDS, Metrics
+from .request import APIError, send
+from .spool import SpoolEntry
 from .utils import HTTPMethod
 
 # try:
@@ -14,11 +19,26 @@ from .utils import HTTPMethod
 # except ImportError:
 #     from Queue import Empty
 
-MAX_MSG_SIZE = 32 << 10
 
-# Our servers only accept batches less than 500KB. Here limit is set slightly
-# lower to leave space for extra data that will be added later, eg. "sentAt".
-BATCH_SIZE_LIMIT = 475000
+def fatal_exception(exc):
+    """Whether `exc` means the API rejected the request for good."""
+    if isinstance(exc, APIError):
+        # retry on server errors and client errors
+        # with 429 status code (rate limited),
+        # don't retry on other client errors
+        return (400 <= exc.status < 500) and exc.status != 429
+    else:
+        # retry on all other errors (eg. network)
+        return False
+
+
+def rejected_exception(exc):
+    """Whether `exc` may be caused by some of a batch's items only.
+
+    The API answers 400 to malformed events and 413 to oversized bodies, so
+    smaller parts of such a batch may still be accepted.
+    """
+    return isinstance(exc, APIError) and exc.status in (400, 413)
 
 
 class Consumer(Thread):
@@ -38,6 +58,15 @@ class Consumer(Thread):
         retries=10,
         timeout=15,
         operation=None,
+        max_retry_batches=100,
+        backoff_base=1,
+        backoff_max=60,
+        session=None,
+        metrics=None,
+        compressor=None,
+        dead_letter=None,
+        adaptive=None,
+        limiter=None,
     ):
         """Create a consumer thread."""
         Thread.__init__(self)
@@ -50,6 +79,15 @@ class Consumer(Thread):
         self.on_error = on_error
         self.queue = queue
         self.gzip = gzip
+        # takes over from `gzip`, see `lotus.compression`
+        self.compressor = compressor
+        # whose `add(batch, error)` receives the batches that failed for good
+        self.dead_letter = dead_letter
+        # an `AdaptiveBatching` that takes over from `flush_at` and
+        # `flush_interval`, and paces requests
+        self.adaptive = adaptive
+        # a `RateLimiter`, usually shared with the client and its consumers
+        self.limiter = limiter
         # It's important to set running in the constructor: if we are asked to
         # pause immediately after construction, we might set running to True in
         # run() *after* we set it to False in pause... and keep running
@@ -57,6 +95,12 @@ class Consumer(Thread):
         self.running = True
         self.retries = retries
         self.timeout = timeout
+        self.session = session
+        # usually shared with the client, see `Client.stats`
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_lane = RetryLane(self, max_batches=max_retry_batches)
 
     def run(self):
         """Runs the consumer."""
@@ -64,6 +108,8 @@ class Consumer(Thread):
         while self.running:
             self.upload()
 
+        # give the batches waiting for a retry one last chance
+        self.retry_lane.stop()
         self.log.debug("consumer exited.")
 
     def pause(self):
@@ -71,78 +117,262 @@ class Consumer(Thread):
         self.running = False
 
     def upload(self):
-        """Upload the next batch of items, return whether successful."""
-        success = False
+        """Upload the next batch of items, return whether successful.
+
+        A batch that fails with a retryable error is handed to the retry lane,
+        so that the consumer can move on to the next batch right away.
+        """
         batch = self.next()
+        if self.adaptive is not None:
+            self.adaptive.batched(batch, self.queue.qsize())
         if len(batch) == 0:
             return False
 
         try:
             self.request(batch)
-            success = True
         except Exception as e:
-            self.log.error("error uploading: %s", e)
-            success = False
-            if self.on_error:
-                self.on_error(e, batch)
+            self.record(batch)
+            self.failed(batch, e)
+            return False
+
+        self.record(batch)
+        self.finish(batch)
+        return True
+
+    def record(self, batch):
+        """Record the size of a batch after its first attempt."""
+        metrics = self.metrics
+        metrics.observe("batch_events", len(batch), SIZE_BOUNDS)
+        metrics.observe("batch_bytes", batch.size, SIZE_BOUNDS)
+        metrics.observe("serialize_seconds", batch.serialize_time)
+
+    def failed(self, batch, error, attempt=0):
+        """Handle a batch whose `attempt`th retry, or upload, failed."""
+        if rejected_exception(error) and len(batch) > 1:
+            self.bisect(batch)
+        elif (
+            attempt < self.retries
+            and not fatal_exception(error)
+            and self.retry_lane.schedule(
+                batch, attempt + 1, getattr(error, "retry_after", None)
+            )
+        ):
+            if attempt:
+                self.log.debug("retry %d failed: %s", attempt, error)
+            else:
+                self.log.warning("error uploading, will retry: %s", error)
+        else:
+            self.finish(batch, error)
+
+    def bisect(self, batch):
+        """Upload both halves of a rejected batch on their own.
+
+        Halves that are rejected again are split further, down to the items
+        the API refuses, which are reported on their own. With k bad items
+        among n, this takes O(k log n) requests.
+        """
+        self.metrics.incr("batches_split")
+        for half in batch.split():
+            try:
+                self.request(half)
+            except Exception as e:
+                self.failed(half, e)
+            else:
+                self.finish(half)
+
+    def finish(self, batch, error=None):
+        """Report the outcome of a batch and acknowledge its items."""
+        try:
+            if error is not None:
+                self.metrics.incr("events_failed", len(batch))
+                self.log.error("error uploading: %s", error)
+                if self.dead_letter is not None:
+                    self.dead_letter.add(batch, error)
+                if self.on_error:
+                    self.on_error(error, batch.items)
+            else:
+                self.metrics.incr("events_uploaded", len(batch))
+            # spooled items stay in the spool, to be replayed on the next
+            # start, unless the API has either accepted or rejected them, or
+            # they are kept in the dead letter store
+            if batch.receipts and (
+                error is None or fatal_exception(error) or self.dead_letter is not None
+            ):
+                self.queue.ack(batch.receipts)
         finally:
             # mark items as acknowledged from queue
             for item in batch:
                 self.queue.task_done()
-            return success
 
     def next(self):
         """Return the next batch of items to upload."""
         queue = self.queue
-        items = []
+        batch = Batch(max_size=self.max_batch_size())
+        limits = self.adaptive or self
+        flush_at = limits.flush_at
+        flush_interval = limits.flush_interval
 
         start_time = monotonic.monotonic()
-        total_size = 0
 
-        while len(items) < self.flush_at:
+        while len(batch) < flush_at:
             elapsed = monotonic.monotonic() - start_time
-            if elapsed >= self.flush_interval:
+            if elapsed >= flush_interval:
                 break
             try:
-                item = queue.get(block=True, timeout=self.flush_interval - elapsed)
-                item_size = len(json.dumps(item, cls=DatetimeSerializer).encode())
-                if item_size > MAX_MSG_SIZE:
-                    self.log.error("Item exceeds 32kb limit, dropping. (%s)", str(item))
-                    continue
-                items.append(item)
-                total_size += item_size
-                if total_size >= BATCH_SIZE_LIMIT:
-                    self.log.debug("hit batch size limit (size: %d)", total_size)
-                    break
+                item = queue.get(block=True, timeout=flush_interval - elapsed)
             except Empty:
                 break
+            if not batch.add(item):
+                self.log.error("Item exceeds 32kb limit, dropping. (%s)", str(item))
+                self.metrics.incr("dropped_oversized")
+                # the dropped item will never be uploaded, acknowledge it
+                # here so that flush() does not wait for it forever
+                if isinstance(item, SpoolEntry):
+                    queue.ack([item.rowid])
+                queue.task_done()
+                continue
+            if batch.full():
+                self.log.debug("hit batch size limit (size: %d)", batch.size)
+                break
 
-        return items
+        return batch
 
-    def request(self, batch):
-        """Attempt to upload the batch and retry before raising an error"""
-
-        def fatal_exception(exc):
-            if isinstance(exc, APIError):
-                # retry on server errors and client errors
-                # with 429 status code (rate limited),
-                # don't retry on other client errors
-                return (400 <= exc.status < 500) and exc.status != 429
-            else:
-                # retry on all other errors (eg. network)
-                return False
+    def max_batch_size(self):
+        """Uncompressed size limit of the next batch.
 
-        @backoff.on_exception(
-            backoff.expo, Exception, max_tries=self.retries + 1, giveup=fatal_exception
-        )
-        def send_request():
+        When compressing, batches are packed until their estimated compressed
+        size reaches the wire limit, instead of their uncompressed size.
+        """
+        compressor = self.compressor or (GZIP if self.gzip else None)
+        if compressor is None:
+            return BATCH_SIZE_LIMIT
+        return compressor.max_batch_size(BATCH_SIZE_LIMIT)
+
+    def request(self, batch):
+        """Make a single attempt at uploading the batch"""
+        adaptive = self.adaptive
+        if adaptive is not None:
+            adaptive.wait()
+        batch.attempts += 1
+        started = monotonic.monotonic()
+        if self.compressor or self.gzip:
+            # compressed as a stream, without joining the chunks first
+            data = batch.chunks()
+        else:
+            data = batch.encode()
+        sent = monotonic.monotonic()
+        batch.serialize_time += sent - started
+        error = None
+        try:
             send(
                 self.host,
                 self.api_key,
                 gzip=self.gzip,
                 timeout=self.timeout,
-                body={"batch": batch},
+                data=data,
                 method=HTTPMethod.POST,
+                session=self.session,
+                metrics=self.metrics,
+                compressor=self.compressor,
+                limiter=self.limiter,
             )
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = monotonic.monotonic() - sent
+            self.metrics.observe("upload_seconds", elapsed)
+            if adaptive is not None:
+                adaptive.observe(elapsed, error)
+
+
+class RetryLane(Thread):
+    """Retries a consumer's failed batches on their own schedule.
+
+    Each batch is retried with exponential backoff and full jitter, up to the
+    consumer's `retries` times, while the consumer keeps uploading new
+    batches. At most `max_batches` batches wait at once; past that, the
+    consumer waits for one of them to be retried before it schedules its next
+    failed batch, and so stops taking new batches from its queue. With
+    `max_batches=0`, failed batches are reported to `on_error` immediately.
+    """
+
+    log = logging.getLogger("lotus")
+
+    def __init__(self, consumer, max_batches=100):
+        Thread.__init__(self)
+        self.daemon = True
+        self.consumer = consumer
+        self.max_batches = max_batches
+        self.running = True
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = Condition()
 
-        send_request()
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, batch, attempt=1, retry_after=None):
+        """Queue `batch` for its next attempt, return False if the lane is full.
+
+        The attempt waits at least `retry_after` seconds, when the API asked,
+        up to `backoff_max`.
+        """
+        consumer = self.consumer
+        delay = backoff.full_jitter(
+            min(consumer.backoff_max, consumer.backoff_base * 2 ** (attempt - 1))
+        )
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, consumer.backoff_max))
+        with self._condition:
+            if not self.max_batches:
+                return False
+            # the lane itself reschedules the batch it just took out
+            while (
+                len(self._heap) >= self.max_batches
+                and self.running
+                and current_thread() is not self
+            ):
+                self._condition.wait()
+            if not self.running:
+                return False
+            if not self.is_alive():
+                self.start()
+            due = monotonic.monotonic() + delay
+            heapq.heappush(self._heap, (due, next(self._sequence), batch, attempt))
+            self._condition.notify_all()
+        return True
+
+    def stop(self):
+        """Retry every waiting batch once, without waiting, then exit."""
+        with self._condition:
+            self.running = False
+            self._condition.notify_all()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while self.running:
+                    now = monotonic.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    self._condition.wait(timeout)
+                if not self._heap:
+                    return
+                _, _, batch, attempt = heapq.heappop(self._heap)
+                # a consumer may be waiting for room
+                self._condition.notify_all()
+            self.retry(batch, attempt)
+
+    def retry(self, batch, attempt):
+        consumer = self.consumer
+        consumer.metrics.incr("retries")
+        try:
+            consumer.request(batch)
+        except Exception as e:
+            consumer.failed(batch, e, attempt)
+        else:
+            consumer.finish(batch)
@@ -0,0 +1,163 @@
+import json
+import math
+import os
+from datetime import datetime
+
+from dateutil.tz import tzutc
+
+from .version import VERSION
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:  # pragma: no cover
+    np = pd = None
+
+# rows encoded at once, bounds the memory used on top of the frame itself
+DEFAULT_CHUNK_SIZE = 10000
+
+_HEX = np.frombuffer(b"0123456789abcdef", dtype=np.uint8) if np else None
+# (start, end, dashes before) of the hex digit groups of a UUID
+_UUID_GROUPS = ((0, 8, 0), (8, 12, 1), (12, 16, 2), (16, 20, 3), (20, 32, 4))
+
+
+def encode_frame(
+    frame,
+    customer_col="customer_id",
+    event_col="event_name",
+    time_col=None,
+    property_cols=None,
+    idempotency_col=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+):
+    """Yield `(customer_ids, events)` for every `chunk_size` rows of `frame`.
+
+    `frame` is a pandas DataFrame, or a pyarrow Table converted to one.
+    Each event is the JSON encoding of a `track_event` body, built from
+    whole columns at once: ids are stringified, timestamps formatted and
+    properties encoded by pandas, without a Python dict per row.
+    `property_cols` defaults to every other column, and rows without an
+    idempotency column get random ones. Rows missing a customer, event,
+    time or idempotency id raise ValueError, before any is encoded.
+    """
+    if pd is None:
+        raise ImportError("track_dataframe requires pandas, install pandas")
+    if not isinstance(frame, pd.DataFrame):
+        # pyarrow Tables and RecordBatches
+        frame = frame.to_pandas()
+    for name in (customer_col, event_col, time_col, idempotency_col):
+        if name is not None and name not in frame.columns:
+            raise ValueError("No column named %r" % name)
+    for name in (customer_col, event_col, time_col, idempotency_col):
+        if name is not None:
+            _check_missing(frame[name], name)
+    times = None
+    if time_col is not None:
+        # parsed whole, so that strings parsing to NaT, such as "", raise
+        # before any chunk is yielded
+        times = frame[time_col]
+        if not pd.api.types.is_datetime64_any_dtype(times):
+            times = pd.to_datetime(times, utc=True, cache=False)
+        if times.dt.tz is not None:
+            times = times.dt.tz_convert(None)
+        _check_missing(times, time_col)
+        times = times.values.astype("datetime64[us]")
+    if property_cols is None:
+        reserved = {customer_col, event_col, time_col, idempotency_col}
+        property_cols = [c for c in frame.columns if c not in reserved]
+
+    # the same for every row, spliced in after the encoded columns
+    constants = {
+        "$type": "track_event",
+        "library": "lotus-python",
+        "library_version": VERSION,
+    }
+    if time_col is None:
+        constants["time_created"] = datetime.now(tzutc()).isoformat()
+    splice = "," + json.dumps(constants, separators=(",", ":"))[1:-1]
+    splice += ',"properties":'
+    for start in range(0, len(frame), chunk_size):
+        chunk = frame.iloc[start : start + chunk_size]
+        customer_ids = chunk[customer_col].astype(str)
+        columns = {
+            "customer_id": customer_ids,
+            "event_name": chunk[event_col].astype(str),
+        }
+        if times is not None:
+            columns["time_created"] = np.datetime_as_string(
+                times[start : start + chunk_size], unit="us", timezone="UTC"
+            )
+        if idempotency_col is None:
+            columns["idempotency_id"] = uuid4_array(len(chunk))
+        else:
+            columns["idempotency_id"] = chunk[idempotency_col].astype(str)
+
+        heads = _lines(pd.DataFrame(columns, index=chunk.index))
+        properties = _properties(chunk, property_cols)
+        # splice each row's properties into its body
+        events = [
+            (head[:-1] + splice + props + "}").encode()
+            for head, props in zip(heads, properties)
+        ]
+        yield customer_ids.tolist(), events
+
+
+def uuid4_array(count):
+    """Return an array of `count` random UUID4 strings, built with numpy."""
+    raw = np.frombuffer(os.urandom(16 * count), dtype=np.uint8).reshape(count, 16)
+    raw = raw.copy()
+    raw[:, 6] = (raw[:, 6] & 0x0F) | 0x40
+    raw[:, 8] = (raw[:, 8] & 0x3F) | 0x80
+    digits = np.empty((count, 32), dtype=np.uint8)
+    digits[:, 0::2] = _HEX[raw >> 4]
+    digits[:, 1::2] = _HEX[raw & 0x0F]
+    out = np.full((count, 36), ord("-"), dtype=np.uint8)
+    for start, end, offset in _UUID_GROUPS:
+        out[:, start + offset : end + offset] = digits[:, start:end]
+    return out.view("S36").ravel().astype(str)
+
+
+def _check_missing(column, name):
+    missing = int(column.isna().sum())
+    if missing:
+        raise ValueError("%d rows have no %s" % (missing, name))
+
+
+def _properties(chunk, property_cols):
+    """Return the JSON encoded properties of every row of `chunk`.
+
+    pandas writes floats with at most 15 significant digits, so float
+    columns are encoded with `repr` instead, like `json` and `orjson` do,
+    and NaN and infinities become null.
+    """
+    if not property_cols:
+        return ["{}"] * len(chunk)
+    floats = [c for c in property_cols if pd.api.types.is_float_dtype(chunk[c])]
+    if not floats:
+        return _lines(chunk[list(property_cols)])
+    columns = []
+    # runs of other columns are still encoded by pandas, a run at a time
+    run = []
+    for name in list(property_cols) + [None]:
+        if name is not None and name not in floats:
+            run.append(name)
+            continue
+        if run:
+            # '{"a":1,"b":2}' without the braces
+            columns.append([line[1:-1] for line in _lines(chunk[run])])
+            run = []
+        if name is not None:
+            key = json.dumps(str(name)) + ":"
+            columns.append(
+                [
+                    key + (repr(value) if math.isfinite(value) else "null")
+                    for value in chunk[name].tolist()
+                ]
+            )
+    return ["{" + ",".join(row) + "}" for row in zip(*columns)]
+
+
+def _lines(frame):
+    return frame.to_json(
+        orient="records", lines=True, date_format="iso", double_precision=15
+    ).splitlines()
@@ -0,0 +1,93 @@
+import sqlite3
+import threading
+import time
+
+from .request import APIError
+
+
+class DeadLetter(object):
+    """A batch kept by a `DeadLetterStore`."""
+
+    __slots__ = ("id", "data", "status", "error", "attempts", "created_at")
+
+    def __init__(self, id, data, status, error, attempts, created_at):
+        self.id = id
+        # the batch's items, as a JSON array
+        self.data = data
+        self.status = status
+        self.error = error
+        self.attempts = attempts
+        self.created_at = created_at
+
+
+class DeadLetterStore(object):
+    """Keeps the batches that could not be delivered in a SQLite database.
+
+    Each batch is stored with its items exactly as they were encoded, so
+    replaying it with `python -m lotus.replay` sends the same idempotency
+    ids, along with the last error, its HTTP status if any, and how many
+    attempts were made.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS batches ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "data BLOB NOT NULL, "
+            "status INTEGER, "
+            "error TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL, "
+            "created_at REAL NOT NULL)"
+        )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM batches").fetchone()[0]
+
+    def add(self, batch, error):
+        """Store the items of `batch`, which failed with `error`."""
+        data = b"[" + b",".join(batch.parts) + b"]"
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO batches (data, status, error, attempts, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (data, _status(error), str(error), batch.attempts, time.time()),
+            )
+
+    def list(self, limit=None):
+        """Return the stored batches, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, data, status, error, attempts, created_at "
+                "FROM batches ORDER BY id LIMIT ?",
+                (-1 if limit is None else limit,),
+            ).fetchall()
+        return [DeadLetter(*row) for row in rows]
+
+    def remove(self, id):
+        """Drop a batch, once it has been delivered."""
+        with self._lock:
+            self._conn.execute("DELETE FROM batches WHERE id = ?", (id,))
+
+    def failed(self, id, error):
+        """Record another failed attempt at delivering a batch."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE batches SET status = ?, error = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (_status(error), str(error), id),
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _status(error):
+    return error.status if isinstance(error, APIError) else None
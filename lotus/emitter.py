@@ -0,0 +1,187 @@
+import itertools
+import os
+import time
+import uuid
+import weakref
+from datetime import datetime, timezone
+from queue import Full
+
+from . import codec
+from .version import VERSION
+
+# property types a schema may declare, encoded as they are
+SCHEMA_TYPES = frozenset((str, int, float, bool, type(None)))
+
+_emitters = weakref.WeakSet()
+
+
+class Emitter(object):
+    """Tracks events of one name and property shape, see `Client.emitter`.
+
+    The static fields of the body are built once. When a `schema` is
+    given, it is checked once here, and each call only compares the exact
+    types of the properties against it. The `put` of each queue shard is
+    looked up once per set of queues, events are queued encoded, and they
+    are not counted in the client's metrics one at a time: `Client.stats`
+    adds `enqueued()`. Calls that the fast path does not cover, eg. in sync
+    mode, with an aggregator or an agent, non-string customer ids or values
+    that need cleaning, go through `track_event`.
+
+    A call costs about 4us on CPython, against 15us or more for
+    `track_event`; a third of it is `Queue.put`, which every queued event
+    goes through, so this does not reach the 2us of buffering events
+    outside the queues.
+    """
+
+    def __init__(self, client, event_name, schema=None, fallback=None):
+        if not isinstance(event_name, str):
+            raise AssertionError(
+                "event_name must have {0}, got: {1}".format(str, event_name)
+            )
+        self.client = client
+        self.event_name = event_name
+        self.fallback = fallback or client.track_event
+        self.schema = None
+        if schema is not None:
+            self.schema = {}
+            for name, types in schema.items():
+                types = types if isinstance(types, tuple) else (types,)
+                unsupported = [t for t in types if t not in SCHEMA_TYPES]
+                if not isinstance(name, str) or unsupported:
+                    raise ValueError(
+                        "Unsupported schema field %r: %r" % (name, unsupported)
+                    )
+                self.schema[name] = frozenset(types)
+            self._fields = self.schema.keys()
+        self._static = {
+            "$type": "track_event",
+            "event_name": event_name,
+            "library": "lotus-python",
+            "library_version": VERSION,
+        }
+        self.reseed()
+        _emitters.add(self)
+        # (second, its formatted date and time) of the last call
+        self._second = (None, None)
+        # the client's queues, and the `put` of each
+        self._queues = None
+        self._puts = ()
+
+    def __call__(
+        self, customer_id, properties=None, time_created=None, idempotency_id=None
+    ):
+        """Track an event for `customer_id`, return `(success, body)`."""
+        client = self.client
+        if properties is None:
+            properties = {}
+        if (
+            type(customer_id) is not str
+            or time_created is not None
+            or idempotency_id is not None
+            or type(properties) is not dict
+            or not client.send
+            or client.sync_mode
+            or client.aggregator is not None
+            or client.agent is not None
+            or not self.check(properties)
+        ):
+            return self.fallback(
+                customer_id=customer_id,
+                event_name=self.event_name,
+                properties=properties,
+                time_created=time_created,
+                idempotency_id=idempotency_id,
+            )
+
+        queues = client.queues
+        if queues is not self._queues:
+            # rebuilt after a fork
+            self._puts = tuple(queue.put_nowait for queue in queues)
+            self._queues = queues
+        puts = self._puts
+        n = next(self._counter)
+        body = dict(self._static)
+        body["customer_id"] = customer_id
+        body["properties"] = properties
+        body["time_created"] = self.now()
+        body["idempotency_id"] = "%s%012x" % (self._id_prefix, n)
+        # queued encoded: bytes share nothing with the caller's properties,
+        # and a long queue of them costs the garbage collector nothing
+        data = codec.dumps(body)
+        try:
+            # the same shard as `Client._shard`
+            if len(puts) == 1:
+                puts[0](data)
+            else:
+                puts[hash(customer_id) % len(puts)](data)
+        except Full:
+            self._dropped += 1
+            client.metrics.incr("dropped")
+            client.log.warning("queue is full")
+            return False, body
+        finally:
+            # stores from racing threads may be out of order, so that
+            # `enqueued` lags a few calls behind
+            self._issued = n + 1
+        return True, body
+
+    def enqueued(self):
+        """Return how many events the fast path has queued."""
+        return self._issued - self._dropped
+
+    def check(self, properties):
+        """Whether `properties` can be queued as they are.
+
+        Raise AssertionError if they do not match the schema.
+        """
+        schema = self.schema
+        if schema is None:
+            return SCHEMA_TYPES.issuperset(map(type, properties.values()))
+        if properties.keys() != self._fields:
+            raise AssertionError(
+                "properties must have the fields {0}, got: {1}".format(
+                    sorted(self._fields), sorted(properties)
+                )
+            )
+        for name, value in properties.items():
+            if type(value) not in schema[name]:
+                raise AssertionError(
+                    "properties.{0} must have {1}, got: {2}".format(
+                        name, tuple(schema[name]), value
+                    )
+                )
+        return True
+
+    def reseed(self):
+        """Draw a new random prefix for the idempotency ids.
+
+        Ids are the prefix, the first groups of a random UUID, followed by a
+        counter, which is cheaper than a random UUID per call.
+        """
+        self._id_prefix = str(uuid.uuid4())[:24]
+        self._counter = itertools.count()
+        # ids drawn and queue puts that failed, counted as `enqueued`
+        self._issued = 0
+        self._dropped = 0
+
+    def now(self):
+        """Return the current time, formatted as `str(datetime)` would."""
+        now = time.time()
+        second = int(now)
+        cached, formatted = self._second
+        if second != cached:
+            formatted = datetime.fromtimestamp(second, timezone.utc).strftime(
+                "%Y-%m-%d %H:%M:%S"
+            )
+            self._second = (second, formatted)
+        return "%s.%06d+00:00" % (formatted, (now - second) * 1e6)
+
+
+def _reseed_all():
+    # a forked child would otherwise repeat its parent's ids
+    for emitter in list(_emitters):
+        emitter.reseed()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reseed_all)
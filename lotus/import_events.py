@@ -0,0 +1,415 @@
+"""Import events from an NDJSON or CSV file.
+
+Usage: python -m lotus.import_events PATH [--format ndjson|csv]
+           [--api-key KEY] [--host URL] [--workers N] [--checkpoint PATH]
+           [--customer-col NAME] [--event-col NAME] [--time-col NAME]
+           [--id-col NAME] [--property-cols A,B,...] [--batch-events N]
+           [--retries N] [--gzip] [--dead-letter PATH]
+
+The file is read as a stream and packed into batches under the API's size
+limit, which are uploaded by parallel workers. The checkpoint file records
+which parts of the file have been uploaded; running the same command again
+resumes where the import stopped. Rows without an idempotency id get one
+derived from their content and position in the file, so that rows uploaded
+twice around a crash are only counted once. Rows that can't be parsed or
+encoded are logged and skipped.
+"""
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import backoff
+import monotonic
+
+from . import codec
+from .batch import BATCH_SIZE_LIMIT, Batch
+from .compression import GzipCompressor
+from .consumer import fatal_exception
+from .dead_letter import DeadLetterStore
+from .request import build_session, send
+from .utils import HTTPMethod
+from .version import VERSION
+
+log = logging.getLogger("lotus")
+
+# namespace of the idempotency ids derived from the rows of a file
+IMPORT_NAMESPACE = uuid.UUID("6f1d7c2e-8a51-4b8e-9c3d-2f0b7e4a9d15")
+
+
+class Checkpoint(object):
+    """The parts of a file that have been uploaded, saved to `path`.
+
+    Everything before `offset` is done, as are the `[start, end)` byte
+    ranges in `done`, uploaded out of order by parallel workers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.done = {}
+        self.events = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.offset = state["offset"]
+            self.done = {start: end for start, end in state["done"]}
+            self.events = state["events"]
+
+    def is_done(self, start):
+        if start < self.offset:
+            return True
+        return any(s <= start < e for s, e in self.done.items())
+
+    def complete(self, start, end, events):
+        """Record that the rows in `[start, end)` have been handled."""
+        with self._lock:
+            self.done[start] = end
+            self.events += events
+            while self.offset in self.done:
+                self.offset = self.done.pop(self.offset)
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        state = {
+            "offset": self.offset,
+            "done": sorted(self.done.items()),
+            "events": self.events,
+        }
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+
+def read_ndjson(f, offset):
+    """Yield `(start, end, line)` for each line of `f` from `offset` on.
+
+    Lines are parsed by `Importer.encode`, so that a malformed one only
+    skips that row.
+    """
+    f.seek(offset)
+    for line in f:
+        start, offset = offset, offset + len(line)
+        if line.strip():
+            yield start, offset, line
+
+
+def read_csv(f, offset):
+    """Yield `(start, end, record)` for each CSV row of `f` after `offset`.
+
+    The first row is the header. Values are kept as strings, empty ones
+    become None; `Importer.encode` converts the properties to numbers
+    where they look like ones, but not the ids.
+    """
+    position = [0]
+
+    def lines(start):
+        f.seek(start)
+        position[0] = start
+        for line in f:
+            position[0] += len(line)
+            yield line.decode("utf-8")
+
+    header = next(csv.reader(lines(0)))
+    offset = max(offset, position[0])
+    start = offset
+    for row in csv.reader(lines(offset)):
+        end = position[0]
+        if row:
+            yield start, end, CSVRow((k, v or None) for k, v in zip(header, row))
+        start = end
+
+
+class CSVRow(dict):
+    """A record read from a CSV file, whose values are all strings."""
+
+
+def _value(text):
+    if not isinstance(text, str):
+        return text
+    for cast in (int, float):
+        try:
+            return cast(text)
+        except ValueError:
+            pass
+    return text
+
+
+class Importer(object):
+    """Packs the records of a file into batches and uploads them."""
+
+    def __init__(
+        self,
+        api_key,
+        host=None,
+        workers=4,
+        checkpoint=None,
+        customer_col="customer_id",
+        event_col="event_name",
+        time_col="time_created",
+        id_col="idempotency_id",
+        property_cols=None,
+        batch_events=1000,
+        retries=5,
+        compressor=None,
+        dead_letter=None,
+        id_prefix="",
+    ):
+        self.api_key = api_key
+        self.endpoint = (host or "https://api.uselotus.io") + "/api/track/"
+        self.workers = workers
+        self.checkpoint = checkpoint or Checkpoint(None)
+        self.customer_col = customer_col
+        self.event_col = event_col
+        self.time_col = time_col
+        self.id_col = id_col
+        self.property_cols = property_cols
+        self.batch_events = batch_events
+        self.retries = retries
+        self.compressor = compressor
+        self.dead_letter = dead_letter
+        self.id_prefix = id_prefix
+        self.session = build_session(pool_maxsize=workers)
+        self.uploaded = 0
+        self.failed = 0
+        self.invalid = 0
+        self._lock = threading.Lock()
+        # bounds the batches held in memory, waiting for a worker
+        self._slots = threading.Semaphore(workers * 2)
+
+    def encode(self, start, record):
+        """Return the encoded `track_event` body of a record.
+
+        `record` is a dict, or the bytes of an NDJSON line.
+        """
+        row = None
+        if isinstance(record, bytes):
+            row, record = record, json.loads(record)
+            if not isinstance(record, dict):
+                raise ValueError("not a JSON object")
+        customer_id = record.get(self.customer_col)
+        event_name = record.get(self.event_col)
+        if customer_id is None or not event_name:
+            raise ValueError("missing %s or %s" % (self.customer_col, self.event_col))
+        idempotency_id = record.get(self.id_col)
+        if idempotency_id is None:
+            if row is None:
+                row = json.dumps(record, sort_keys=True, default=str).encode()
+            idempotency_id = uuid.uuid5(
+                IMPORT_NAMESPACE,
+                "%s%s:%d" % (self.id_prefix, hashlib.sha1(row).hexdigest(), start),
+            )
+        if self.property_cols is not None:
+            properties = {name: record.get(name) for name in self.property_cols}
+        elif isinstance(record.get("properties"), dict):
+            properties = record["properties"]
+        else:
+            reserved = (self.customer_col, self.event_col, self.time_col, self.id_col)
+            properties = {k: v for k, v in record.items() if k not in reserved}
+        if isinstance(record, CSVRow):
+            properties = {k: _value(v) for k, v in properties.items()}
+        time_created = record.get(self.time_col)
+        if time_created is None:
+            raise ValueError("missing %s" % self.time_col)
+        return codec.dumps(
+            {
+                "$type": "track_event",
+                "customer_id": str(customer_id),
+                "event_name": str(event_name),
+                "idempotency_id": str(idempotency_id),
+                "time_created": str(time_created),
+                "properties": properties,
+                "library": "lotus-python",
+                "library_version": VERSION,
+            }
+        )
+
+    def run(self, records, progress=None):
+        """Upload `records`, an iterable of `(start, end, record)`.
+
+        Errors of the uploads themselves, rather than of the requests, are
+        raised once every batch has been handled.
+        """
+        checkpoint = self.checkpoint
+        errors = []
+
+        def done(future):
+            self._slots.release()
+            error = future.exception()
+            if error is not None:
+                log.error("error handling a batch: %r", error)
+                errors.append(error)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+
+            def submit(batch, start, end):
+                self._slots.acquire()
+                executor.submit(self.upload, batch, start, end).add_done_callback(done)
+
+            batch, batch_start, end = self.new_batch(), None, None
+            for start, end, record in records:
+                if checkpoint.is_done(start):
+                    if batch_start is not None:
+                        submit(batch, batch_start, start)
+                        batch, batch_start = self.new_batch(), None
+                    continue
+                try:
+                    data = self.encode(start, record)
+                except Exception as e:
+                    log.warning("skipping the row at byte %d: %s", start, e)
+                    data = None
+                if data is not None and len(data) > batch.max_msg_size:
+                    log.warning("skipping the row at byte %d: too large", start)
+                    data = None
+                if (
+                    data is not None
+                    and batch_start is not None
+                    and (
+                        len(batch) >= self.batch_events
+                        or batch.size + len(data) > batch.max_size
+                    )
+                ):
+                    # the row starts the next batch
+                    submit(batch, batch_start, start)
+                    batch, batch_start = self.new_batch(), None
+                if batch_start is None:
+                    batch_start = start
+                if data is None:
+                    with self._lock:
+                        self.invalid += 1
+                else:
+                    batch.add(data)
+                if progress:
+                    progress(self)
+            if batch_start is not None:
+                submit(batch, batch_start, end)
+        if errors:
+            raise errors[0]
+
+    def new_batch(self):
+        if self.compressor:
+            return Batch(max_size=self.compressor.max_batch_size(BATCH_SIZE_LIMIT))
+        return Batch()
+
+    def upload(self, batch, start, end):
+        try:
+            if len(batch):
+                self.send(batch)
+        except Exception as e:
+            log.error("error uploading the rows at bytes %d-%d: %s", start, end, e)
+            with self._lock:
+                self.failed += len(batch)
+            if self.dead_letter is None:
+                # not checkpointed, the next run tries again
+                return
+            self.dead_letter.add(batch, e)
+        else:
+            with self._lock:
+                self.uploaded += len(batch)
+        self.checkpoint.complete(start, end, len(batch))
+
+    def send(self, batch):
+        for attempt in range(self.retries + 1):
+            batch.attempts += 1
+            try:
+                send(
+                    self.endpoint,
+                    self.api_key,
+                    method=HTTPMethod.POST,
+                    data=batch.chunks() if self.compressor else batch.encode(),
+                    session=self.session,
+                    compressor=self.compressor,
+                )
+                return
+            except Exception as e:
+                if attempt == self.retries or fatal_exception(e):
+                    raise
+                time.sleep(backoff.full_jitter(min(60, 2**attempt)))
+
+
+class Progress(object):
+    """Prints the import's progress and throughput every `interval` seconds."""
+
+    def __init__(self, size, interval=1.0, out=sys.stderr):
+        self.size = size
+        self.interval = interval
+        self.out = out
+        self.started = monotonic.monotonic()
+        self._last = self.started
+
+    def __call__(self, importer, force=False):
+        now = monotonic.monotonic()
+        if not force and now - self._last < self.interval:
+            return
+        self._last = now
+        rate = importer.uploaded / max(now - self.started, 1e-9)
+        done = 100.0 * importer.checkpoint.offset / self.size if self.size else 100
+        self.out.write(
+            "%d uploaded, %d failed, %d invalid, %.0f events/s, %.1f%% of the file\n"
+            % (importer.uploaded, importer.failed, importer.invalid, rate, done)
+        )
+        self.out.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=("ndjson", "csv"))
+    parser.add_argument("--api-key", default=os.environ.get("LOTUS_API_KEY"))
+    parser.add_argument("--host", default=os.environ.get("LOTUS_HOST"))
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--checkpoint", help="defaults to PATH.checkpoint")
+    parser.add_argument("--customer-col", default="customer_id")
+    parser.add_argument("--event-col", default="event_name")
+    parser.add_argument("--time-col", default="time_created")
+    parser.add_argument("--id-col", default="idempotency_id")
+    parser.add_argument("--property-cols", help="comma separated, default: the rest")
+    parser.add_argument("--batch-events", type=int, default=1000)
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("--dead-letter", help="keep rejected batches in this store")
+    args = parser.parse_args(argv)
+    logging.basicConfig()
+    if not args.api_key:
+        parser.error("--api-key or LOTUS_API_KEY is required")
+    fmt = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+
+    checkpoint = Checkpoint(args.checkpoint or args.path + ".checkpoint")
+    importer = Importer(
+        args.api_key,
+        host=args.host,
+        workers=args.workers,
+        checkpoint=checkpoint,
+        customer_col=args.customer_col,
+        event_col=args.event_col,
+        time_col=args.time_col,
+        id_col=args.id_col,
+        property_cols=args.property_cols.split(",") if args.property_cols else None,
+        batch_events=args.batch_events,
+        retries=args.retries,
+        compressor=GzipCompressor() if args.gzip else None,
+        dead_letter=DeadLetterStore(args.dead_letter) if args.dead_letter else None,
+    )
+    progress = Progress(os.path.getsize(args.path))
+    read = read_csv if fmt == "csv" else read_ndjson
+    with io.open(args.path, "rb") as f:
+        importer.run(read(f, checkpoint.offset), progress=progress)
+    progress(importer, force=True)
+    return 1 if importer.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
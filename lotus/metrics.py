@@ -0,0 +1,160 @@
+import bisect
+import logging
+from collections import deque
+from queue import Queue
+from threading import Event, Lock, Thread
+
+import monotonic
+
+log = logging.getLogger("lotus")
+
+# histogram bucket upper bounds, in seconds
+DURATION_BOUNDS = tuple(0.0001 * 2**n for n in range(20))
+# histogram bucket upper bounds, in bytes or events
+SIZE_BOUNDS = tuple(2**n for n in range(24))
+# histogram bucket upper bounds, for compression ratios
+RATIO_BOUNDS = tuple(1.25**n for n in range(24))
+
+
+class Histogram(object):
+    """Counts observations in fixed buckets to estimate percentiles."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Return the upper bound of the bucket holding the `q` percentile."""
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+        }
+
+
+class Metrics(object):
+    """A registry of counters and histograms shared by a client's threads."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value, bounds=DURATION_BOUNDS):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(bounds)
+            histogram.observe(value)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._counters)
+            for name, histogram in self._histograms.items():
+                stats[name] = histogram.snapshot()
+        return stats
+
+
+class QueueAges(object):
+    """Tracks when the items of a FIFO queue were put, oldest first."""
+
+    def __init__(self):
+        self._entries = deque()
+
+    def put(self, count=1, at=None):
+        self._entries.append([monotonic.monotonic() if at is None else at, count])
+
+    def get(self):
+        entry = self._entries[0]
+        entry[1] -= 1
+        if not entry[1]:
+            self._entries.popleft()
+
+    def oldest(self):
+        """Age in seconds of the oldest item, or None if there are none."""
+        if not self._entries:
+            return None
+        return monotonic.monotonic() - self._entries[0][0]
+
+
+class TimedQueue(Queue):
+    """A `Queue` that knows how long its oldest item has been waiting."""
+
+    def _init(self, maxsize):
+        Queue._init(self, maxsize)
+        self._ages = QueueAges()
+
+    def _put(self, item):
+        Queue._put(self, item)
+        self._ages.put()
+
+    def _put_many(self, items):
+        self.queue.extend(items)
+        self._ages.put(len(items))
+
+    def _get(self):
+        self._ages.get()
+        return Queue._get(self)
+
+    def oldest_age(self):
+        """Seconds the oldest queued item has been waiting, or None."""
+        with self.mutex:
+            return self._ages.oldest()
+
+
+class StatsReporter(Thread):
+    """Passes a client's stats to `callback` every `interval` seconds."""
+
+    def __init__(self, client, callback, interval=10):
+        Thread.__init__(self)
+        self.daemon = True
+        self.client = client
+        self.callback = callback
+        self.interval = interval
+        self._stopped = Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        try:
+            self.callback(self.client.stats())
+        except Exception as e:
+            log.error("error reporting stats: %s", e)
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,141 @@
+import threading
+import time
+
+import monotonic
+
+
+class TokenBucket(object):
+    """Refills at `rate` tokens per second, up to `capacity` tokens.
+
+    Takers may go into debt, they wait until it is paid back, so that
+    requests are let through in the order they asked, at the bucket's rate.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic.monotonic()
+
+    def reserve(self, amount, now):
+        """Take `amount` tokens, return the seconds until they are available."""
+        if now > self.updated:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+        self.tokens -= amount
+        return self.updated - now + max(0, -self.tokens) / self.rate
+
+    def empty(self, at):
+        """Start refilling from nothing at `at`."""
+        self.tokens = 0
+        self.updated = max(self.updated, at)
+
+
+class RateLimiter(object):
+    """Paces the requests of every thread of a client.
+
+    Token buckets let through `requests_per_second` requests, and
+    `bytes_per_second` bytes of request bodies, on average, in bursts of up
+    to `burst` seconds' worth; either may be None for no limit.
+
+    A 429 with a `Retry-After` header pauses every request until it has
+    passed, for at most `max_pause` seconds, like the consumers' longest
+    backoff. A single request goes first then, and the others wait for its
+    answer, so that threads don't all hit the API again at once; the
+    buckets start again from empty.
+    """
+
+    def __init__(
+        self,
+        requests_per_second=None,
+        bytes_per_second=None,
+        burst=1.0,
+        max_pause=60,
+        metrics=None,
+    ):
+        for name, rate in (
+            ("requests_per_second", requests_per_second),
+            ("bytes_per_second", bytes_per_second),
+        ):
+            if rate is not None and rate <= 0:
+                raise ValueError("%s must be positive, got %r" % (name, rate))
+        self.requests_per_second = requests_per_second
+        self.bytes_per_second = bytes_per_second
+        self.max_pause = max_pause
+        self.metrics = metrics
+        self._requests = None
+        if requests_per_second:
+            self._requests = TokenBucket(
+                requests_per_second, max(1, requests_per_second * burst)
+            )
+        self._bytes = None
+        if bytes_per_second:
+            self._bytes = TokenBucket(bytes_per_second, bytes_per_second * burst)
+        self._resume_at = 0
+        self._paused = False
+        # the thread whose request checks whether the API accepts requests
+        # again, after a pause
+        self._probe = None
+        self._condition = threading.Condition()
+
+    def acquire(self, size=0, block=True):
+        """Wait until a request with a body of `size` bytes may be sent.
+
+        Without `block`, nothing waits: the seconds the caller should wait
+        are returned instead, and requests after a pause do not wait for the
+        first one's answer.
+        """
+        started = monotonic.monotonic()
+        with self._condition:
+            while block:
+                if self._probe is not None:
+                    self._condition.wait()
+                    continue
+                wait = self._resume_at - monotonic.monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                if self._paused:
+                    self._paused = False
+                    self._probe = threading.get_ident()
+                break
+            now = monotonic.monotonic()
+            wait = max(0, self._resume_at - now)
+            if self._requests is not None:
+                wait = max(wait, self._requests.reserve(1, now))
+            if self._bytes is not None:
+                wait = max(wait, self._bytes.reserve(size, now))
+        if not block:
+            return wait
+        if wait > 0:
+            time.sleep(wait)
+        waited = monotonic.monotonic() - started
+        if waited > 0.001 and self.metrics is not None:
+            self.metrics.observe("rate_limit_seconds", waited)
+        return waited
+
+    def release(self, error=None):
+        """Record the answer to a request made after `acquire`."""
+        retry_after = getattr(error, "retry_after", None)
+        with self._condition:
+            if retry_after is not None:
+                self.pause(min(retry_after, self.max_pause))
+            if self._probe == threading.get_ident():
+                self._probe = None
+                self._condition.notify_all()
+
+    def pause(self, seconds):
+        """Hold every request for `seconds`."""
+        with self._condition:
+            resume_at = monotonic.monotonic() + seconds
+            if resume_at > self._resume_at:
+                self._resume_at = resume_at
+                for bucket in (self._requests, self._bytes):
+                    if bucket is not None:
+                        bucket.empty(resume_at)
+            self._paused = True
+            self._condition.notify_all()
+        if self.metrics is not None:
+            self.metrics.incr("rate_limit_pauses")
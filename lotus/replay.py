@@ -0,0 +1,137 @@
+"""Re-send the batches kept in a dead letter store.
+
+Usage: python -m lotus.replay PATH [--api-key KEY] [--host URL] [--rate N]
+           [--workers N] [--max-attempts N] [--limit N] [--list]
+
+Batches are sent with their original idempotency ids, so events the API
+already accepted are not counted twice. Their items are packed again into
+requests under the API's size limit, and requests the API rejects are split
+like the client's consumers do. Delivered batches are removed from the
+store, failed ones stay with their attempt count increased.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from . import codec
+from .batch import BATCH_SIZE_LIMIT, Batch
+from .consumer import rejected_exception
+from .dead_letter import DeadLetterStore
+from .ratelimit import RateLimiter
+from .request import send
+from .utils import HTTPMethod
+
+log = logging.getLogger("lotus")
+
+
+def replay(
+    store, api_key, host=None, rate=10, workers=4, max_attempts=None, limit=None
+):
+    """Re-send the stored batches, return the `(delivered, failed)` counts."""
+    endpoint = (host or "https://api.uselotus.io") + "/api/track/"
+    # evenly spaced requests, paused when the API asks with Retry-After
+    limiter = RateLimiter(requests_per_second=rate or None, burst=0)
+    letters = store.list(limit=limit)
+    if max_attempts is not None:
+        letters = [letter for letter in letters if letter.attempts < max_attempts]
+
+    def post(batch):
+        """Send `batch`, split while it is rejected, return the first error."""
+        try:
+            send(
+                endpoint,
+                api_key,
+                method=HTTPMethod.POST,
+                data=batch.encode(),
+                limiter=limiter,
+            )
+        except Exception as e:
+            if not (rejected_exception(e) and len(batch) > 1):
+                return e
+            errors = [post(half) for half in batch.split()]
+            return next((error for error in errors if error is not None), None)
+        return None
+
+    def deliver(letter):
+        errors = [post(batch) for batch in pack(letter.data)]
+        error = next((error for error in errors if error is not None), None)
+        if error is not None:
+            log.error("error replaying batch %d: %s", letter.id, error)
+            store.failed(letter.id, error)
+            return False
+        store.remove(letter.id)
+        return True
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(deliver, letters))
+    delivered = sum(results)
+    return delivered, len(results) - delivered
+
+
+def pack(data, max_size=BATCH_SIZE_LIMIT):
+    """Return batches of the items of a stored batch, each under `max_size`.
+
+    Compressed batches may hold many times the API's limit before they are
+    compressed, and are sent uncompressed here.
+    """
+    batches = [Batch(max_size=max_size)]
+    for item in json.loads(data):
+        part = codec.dumps(item)
+        if len(batches[-1]) and batches[-1].size + len(part) > max_size:
+            batches.append(Batch(max_size=max_size))
+        batches[-1].add(part)
+    return batches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="the dead letter store's SQLite database")
+    parser.add_argument("--api-key", default=os.environ.get("LOTUS_API_KEY"))
+    parser.add_argument("--host", default=os.environ.get("LOTUS_HOST"))
+    parser.add_argument("--rate", type=float, default=10, help="requests per second")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-attempts", type=int)
+    parser.add_argument("--limit", type=int)
+    parser.add_argument(
+        "--list", action="store_true", help="show the stored batches and exit"
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig()
+
+    store = DeadLetterStore(args.path)
+    if args.list:
+        for letter in store.list(limit=args.limit):
+            print(
+                "%d  %s  attempts=%d  status=%s  %s"
+                % (
+                    letter.id,
+                    datetime.fromtimestamp(letter.created_at).isoformat(),
+                    letter.attempts,
+                    letter.status,
+                    letter.error,
+                )
+            )
+        return 0
+    if not args.api_key:
+        parser.error("--api-key or LOTUS_API_KEY is required")
+
+    delivered, failed = replay(
+        store,
+        args.api_key,
+        host=args.host,
+        rate=args.rate,
+        workers=args.workers,
+        max_attempts=args.max_attempts,
+        limit=args.limit,
+    )
+    print("delivered %d batches, %d failed" % (delivered, failed))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,41 @@
-import json
 import logging
-from datetime import date, datetime
-from gzip import GzipFile
-from io import BytesIO
+import os
+from datetime import datetime
+from email.utils import parsedate_to_datetime
 
 from dateutil.tz import tzutc
 from requests import sessions
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
 
+from . import codec
+from .compression import GZIP
+from .codec import DatetimeSerializer  # noqa: F401
 from .utils import HTTPMethod
 from .version import VERSION
 
-_session = sessions.Session()
+
+def build_session(pool_maxsize=DEFAULT_POOLSIZE, keep_alive=True):
+    """Create a session keeping up to `pool_maxsize` connections per host."""
+    session = sessions.Session()
+    adapter = HTTPAdapter(pool_connections=DEFAULT_POOLSIZE, pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+    return session
+
+
+_session = build_session()
+
+
+def _reset_session():
+    # a forked child must not share the parent's pooled connections
+    global _session
+    _session = build_session()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_session)
 
 
 def send(
@@ -21,44 +46,90 @@ def send(
     timeout=15,
     body={},
     query={},
+    data=None,
+    session=None,
+    metrics=None,
+    compressor=None,
+    limiter=None,
 ):
-    """Post the `kwargs` to the API"""
-    log = logging.getLogger("lotus")
-    body["sentAt"] = datetime.utcnow().replace(tzinfo=tzutc()).isoformat()
-    url = host
-    if not url.startswith("http"):
-        url = "https://" + url
-    data = json.dumps(body, cls=DatetimeSerializer)
-    log.debug("making request: %s", data)
-    headers = {
-        "Content-Type": "application/json",
-        "User-Agent": "lotus-python/" + VERSION,
-        "X-API-KEY": api_key,
-    }
-    if gzip:
-        headers["Content-Encoding"] = "gzip"
-        buf = BytesIO()
-        with GzipFile(fileobj=buf, mode="w") as gz:
-            # 'data' was produced by json.dumps(),
-            # whose default encoding is utf-8.
-            gz.write(data.encode("utf-8"))
-        data = buf.getvalue()
+    """Post the `kwargs` to the API
+
+    `data` may be passed instead of `body` when the request body has already
+    been encoded to JSON bytes, or a list of chunks of them, e.g. by
+    `Batch.chunks`. Requests go through `session`, or the module's shared
+    session if it is None. Bodies are compressed with `compressor`, or always
+    gzipped if it is None and `gzip` is set, and the compression is recorded
+    to `metrics`, if given. A `RateLimiter` paces the request, if given.
+    """
+    url, headers, data = prepare_request(
+        host, api_key, gzip, body, data, metrics, compressor
+    )
+    if session is None:
+        session = _session
+    if limiter is None:
+        return _send(session, method, url, headers, data, query, timeout)
 
+    limiter.acquire(len(data) if method != HTTPMethod.GET else 0)
+    error = None
+    try:
+        return _send(session, method, url, headers, data, query, timeout)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        limiter.release(error)
+
+
+def _send(session, method, url, headers, data, query, timeout):
     if method == HTTPMethod.GET:
-        res = _session.get(url, headers=headers, params=query, timeout=timeout)
+        res = session.get(url, headers=headers, params=query, timeout=timeout)
     elif method == HTTPMethod.POST:
-        res = _session.post(
+        res = session.post(
             url, headers=headers, data=data, params=query, timeout=timeout
         )
     elif method == HTTPMethod.PATCH:
-        res = _session.patch(
+        res = session.patch(
             url, data=data, headers=headers, params=query, timeout=timeout
         )
     elif method == HTTPMethod.DELETE:
-        res = _session.delete(url, headers=headers, params=query, timeout=timeout)
+        res = session.delete(url, headers=headers, params=query, timeout=timeout)
     else:
         raise ValueError("Unsupported HTTP method: " + method)
 
+    return check_response(res)
+
+
+def prepare_request(
+    host, api_key, gzip=False, body={}, data=None, metrics=None, compressor=None
+):
+    """Return the url, headers and encoded body of a request."""
+    log = logging.getLogger("lotus")
+    url = host
+    if not url.startswith("http"):
+        url = "https://" + url
+    if data is None:
+        body["sentAt"] = datetime.utcnow().replace(tzinfo=tzutc()).isoformat()
+        data = codec.dumps(body)
+    log.debug("making request: %s", data)
+    headers = {
+        "Content-Type": "application/json",
+        "User-Agent": "lotus-python/" + VERSION,
+        "X-API-KEY": api_key,
+    }
+    if compressor is None and gzip:
+        compressor = GZIP
+    if compressor is not None:
+        encoding, data = compressor.compress(data, metrics)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+    elif not isinstance(data, bytes):
+        data = b"".join(data)
+    return url, headers, data
+
+
+def check_response(res):
+    """Return `res` if it was successful, raise an `APIError` otherwise."""
+    log = logging.getLogger("lotus")
     if res.status_code == 200 or res.status_code == 201 or res.status_code == 204:
         log.debug("data uploaded successfully")
         return res
@@ -69,25 +140,39 @@ def send(
         else:
             payload = "Success"
         log.debug("received response: %s", payload)
-        raise APIError(res.status_code, payload)
+        raise APIError(res.status_code, payload, retry_after(res))
     except ValueError:
         print(res.__dict__)
-        raise APIError(res.status_code, res.text)
+        raise APIError(res.status_code, res.text, retry_after(res))
+
+
+def retry_after(res):
+    """Return the seconds a 429 or 503 response asks to wait, or None."""
+    if res.status_code not in (429, 503):
+        return None
+    value = res.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=tzutc())
+    return max(0.0, (when - datetime.now(tzutc())).total_seconds())
 
 
 class APIError(Exception):
-    def __init__(self, status, payload):
+    def __init__(self, status, payload, retry_after=None):
         self.status = status
         self.payload = payload
+        # seconds the API asked to wait before the next request, if any
+        self.retry_after = retry_after
 
     def __str__(self):
         msg = "[Lotus] {0}: {1}"
         return msg.format(self.status, self.payload)
-
-
-class DatetimeSerializer(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, (date, datetime)):
-            return obj.isoformat()
-
-        return json.JSONEncoder.default(self, obj)
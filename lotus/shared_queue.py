@@ -0,0 +1,271 @@
+"""Run the uploader of a shared queue.
+
+Usage: python -m lotus.shared_queue NAME [--size BYTES] [--api-key KEY]
+           [--host URL] [--flush-at N] [--flush-interval SECONDS]
+
+Creates the shared queue `NAME`, then uploads what the worker processes
+put on it, with `Client(shared_queue=NAME)`, until interrupted.
+"""
+
+import argparse
+import fcntl
+import logging
+import os
+import signal
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+from queue import Empty, Full
+
+import monotonic
+
+from . import codec
+from .utils import runtime_dir
+
+log = logging.getLogger("lotus")
+
+DEFAULT_SIZE = 64 << 20
+
+# head, tail, count and capacity, followed by the ring of records
+_HEADER = struct.Struct("<QQQQ")
+_HEADER_SIZE = 64
+_LENGTH = struct.Struct("<I")
+# marks the unused end of the ring, the next record starts at its beginning
+_WRAP = 0xFFFFFFFF
+
+
+class SharedQueue(object):
+    """A queue of encoded events shared by processes, in shared memory.
+
+    Worker processes put events, which are encoded as they are put and
+    appended to a ring buffer in a `multiprocessing.shared_memory` block;
+    one uploader process gets them back and uploads full batches, instead
+    of every worker uploading its own. Processes open the queue by `name`,
+    or inherit it through a fork. Access is serialized by a lock on the
+    file at `lock_path`, by default in the user's `runtime_dir`, plus a
+    thread lock within each process.
+
+    It has the parts of the `Queue` interface the client uses. `put`
+    raises `Full` when the ring has no room for the item; `qsize` counts
+    items in the ring, and `join` waits until the uploader has taken them.
+    """
+
+    def __init__(self, name, size=DEFAULT_SIZE, create=False, lock_path=None):
+        self.name = name
+        self.lock_path = lock_path or os.path.join(
+            runtime_dir(), "lotus-%s.lock" % name
+        )
+        self._open_lock()
+        try:
+            if create:
+                self._shm = shared_memory.SharedMemory(
+                    name, create=True, size=_HEADER_SIZE + size
+                )
+                _HEADER.pack_into(self._shm.buf, 0, 0, 0, 0, size)
+            else:
+                self._shm = _attach(name)
+        except BaseException:
+            os.close(self._lock_fd)
+            raise
+        self.capacity = _HEADER.unpack_from(self._shm.buf, 0)[3]
+        self._buffer = deque()
+
+    def _open_lock(self):
+        # POSIX locks belong to a process, so each process opens the file
+        # and threads of a process take `_thread_lock` first
+        self._lock_fd = os.open(
+            self.lock_path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600
+        )
+        self._thread_lock = threading.Lock()
+
+    def after_fork(self):
+        """Take new locks, in a forked child."""
+        os.close(self._lock_fd)
+        self._buffer = deque()
+        self._open_lock()
+
+    def _acquire(self):
+        self._thread_lock.acquire()
+        fcntl.lockf(self._lock_fd, fcntl.LOCK_EX)
+
+    def _release(self):
+        fcntl.lockf(self._lock_fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def put(self, item, block=False, timeout=None):
+        if not self.put_many([item], block=block, timeout=timeout):
+            raise Full
+
+    def put_many(self, items, block=False, timeout=None):
+        """Put `items` under one lock, return how many fit.
+
+        With `block`, wait for room until they are all queued, or until
+        `timeout` seconds have passed.
+        """
+        dumps = codec.dumps
+        records = [item if isinstance(item, bytes) else dumps(item) for item in items]
+        deadline = None if timeout is None else monotonic.monotonic() + timeout
+        queued = 0
+        while True:
+            self._acquire()
+            try:
+                queued += self._write(records[queued:] if queued else records)
+            finally:
+                self._release()
+            if not block or queued == len(records):
+                return queued
+            if deadline is not None and monotonic.monotonic() >= deadline:
+                return queued
+            time.sleep(0.001)
+
+    def _write(self, records):
+        buf = self._shm.buf
+        capacity = self.capacity
+        head, tail, count, _ = _HEADER.unpack_from(buf, 0)
+        written = 0
+        for data in records:
+            offset = head % capacity
+            needed = _LENGTH.size + len(data)
+            skip = 0 if capacity - offset >= needed else capacity - offset
+            if head + skip + needed - tail > capacity:
+                break
+            if skip:
+                if skip >= _LENGTH.size:
+                    _LENGTH.pack_into(buf, _HEADER_SIZE + offset, _WRAP)
+                head += skip
+                offset = 0
+            start = _HEADER_SIZE + offset
+            _LENGTH.pack_into(buf, start, len(data))
+            buf[start + _LENGTH.size : start + needed] = data
+            head += needed
+            written += 1
+        if written:
+            _HEADER.pack_into(buf, 0, head, tail, count + written, capacity)
+        return written
+
+    def _read(self, limit=1000):
+        buf = self._shm.buf
+        capacity = self.capacity
+        head, tail, count, _ = _HEADER.unpack_from(buf, 0)
+        read = 0
+        while tail < head and read < limit:
+            offset = tail % capacity
+            if capacity - offset < _LENGTH.size:
+                tail += capacity - offset
+                continue
+            start = _HEADER_SIZE + offset
+            (length,) = _LENGTH.unpack_from(buf, start)
+            if length == _WRAP:
+                tail += capacity - offset
+                continue
+            start += _LENGTH.size
+            self._buffer.append(bytes(buf[start : start + length]))
+            tail += _LENGTH.size + length
+            read += 1
+        if read or tail != _HEADER.unpack_from(buf, 0)[1]:
+            _HEADER.pack_into(buf, 0, head, tail, count - read, capacity)
+
+    def get(self, block=True, timeout=None):
+        """Return the next encoded event, reading ahead a group of them."""
+        deadline = None if timeout is None else monotonic.monotonic() + timeout
+        while not self._buffer:
+            self._acquire()
+            try:
+                self._read()
+            finally:
+                self._release()
+            if self._buffer:
+                break
+            if not block or (
+                deadline is not None and monotonic.monotonic() >= deadline
+            ):
+                raise Empty
+            time.sleep(0.005)
+        return self._buffer.popleft()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self):
+        pass
+
+    def qsize(self):
+        return _HEADER.unpack_from(self._shm.buf, 0)[2] + len(self._buffer)
+
+    def empty(self):
+        return not self.qsize()
+
+    def join(self):
+        """Wait until the uploader has taken every queued item."""
+        while _HEADER.unpack_from(self._shm.buf, 0)[2] or self._buffer:
+            time.sleep(0.005)
+
+    def oldest_age(self):
+        # not tracked across processes
+        return None
+
+    def close(self):
+        self._shm.close()
+        os.close(self._lock_fd)
+
+    def unlink(self):
+        """Remove the shared memory block, once every process is done."""
+        self._shm.unlink()
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # before Python 3.13, the resource tracker would unlink the block
+        # when this process exits, under the processes still using it
+        from multiprocessing import resource_tracker
+
+        shm = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def main(argv=None):
+    from .client import Client
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("name")
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE)
+    parser.add_argument("--api-key", default=os.environ.get("LOTUS_API_KEY"))
+    parser.add_argument("--host", default=os.environ.get("LOTUS_HOST"))
+    parser.add_argument("--flush-at", type=int, default=1000)
+    parser.add_argument("--flush-interval", type=float, default=0.5)
+    args = parser.parse_args(argv)
+    logging.basicConfig()
+    if not args.api_key:
+        parser.error("--api-key or LOTUS_API_KEY is required")
+
+    queue = SharedQueue(args.name, size=args.size, create=True)
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    client = Client(
+        args.api_key,
+        host=args.host,
+        shared_queue=queue,
+        shared_queue_upload=True,
+        flush_at=args.flush_at,
+        flush_interval=args.flush_interval,
+    )
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.flush()
+        client.join()
+        queue.close()
+        queue.unlink()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,247 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import weakref
+from collections import deque
+from queue import Queue
+
+import monotonic
+
+from . import codec
+from .metrics import QueueAges
+
+log = logging.getLogger("lotus")
+
+# the spool files of a client's shards, and of forked children, named after
+# their shard and pid
+_SPOOL = re.compile(r"^queue-(\d+)\.db$")
+_CHILD_SPOOL = re.compile(r"^queue-(\d+)-(\d+)\.db$")
+
+
+class SpoolEntry(object):
+    """An item read back from a `SpoolQueue`, with its row id."""
+
+    __slots__ = ("rowid", "data")
+
+    def __init__(self, rowid, data):
+        self.rowid = rowid
+        self.data = data
+
+
+class SpoolQueue(Queue):
+    """A queue whose items are persisted to an append-only SQLite log.
+
+    Items are encoded once when they are put and appended to the log in
+    groups of `commit_every` items, or `commit_interval` seconds after the
+    first item of a group was put, by a background thread if no other put
+    comes first, so the cost of a commit is shared by many items. The log uses SQLite's WAL
+    journal; pass `fsync=True` to also fsync every commit, which survives
+    power loss instead of only process crashes.
+
+    `get` returns `SpoolEntry` objects. Items stay in the log until they are
+    acknowledged with `ack`, so anything left behind by a crashed process is
+    read again when a queue is next opened on the same file.
+    """
+
+    def __init__(
+        self,
+        path,
+        maxsize=0,
+        commit_every=1000,
+        commit_interval=0.05,
+        read_ahead=500,
+        fsync=False,
+    ):
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.read_ahead = read_ahead
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=%s" % ("FULL" if fsync else "NORMAL"))
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS events "
+            "(id INTEGER PRIMARY KEY AUTOINCREMENT, data BLOB NOT NULL)"
+        )
+        Queue.__init__(self, maxsize)
+        # set while items wait for a commit
+        self._dirty = threading.Event()
+        committer = threading.Thread(
+            target=_commit_later,
+            args=(weakref.ref(self), self._dirty, commit_interval),
+        )
+        committer.daemon = True
+        committer.start()
+        # items left behind by a previous process still need to be uploaded
+        self.unfinished_tasks = self._size
+        if self._size:
+            log.info("replaying %d spooled items from %s", self._size, path)
+
+    def _init(self, maxsize):
+        self._pending = []
+        self._buffer = deque()
+        self._cursor = 0
+        self._last_commit = monotonic.monotonic()
+        (self._size,) = self._conn.execute("SELECT COUNT(*) FROM events").fetchone()
+        # replayed items are counted as queued since the queue was opened
+        self._ages = QueueAges()
+        if self._size:
+            self._ages.put(self._size)
+
+    def _qsize(self):
+        return self._size
+
+    def _put(self, item):
+        if not isinstance(item, bytes):
+            item = codec.dumps(item)
+        self._pending.append(item)
+        self._size += 1
+        self._ages.put()
+        if (
+            len(self._pending) >= self.commit_every
+            or monotonic.monotonic() - self._last_commit >= self.commit_interval
+        ):
+            self._commit()
+        elif len(self._pending) == 1:
+            self._dirty.set()
+
+    def _put_many(self, items):
+        dumps = codec.dumps
+        self._pending.extend(
+            item if isinstance(item, bytes) else dumps(item) for item in items
+        )
+        self._size += len(items)
+        self._ages.put(len(items))
+        if (
+            len(self._pending) >= self.commit_every
+            or monotonic.monotonic() - self._last_commit >= self.commit_interval
+        ):
+            self._commit()
+        elif self._pending:
+            self._dirty.set()
+
+    def _get(self):
+        if not self._buffer:
+            self._commit()
+            self._read()
+        self._size -= 1
+        self._ages.get()
+        return self._buffer.popleft()
+
+    def _commit(self):
+        pending = self._pending
+        self._last_commit = monotonic.monotonic()
+        if not pending:
+            return
+        self._pending = []
+        with self._db_lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT INTO events (data) VALUES (?)", ((data,) for data in pending)
+            )
+            self._conn.execute("COMMIT")
+
+    def _read(self):
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT id, data FROM events WHERE id > ? ORDER BY id LIMIT ?",
+                (self._cursor, self.read_ahead),
+            ).fetchall()
+        for rowid, data in rows:
+            self._buffer.append(SpoolEntry(rowid, data))
+        if rows:
+            self._cursor = rows[-1][0]
+
+    def ack(self, rowids):
+        """Remove the acknowledged items from the log."""
+        with self._db_lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "DELETE FROM events WHERE id = ?", ((rowid,) for rowid in rowids)
+            )
+            self._conn.execute("COMMIT")
+
+    def oldest_age(self):
+        """Seconds the oldest queued item has been waiting, or None."""
+        with self.mutex:
+            return self._ages.oldest()
+
+    def sync(self):
+        """Write any items that are not yet committed to the log."""
+        with self.mutex:
+            self._commit()
+
+
+def _commit_later(queue_ref, dirty, interval):
+    # commits the items of a queue that no further put commits
+    while True:
+        if not dirty.wait(1.0):
+            if queue_ref() is None:
+                return
+            continue
+        time.sleep(interval)
+        dirty.clear()
+        queue = queue_ref()
+        if queue is None:
+            return
+        queue.sync()
+        del queue
+
+
+def orphaned_spools(spool_dir, shards):
+    """Return `(shard, path)` of the spool files nobody reads any more.
+
+    Those are the files of forked children that exited, and of shards
+    beyond the `shards` a client now runs, left by a client that ran more.
+    """
+    orphans = []
+    for name in sorted(os.listdir(spool_dir)):
+        match = _CHILD_SPOOL.match(name)
+        if match and not _pid_alive(int(match.group(2))):
+            orphans.append((int(match.group(1)), os.path.join(spool_dir, name)))
+        match = _SPOOL.match(name)
+        if match and int(match.group(1)) >= shards:
+            orphans.append((int(match.group(1)), os.path.join(spool_dir, name)))
+    return orphans
+
+
+def read_spool(path, chunk=1000):
+    """Yield the items stored in the spool at `path`, in lists of `chunk`."""
+    conn = sqlite3.connect(path)
+    try:
+        cursor = conn.execute("SELECT data FROM events ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(chunk)
+            if not rows:
+                break
+            yield [data for (data,) in rows]
+    finally:
+        conn.close()
+
+
+def remove_spool(path):
+    """Delete a spool file, with its WAL."""
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # another user's process
+        return True
+    return True
@@ -0,0 +1,215 @@
+"""A local stand-in for the Lotus API, for tests and benchmarks.
+
+Usage: python -m lotus.stub_server [--port N] [--latency SECONDS]
+           [--error-rate P] [--throttle-rate P] [--retry-after SECONDS]
+"""
+
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+def _customer(method, path, query, body):
+    if method == "GET" and path == "/api/customers/":
+        return [{"customer_id": "customer-1"}]
+    return {"customer_id": (body or {}).get("customer_id") or path.split("/")[3]}
+
+
+def _collection(prefix, payload):
+    """Answer with `payload`, in a list when `prefix` itself is listed."""
+
+    def respond(method, path, query, body):
+        return [payload] if method == "GET" and path == prefix else payload
+
+    return respond
+
+
+# canned answers for every endpoint of `Client.operations`
+DEFAULT_RESPONSES = {
+    "/api/ping/": {"organization_id": "org-1"},
+    "/api/track/": {"success": "all", "failed_events": {}},
+    "/api/customers/": _customer,
+    "/api/batch_create_customers/": {"success": "all", "failed_customers": {}},
+    "/api/credits/": _collection(
+        "/api/credits/", {"credit_id": "credit-1", "amount": 10}
+    ),
+    "/api/subscriptions/": _collection(
+        "/api/subscriptions/", {"subscription_id": "subscription-1"}
+    ),
+    "/api/plans/": _collection(
+        "/api/plans/", {"plan_id": "plan-1", "plan_name": "Plan"}
+    ),
+    "/api/customer_metric_access/": [{"metric_id": "metric-1", "access": True}],
+    "/api/customer_feature_access/": [{"feature_id": "feature-1", "access": True}],
+    "/api/metric_access/": {"customer": {"customer_id": "customer-1"}, "access": True},
+    "/api/feature_access/": {"customer": {"customer_id": "customer-1"}, "access": True},
+}
+
+
+class StubServer(object):
+    """A local stand-in for the Lotus API that answers with canned JSON.
+
+    `responses` maps a url path prefix to the payload returned for it, a
+    `(status, payload)` tuple, or a function of `(method, path, query, body)`
+    returning the payload; the longest matching prefix wins, and
+    `DEFAULT_RESPONSES` answers for paths not in `responses`.
+
+    Each request waits `latency` seconds, then fails with a 500 with
+    probability `error_rate`, or with a 429 and a `Retry-After` header with
+    probability `throttle_rate`. Requests are recorded in `requests` as
+    `(method, path, query, headers, body)` tuples unless `record` is False.
+    """
+
+    def __init__(
+        self,
+        responses=None,
+        latency=0,
+        error_rate=0,
+        throttle_rate=0,
+        retry_after=1,
+        record=True,
+        port=0,
+        seed=None,
+    ):
+        self.responses = responses or {}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.record = record
+        self.requests = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, method, path, query, headers, body):
+        """Record a request, return its `(status, payload, headers)`."""
+        with self._lock:
+            if self.record:
+                self.requests.append((method, path, query, headers, body))
+            roll = self._random.random()
+        if self.latency:
+            time.sleep(self.latency)
+        if roll < self.error_rate:
+            return 500, {"detail": "stub server error"}, {}
+        if roll < self.error_rate + self.throttle_rate:
+            return (
+                429,
+                {"detail": "rate limited"},
+                {"Retry-After": str(self.retry_after)},
+            )
+
+        responses = dict(DEFAULT_RESPONSES)
+        responses.update(self.responses)
+        matches = [prefix for prefix in responses if path.startswith(prefix)]
+        if not matches:
+            return 200, {}, {}
+        payload = responses[max(matches, key=len)]
+        if callable(payload):
+            payload = payload(method, path, query, body)
+        if isinstance(payload, tuple):
+            return payload + ({},)
+        return 200, payload, {}
+
+
+def _handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body are written separately, don't wait on delayed ACKs
+        disable_nagle_algorithm = True
+
+        def _handle(self):
+            url = urlparse(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            encoding = self.headers.get("Content-Encoding")
+            if encoding == "gzip":
+                raw = gzip.decompress(raw)
+            elif encoding == "zstd":
+                raw = zstandard.ZstdDecompressor().decompressobj().decompress(raw)
+            body = json.loads(raw) if raw else None
+            status, payload, headers = stub.respond(
+                self.command,
+                url.path,
+                parse_qs(url.query),
+                dict(self.headers),
+                body,
+            )
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    parser.add_argument("--retry-after", type=float, default=1)
+    args = parser.parse_args()
+
+    server = StubServer(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        record=False,
+        port=args.port,
+    )
+    # the first line tells callers, eg. benchmarks, where to connect
+    print(server.url, flush=True)
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import pytest
+
+from lotus import Client
+from lotus.adaptive import AdaptiveBatching
+from lotus.batch import Batch
+from lotus.metrics import Metrics
+from lotus.request import APIError
+from lotus.stub_server import StubServer
+
+
+def _batch(count):
+    batch = Batch()
+    for n in range(count):
+        batch.add({"customer_id": "c%d" % n, "event_name": "e"})
+    return batch
+
+
+class TestAdaptiveBatching:
+    def test_batch_size_follows_the_queue(self):
+        adaptive = AdaptiveBatching(flush_at=100, max_flush_at=300)
+        adaptive.batched(_batch(100), queue_depth=5000)
+        assert adaptive.flush_at == 200
+        adaptive.batched(_batch(200), queue_depth=5000)
+        adaptive.batched(_batch(300), queue_depth=5000)
+        assert adaptive.flush_at == 300
+        # a full batch that empties the queue does not grow it further
+        adaptive.batched(_batch(300), queue_depth=0)
+        assert adaptive.flush_at == 225
+        for _ in range(20):
+            adaptive.batched(_batch(1), queue_depth=0)
+        assert adaptive.flush_at == adaptive.min_flush_at
+
+    def test_linger_shrinks_with_light_traffic(self):
+        adaptive = AdaptiveBatching(flush_at=100, flush_interval=0.5)
+        adaptive.batched(_batch(3), queue_depth=0)
+        assert adaptive.flush_interval == 0.25
+        for _ in range(20):
+            adaptive.batched(_batch(3), queue_depth=0)
+        assert adaptive.flush_interval == adaptive.min_flush_interval
+        # batches filling up give it back
+        adaptive.batched(_batch(adaptive.flush_at), queue_depth=0)
+        assert adaptive.flush_interval == pytest.approx(0.11)
+
+    def test_idle_polling_changes_nothing(self):
+        adaptive = AdaptiveBatching(flush_at=100, flush_interval=0.5)
+        before = adaptive.settings()
+        for _ in range(20):
+            adaptive.batched(_batch(0), queue_depth=0)
+        assert adaptive.settings() == before
+
+    def test_rate_is_aimd(self):
+        metrics = Metrics()
+        adaptive = AdaptiveBatching(min_rate=10, max_rate=40, metrics=metrics)
+        adaptive.observe(0.01, APIError(429, "rate limited"))
+        assert adaptive.rate == 20
+        adaptive.observe(0.01, APIError(429, "rate limited"))
+        adaptive.observe(0.01, APIError(429, "rate limited"))
+        assert adaptive.rate == 10
+        adaptive.observe(0.01)
+        assert adaptive.rate == 11
+        # other errors leave it alone
+        adaptive.observe(0.01, APIError(500, "error"))
+        assert adaptive.rate == 11
+        assert metrics.snapshot()["adaptive_throttled"] == 3
+
+    def test_latency_spikes_slow_down_requests(self):
+        adaptive = AdaptiveBatching(rate_step=0, latency_floor=0.1)
+        for _ in range(5):
+            adaptive.observe(0.05)
+        assert adaptive.rate == 100
+        # slower, but under the floor
+        adaptive.observe(0.09)
+        assert adaptive.rate == 100
+        adaptive.observe(0.5)
+        assert adaptive.rate == 50
+
+    def test_settings_are_bounded(self):
+        adaptive = AdaptiveBatching(flush_at=5000, flush_interval=0)
+        assert adaptive.settings() == {
+            "flush_at": 1000,
+            "flush_interval": 0.01,
+            "rate": 100.0,
+        }
+        with pytest.raises(ValueError):
+            AdaptiveBatching(min_flush_at=100, max_flush_at=10)
+        with pytest.raises(ValueError):
+            AdaptiveBatching(min_rate=0)
+
+    def test_client(self):
+        with StubServer(throttle_rate=1, retry_after=0) as stub:
+            client = Client(
+                "api-key",
+                host=stub.url,
+                flush_interval=0.05,
+                max_retries=0,
+                adaptive={"max_rate": 20, "min_flush_interval": 0.05},
+            )
+            for n in range(3):
+                client.track_event(customer_id="c%d" % n, event_name="e")
+                client.flush()
+            stats = client.stats()
+        [settings] = stats["adaptive"]
+        assert settings["rate"] == 2.5
+        assert settings["flush_interval"] == 0.05
+        assert stats["adaptive_throttled"] == 3
+        assert "adaptive" not in Client("api-key", send=False).stats()
+        client = Client("api-key", send=False, flush_interval=2, adaptive=True)
+        assert client.stats()["adaptive"][0]["flush_interval"] == 1.0
@@ -0,0 +1,96 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from lotus import Client
+from lotus.agent import Agent
+from lotus.stub_server import StubServer
+
+
+@pytest.fixture
+def agent(tmp_path):
+    with StubServer() as stub:
+        client = Client("api-key", host=stub.url, flush_interval=0.1)
+        agent = Agent(
+            client, socket_path=str(tmp_path / "agent.sock"), udp=("127.0.0.1", 0)
+        )
+        thread = threading.Thread(target=agent.serve_forever, args=(0.05,))
+        thread.start()
+        agent.stub = stub
+        yield agent
+        agent.stop()
+        thread.join()
+        agent.close()
+
+
+def _wait_for(agent, count):
+    deadline = time.time() + 5
+    while agent.client.stats().get("enqueued", 0) < count:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    agent.client.flush()
+    return [e for *_, body in agent.stub.requests for e in body["batch"]]
+
+
+class TestAgent:
+    def test_unix_socket(self, agent):
+        client = Client("api-key", transport="agent", agent_address=agent.socket_path)
+        assert client.queues == [] and client.consumers == []
+        for n in range(10):
+            assert client.track_event(
+                customer_id="c1", event_name="e", properties={"n": n}
+            )[0]
+        events = _wait_for(agent, 10)
+        assert [e["properties"]["n"] for e in events] == list(range(10))
+        assert client.stats()["enqueued"] == 10
+
+    def test_udp_and_bulk_methods(self, agent):
+        client = Client("api-key", transport="agent", agent_address=agent.udp_address)
+        queued, errors = client.track_events(
+            [{"customer_id": "c1", "event_name": "e"}, {"event_name": "e"}]
+        )
+        assert (queued, [index for index, _ in errors]) == (1, [1])
+        emit = client.emitter("e")
+        emit("c2", {"n": 1})
+        events = _wait_for(agent, 2)
+        assert sorted(e["customer_id"] for e in events) == ["c1", "c2"]
+
+    def test_invalid_datagrams_are_dropped(self, agent):
+        assert not agent.handle(b"not json")
+        assert not agent.handle(b'{"$type": "track_event"}')
+        assert agent.client.stats()["agent_invalid"] == 2
+
+    def test_second_agent_refuses_a_live_socket(self, agent):
+        with pytest.raises(OSError):
+            Agent(agent.client, socket_path=agent.socket_path)
+        # the running agent still owns its socket
+        client = Client("api-key", transport="agent", agent_address=agent.socket_path)
+        client.track_event(customer_id="c1", event_name="still_here")
+        assert [e["event_name"] for e in _wait_for(agent, 1)] == ["still_here"]
+
+    def test_stale_socket_is_replaced(self, tmp_path):
+        path = str(tmp_path / "agent.sock")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sock.close()
+        agent = Agent(Client("api-key", send=False), socket_path=path)
+        agent.close()
+        assert not os.path.exists(path)
+
+    def test_other_files_are_not_replaced(self, tmp_path):
+        path = tmp_path / "agent.sock"
+        path.write_text("data")
+        with pytest.raises(OSError):
+            Agent(Client("api-key", send=False), socket_path=str(path))
+        assert path.read_text() == "data"
+
+    def test_no_agent_drops_events(self, tmp_path):
+        client = Client(
+            "api-key", transport="agent", agent_address=str(tmp_path / "none.sock")
+        )
+        success, _ = client.track_event(customer_id="c1", event_name="e")
+        assert not success
+        assert client.stats()["dropped"] == 1
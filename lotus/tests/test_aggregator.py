@@ -0,0 +1,105 @@
+import json
+import time
+
+import mock
+import pytest
+
+from lotus import Client
+from lotus.aggregator import Aggregator
+
+
+@pytest.fixture
+def aggregator():
+    emit = mock.Mock()
+    aggregator = Aggregator(
+        emit, {"api_call": {"count": "sum", "latency": "max"}}, window=60
+    )
+    yield aggregator
+    aggregator._stopped.set()
+
+
+def _emitted(emit):
+    return sorted(
+        (call[1] for call in emit.call_args_list),
+        key=lambda event: sorted(event["properties"].items()),
+    )
+
+
+class TestAggregator:
+    def test_merges_by_customer_event_and_group(self, aggregator):
+        for n in range(10):
+            assert aggregator.add(
+                "c1", "api_call", {"region": "US", "count": 1, "latency": n}
+            )
+        assert aggregator.add("c1", "api_call", {"region": "EU", "count": 2})
+        assert aggregator.add("c2", "api_call", {"region": "US", "count": 1})
+        aggregator.flush()
+
+        events = _emitted(aggregator.emit)
+        assert len(events) == 3
+        us = [e for e in events if e["properties"]["region"] == "US"]
+        c1 = [e for e in us if e["customer_id"] == "c1"][0]
+        assert c1["properties"] == {"region": "US", "count": 10, "latency": 9}
+        assert c1["time_created"].timestamp() % 60 == 0
+
+    def test_idempotency_ids_are_unique_per_aggregator(self, aggregator):
+        other = Aggregator(mock.Mock(), aggregator.rules, window=60)
+        other._stopped.set()
+        aggregator.add("c1", "api_call", {"count": 5})
+        other.add("c1", "api_call", {"count": 3})
+        for agg in (aggregator, other):
+            agg.flush()
+        first = aggregator.emit.call_args[1]["idempotency_id"]
+        # both counts are billed, neither is deduplicated as the other's retry
+        assert first != other.emit.call_args[1]["idempotency_id"]
+
+        # a window flushed early must not reuse the id on its next emission
+        aggregator.add("c1", "api_call", {"count": 1})
+        aggregator.flush()
+        assert aggregator.emit.call_args[1]["idempotency_id"] != first
+
+    def test_passes_through_what_it_cannot_aggregate(self, aggregator):
+        assert not aggregator.add("c1", "page_view", {"count": 1})
+        assert not aggregator.add("c1", "api_call", {"count": "one"})
+        assert not aggregator.add("c1", "api_call", {"count": True})
+        assert not aggregator.add("c1", "api_call", {"count": 1, "tags": ["a"]})
+
+    def test_closed_windows_are_emitted(self):
+        emit = mock.Mock()
+        aggregator = Aggregator(emit, {"api_call": {"count": "sum"}}, window=0.1)
+        aggregator.add("c1", "api_call", {"count": 1})
+        time.sleep(0.4)
+        aggregator.stop()
+        assert emit.call_count == 1
+
+    def test_rejects_unknown_reducers(self):
+        with pytest.raises(ValueError):
+            Aggregator(mock.Mock(), {"api_call": {"count": "avg"}})
+
+
+class TestClientAggregation:
+    def test_track_event_is_aggregated(self):
+        with mock.patch("lotus.consumer.send") as send:
+            client = Client(
+                "api-key",
+                host="http://localhost",
+                aggregate={"api_call": {"count": "sum"}},
+                aggregate_window=60,
+            )
+            for _ in range(100):
+                assert client.track_event(
+                    customer_id=1, event_name="api_call", properties={"count": 1}
+                ) == (True, None)
+            client.track_event(customer_id=1, event_name="other")
+            client.flush()
+            client.join()
+
+        events = [
+            e
+            for call in send.call_args_list
+            for e in json.loads(call[1]["data"])["batch"]
+        ]
+        assert len(events) == 2
+        merged = [e for e in events if e["event_name"] == "api_call"][0]
+        assert merged["customer_id"] == "1"
+        assert merged["properties"] == {"count": 100}
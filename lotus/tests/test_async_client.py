@@ -0,0 +1,225 @@
+import asyncio
+import inspect
+import os
+import time
+
+import pytest
+
+from lotus import AsyncClient, Client
+from lotus.async_client import METHODS
+from lotus.request import APIError
+from lotus.stub_server import StubServer
+
+pytest.importorskip("httpx")
+
+
+@pytest.fixture
+def stub():
+    with StubServer() as server:
+        yield server
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+class TestAsyncClient:
+    def test_mirrors_every_public_method(self):
+        public = {
+            name
+            for name in dir(Client)
+            if not name.startswith("_") and callable(getattr(Client, name))
+        }
+        # read local counters and queue events without blocking
+        public -= {"stats", "emitter"}
+        for name in public:
+            assert inspect.iscoroutinefunction(getattr(AsyncClient, name)), name
+        assert set(METHODS) <= public
+
+    def test_get_customer(self, stub):
+        stub.responses["/api/customers/"] = {"customer_id": "c1", "email": "a@b.co"}
+
+        async def main():
+            client = AsyncClient("api-key", host=stub.url, sync_mode=True)
+            try:
+                return await client.get_customer(customer_id="c1")
+            finally:
+                await client.aclose()
+
+        customer = _run(main())
+        assert customer["customer_id"] == "c1"
+        method, path, _, headers, _ = stub.requests[0]
+        assert (method, path) == ("GET", "/api/customers/c1/")
+        assert headers["X-API-KEY"] == "api-key"
+
+    def test_query_and_list_parsing(self, stub):
+        stub.responses["/api/subscriptions/"] = [{"subscription_id": "s1"}]
+
+        async def main():
+            client = AsyncClient("api-key", host=stub.url, sync_mode=True)
+            try:
+                return await client.list_subscriptions(
+                    customer_id="c1", status=["active", "ended"]
+                )
+            finally:
+                await client.aclose()
+
+        subscriptions = _run(main())
+        assert [s["subscription_id"] for s in subscriptions] == ["s1"]
+        _, _, query, _, _ = stub.requests[0]
+        assert query == {"customer_id": ["c1"], "status": ["active", "ended"]}
+
+    def test_post_body_and_validation(self, stub):
+        async def main():
+            client = AsyncClient("api-key", host=stub.url, sync_mode=True)
+            try:
+                with pytest.raises(AssertionError):
+                    await client.create_credit(customer_id="c1")
+                return await client.create_credit(
+                    customer_id="c1", amount=10, currency_code="USD"
+                )
+            finally:
+                await client.aclose()
+
+        _run(main())
+        method, path, _, _, body = stub.requests[0]
+        assert (method, path) == ("POST", "/api/credits/")
+        assert body["amount"] == 10
+        assert "sentAt" in body
+
+    def test_api_errors(self, stub):
+        stub.responses["/api/plans/"] = (404, {"detail": "not found"})
+
+        async def main():
+            client = AsyncClient("api-key", host=stub.url, sync_mode=True)
+            try:
+                await client.get_plan(plan_id="p1")
+            finally:
+                await client.aclose()
+
+        with pytest.raises(APIError) as exc:
+            _run(main())
+        assert exc.value.status == 404
+
+    def test_concurrent_calls_and_track_event(self, stub):
+        stub.responses["/api/feature_access/"] = {"access": True}
+
+        async def main():
+            async with AsyncClient("api-key", host=stub.url) as client:
+                await client.track_event(
+                    customer_id="c1", event_name="api_call", properties={"n": 1}
+                )
+                return await asyncio.gather(
+                    *[
+                        client.check_feature_access(customer_id="c1", feature_id="f1")
+                        for _ in range(20)
+                    ]
+                )
+
+        results = _run(main())
+        assert [r["access"] for r in results] == [True] * 20
+        paths = [request[1] for request in stub.requests]
+        assert paths.count("/api/feature_access/") == 20
+        assert paths.count("/api/track/") == 1
+
+    def test_entitlement_cache(self, stub):
+        stub.responses["/api/metric_access/"] = {"access": True}
+
+        async def main():
+            client = AsyncClient(
+                "api-key", host=stub.url, sync_mode=True, entitlement_cache=True
+            )
+            try:
+                for _ in range(3):
+                    await client.check_metric_access(customer_id="c1", metric_id="m1")
+                await client.cancel_subscription(subscription_id="s1")
+                await client.check_metric_access(customer_id="c1", metric_id="m1")
+            finally:
+                await client.aclose()
+
+        _run(main())
+        paths = [request[1] for request in stub.requests]
+        assert paths.count("/api/metric_access/") == 2
+
+    def test_prewarm(self, stub):
+        async def main():
+            client = AsyncClient("api-key", host=stub.url, sync_mode=True)
+            try:
+                await client.prewarm(connections=2)
+            finally:
+                await client.aclose()
+
+        _run(main())
+        assert [r[:2] for r in stub.requests] == [("GET", "/api/ping/")] * 2
+
+    def test_retry_after(self, stub):
+        stub.throttle_rate = 1
+        stub.retry_after = 0.3
+
+        async def main():
+            client = AsyncClient("api-key", host=stub.url, sync_mode=True)
+            try:
+                with pytest.raises(APIError) as exc:
+                    await client.get_plan(plan_id="p1")
+                assert exc.value.retry_after == 0.3
+                stub.throttle_rate = 0
+                started = time.monotonic()
+                await client.get_plan(plan_id="p1")
+                return time.monotonic() - started
+            finally:
+                await client.aclose()
+
+        assert _run(main()) >= 0.25
+
+    def test_track_events_in_sync_mode(self, stub):
+        events = [{"customer_id": "c%d" % n, "event_name": "e"} for n in range(2)]
+
+        async def main():
+            client = AsyncClient("api-key", host=stub.url, sync_mode=True)
+            try:
+                return await client.track_events(events + [{"customer_id": None}])
+            finally:
+                await client.aclose()
+
+        queued, errors = _run(main())
+        assert queued == 2
+        assert [index for index, _ in errors] == [2]
+        paths = [request[1] for request in stub.requests]
+        assert paths == ["/api/track/"] * 2
+
+    def test_aggregate(self, stub):
+        rules = {"api_call": {"tokens": "sum"}}
+        with pytest.raises(ValueError):
+            AsyncClient("api-key", host=stub.url, sync_mode=True, aggregate=rules)
+
+        async def main():
+            client = AsyncClient("api-key", host=stub.url, aggregate=rules)
+            for _ in range(3):
+                await client.track_event(
+                    customer_id="c1", event_name="api_call", properties={"tokens": 2}
+                )
+            await client.shutdown()
+            await client.aclose()
+
+        _run(main())
+        (event,) = [e for *_, body in stub.requests for e in body["batch"]]
+        assert event["properties"] == {"tokens": 6}
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+    def test_fork_rebuilds_the_connection_pool(self, stub):
+        stub.responses["/api/customers/"] = {"customer_id": "c1"}
+        client = AsyncClient("api-key", host=stub.url, sync_mode=True)
+        _run(client.get_customer(customer_id="c1"))
+        http = client._http
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                assert client._http is not http
+                _run(client.get_customer(customer_id="c1"))
+                code = 0
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+        assert len(stub.requests) == 2
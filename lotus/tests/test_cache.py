@@ -0,0 +1,133 @@
+import threading
+import time
+
+import mock
+
+from lotus import Client
+from lotus.cache import FRESH, MISSING, STALE, EntitlementCache, cache_key
+from lotus.stub_server import StubServer
+
+
+def _key(customer_id="c1", feature_id="f1", filters=None):
+    return cache_key("check_feature_access", customer_id, feature_id, filters)
+
+
+def _wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestEntitlementCache:
+    def test_fresh_stale_and_missing(self):
+        cache = EntitlementCache(ttls={"check_feature_access": 0.05}, stale_ttl=0.1)
+        key = _key()
+        assert cache.lookup(key[0], key) == (MISSING, None)
+        cache.store(key, {"access": True})
+        assert cache.lookup(key[0], key) == (FRESH, {"access": True})
+        time.sleep(0.06)
+        assert cache.lookup(key[0], key) == (STALE, {"access": True})
+        # only one caller is asked to refresh
+        assert cache.lookup(key[0], key) == (FRESH, {"access": True})
+        time.sleep(0.1)
+        assert cache.lookup(key[0], key) == (MISSING, None)
+
+    def test_get_refreshes_stale_values_in_background(self):
+        cache = EntitlementCache(ttls={"check_feature_access": 0}, stale_ttl=60)
+        key = _key()
+        fetch = mock.Mock(side_effect=[1, 2])
+        assert cache.get(key[0], key, fetch) == 1
+        assert cache.get(key[0], key, fetch) == 1
+        assert _wait_for(lambda: cache.lookup(key[0], key)[1] == 2)
+        assert fetch.call_count == 2
+
+    def test_failed_refresh_keeps_stale_value(self):
+        cache = EntitlementCache(ttls={"check_feature_access": 0}, stale_ttl=60)
+        key = _key()
+        cache.store(key, 1)
+        cache.get(key[0], key, mock.Mock(side_effect=Exception("down")))
+        assert _wait_for(lambda: not cache._refreshing)
+        assert cache.lookup(key[0], key) == (STALE, 1)
+
+    def test_lru_eviction(self):
+        cache = EntitlementCache(max_size=2)
+        cache.store(_key("c1"), 1)
+        cache.store(_key("c2"), 2)
+        cache.lookup("check_feature_access", _key("c1"))
+        cache.store(_key("c3"), 3)
+        assert len(cache) == 2
+        assert cache.lookup("check_feature_access", _key("c2"))[0] == MISSING
+
+    def test_invalidate(self):
+        cache = EntitlementCache()
+        cache.store(_key("c1"), 1)
+        cache.store(_key("c1", "f2"), 1)
+        cache.store(_key("c2"), 2)
+        cache.invalidate("c1")
+        assert len(cache) == 1
+        cache.invalidate()
+        assert len(cache) == 0
+
+    def test_fetches_racing_an_invalidation_are_not_stored(self):
+        cache = EntitlementCache(ttls={"check_feature_access": 0}, stale_ttl=60)
+        key = _key()
+        cache.store(key, "old")
+        started, invalidated = threading.Event(), threading.Event()
+
+        def fetch():
+            # the answer predates the subscription change
+            started.set()
+            invalidated.wait(1)
+            return "old"
+
+        assert cache.get(key[0], key, fetch) == "old"
+        assert started.wait(1)
+        cache.invalidate("c1")
+        invalidated.set()
+        assert _wait_for(lambda: not cache._refreshing)
+        assert cache.lookup(key[0], key) == (MISSING, None)
+
+        # the same for a fetch of a missing value
+        def missing():
+            cache.invalidate()
+            return "old"
+
+        assert cache.get(key[0], key, missing) == "old"
+        assert cache.lookup(key[0], key) == (MISSING, None)
+
+    def test_key_ignores_filter_order(self):
+        a = [
+            {"property_name": "region", "value": "US"},
+            {"property_name": "x", "value": 1},
+        ]
+        assert _key(filters=a) == _key(filters=list(reversed(a)))
+        assert _key(filters=a) != _key()
+
+
+class TestClientCache:
+    def test_access_checks_are_cached_and_invalidated(self):
+        with StubServer() as stub:
+            stub.responses["/api/feature_access/"] = {"access": True}
+            stub.responses["/api/subscriptions/"] = {"subscription_id": "s1"}
+            client = Client(
+                "api-key", host=stub.url, sync_mode=True, entitlement_cache=True
+            )
+            for _ in range(5):
+                assert client.check_feature_access(customer_id="c1", feature_id="f1")[
+                    "access"
+                ]
+            client.check_feature_access(customer_id="c2", feature_id="f1")
+            client.create_subscription(
+                customer_id="c1", plan_id="p1", start_date="2023-01-01"
+            )
+            client.check_feature_access(customer_id="c1", feature_id="f1")
+            client.check_feature_access(customer_id="c2", feature_id="f1")
+
+        paths = [request[1] for request in stub.requests]
+        assert paths == [
+            "/api/feature_access/",
+            "/api/feature_access/",
+            "/api/subscriptions/",
+            "/api/feature_access/",
+        ]
@@ -0,0 +1,247 @@
+import json
+import os
+import uuid
+from decimal import Decimal
+from queue import Full
+
+import mock
+import pytest
+
+from lotus import Client
+from lotus.stub_server import StubServer
+
+
+def _uploaded(send):
+    """Return the events posted through a mocked `send`, in upload order."""
+    events = []
+    for call in send.call_args_list:
+        events.extend(json.loads(call[1]["data"])["batch"])
+    return events
+
+
+class TestClient:
+    def test_thread_creates_one_consumer_per_shard(self):
+        client = Client("api-key", send=False, thread=4)
+        assert len(client.consumers) == 4
+        assert len(client.queues) == 4
+        assert [c.queue for c in client.consumers] == client.queues
+
+    def test_sync_mode_has_no_consumers(self):
+        client = Client("api-key", sync_mode=True)
+        assert client.consumers == []
+        client.join()
+
+    def test_customer_events_share_a_shard(self):
+        client = Client("api-key", send=False, thread=8)
+        assert client._shard("customer-1") is client._shard("customer-1")
+        shards = {id(client._shard("customer-%d" % n)) for n in range(100)}
+        assert len(shards) > 1
+
+    def test_flush_and_join_cover_every_shard(self):
+        with mock.patch("lotus.consumer.send") as send:
+            client = Client("api-key", host="http://localhost", thread=4)
+            for n in range(200):
+                client.track_event(
+                    customer_id="customer-%d" % (n % 10),
+                    event_name="test_event",
+                    properties={"n": n},
+                )
+            client.flush()
+            client.join()
+
+        events = _uploaded(send)
+        assert len(events) == 200
+        assert all(not consumer.is_alive() for consumer in client.consumers)
+        for customer in range(10):
+            seen = [
+                e["properties"]["n"]
+                for e in events
+                if e["customer_id"] == "customer-%d" % customer
+            ]
+            assert seen == sorted(seen)
+
+    def test_blocking_calls_parse_responses(self):
+        with StubServer() as stub:
+            stub.responses["/api/customers/"] = {"customer_id": "c1"}
+            stub.responses["/api/subscriptions/"] = [{"subscription_id": "s1"}]
+            stub.responses["/api/subscriptions/s1/"] = {"subscription_id": "s1"}
+            client = Client("api-key", host=stub.url, sync_mode=True)
+            assert client.get_customer(customer_id="c1")["customer_id"] == "c1"
+            subscriptions = client.list_subscriptions(customer_id="c1")
+            assert subscriptions[0]["subscription_id"] == "s1"
+            cancelled = client.cancel_subscription(subscription_id="s1")
+            assert isinstance(cancelled, dict)
+
+        paths = [request[1] for request in stub.requests]
+        assert paths == [
+            "/api/customers/c1/",
+            "/api/subscriptions/",
+            "/api/subscriptions/s1/cancel/",
+        ]
+
+    def test_transport_configuration(self):
+        client = Client("api-key", send=False)
+        assert client.session is None
+        assert client.timeout == 15
+
+        client = Client(
+            "api-key", send=False, pool_maxsize=32, connect_timeout=2, timeout=30
+        )
+        adapter = client.session.get_adapter("https://api.uselotus.io")
+        assert adapter._pool_maxsize == 32
+        assert client.timeout == (2, 30)
+        assert all(c.session is client.session for c in client.consumers)
+        assert all(c.timeout == (2, 30) for c in client.consumers)
+
+        client = Client("api-key", send=False, keep_alive=False)
+        assert client.session.headers["Connection"] == "close"
+
+    def test_requests_use_the_client_session(self):
+        with StubServer() as stub:
+            stub.responses["/api/customers/"] = {"customer_id": "c1"}
+            client = Client("api-key", host=stub.url, sync_mode=True, pool_maxsize=4)
+            with mock.patch.object(
+                client.session, "get", wraps=client.session.get
+            ) as get:
+                client.get_customer(customer_id="c1")
+            assert get.call_count == 1
+
+    def test_prewarm(self):
+        with StubServer() as stub:
+            client = Client("api-key", host=stub.url, sync_mode=True)
+            client.prewarm(connections=3)
+        assert [r[:2] for r in stub.requests] == [("GET", "/api/ping/")] * 3
+
+    def test_track_event_copies_nested_properties(self):
+        client = Client("api-key", send=False)
+        client.send = True
+        properties = {"meta": {"n": 1}, "tags": ["a"]}
+        client.track_event(customer_id="c1", event_name="e", properties=properties)
+        properties["meta"]["n"] = 2
+        properties["tags"].append("b")
+        queued = client.queues[0].get()
+        assert queued["properties"] == {"meta": {"n": 1}, "tags": ["a"]}
+
+    def test_track_events(self):
+        client = Client("api-key", send=False, thread=4)
+        client.send = True
+        events = [
+            {"customer_id": "c%d" % n, "event_name": "e", "properties": {"n": n}}
+            for n in range(20)
+        ]
+        events[3] = {"customer_id": None, "event_name": "e"}
+        events[7] = {"customer_id": 7, "event_name": "e", "time_created": 5}
+        queued, errors = client.track_events(events)
+        assert queued == 18
+        assert [index for index, _ in errors] == [3, 7]
+        assert all(isinstance(e, AssertionError) for _, e in errors)
+
+        for queue in client.queues:
+            while not queue.empty():
+                body = json.loads(queue.get())
+                assert client._shard(body["customer_id"]) is queue
+                assert uuid.UUID(body["idempotency_id"]).version == 4
+                assert body["library"] == "lotus-python"
+        assert client.stats()["enqueued"] == 18
+
+    def test_track_events_reports_a_full_queue(self):
+        client = Client("api-key", send=False, max_queue_size=5)
+        client.send = True
+        events = [{"customer_id": "c1", "event_name": "e"} for _ in range(8)]
+        queued, errors = client.track_events(events)
+        assert queued == 5
+        assert [index for index, _ in errors] == [5, 6, 7]
+        assert all(isinstance(e, Full) for _, e in errors)
+        assert client.stats()["dropped"] == 3
+
+    def test_track_events_cleans_properties(self):
+        client = Client("api-key", send=False)
+        client.send = True
+        properties = {"amount": Decimal("1.5"), "tags": ("a", "b")}
+        client.track_events(
+            [{"customer_id": 1, "event_name": "e", "properties": properties}]
+        )
+        body = json.loads(client.queue.get())
+        assert body["customer_id"] == "1"
+        assert body["properties"] == {"amount": 1.5, "tags": ["a", "b"]}
+
+    def test_track_events_in_sync_mode(self):
+        with StubServer() as stub:
+            client = Client("api-key", host=stub.url, sync_mode=True)
+            queued, errors = client.track_events(
+                [{"customer_id": "c1", "event_name": "e"}, {"event_name": "e"}]
+            )
+        assert queued == 1
+        assert [index for index, _ in errors] == [1]
+        assert len(stub.requests) == 1
+
+    def test_emitter(self):
+        client = Client("api-key", send=False)
+        client.send = True
+        emit = client.emitter("api_call", schema={"tokens": int, "model": str})
+        properties = {"tokens": 5, "model": "small"}
+        assert emit("c1", properties)[0]
+        body = json.loads(client.queue.get())
+        _, expected = client.track_event(
+            customer_id="c1", event_name="api_call", properties=properties
+        )
+        client.queue.get()
+        assert body.keys() == expected.keys()
+        assert body["properties"] == properties
+        assert len(body["time_created"]) == len(expected["time_created"])
+        assert emit("c1", properties)[1]["idempotency_id"] != body["idempotency_id"]
+        uuid.UUID(body["idempotency_id"])
+        # the emitter's events are counted, with the track_event one
+        assert client.stats()["enqueued"] == 3
+
+    def test_emitter_checks_the_schema(self):
+        client = Client("api-key", send=False)
+        client.send = True
+        emit = client.emitter("api_call", schema={"tokens": (int, float)})
+        emit("c1", {"tokens": 1.5})
+        with pytest.raises(AssertionError):
+            emit("c1", {"tokens": "5"})
+        with pytest.raises(AssertionError):
+            emit("c1", {"tokens": 5, "extra": 1})
+        with pytest.raises(ValueError):
+            client.emitter("api_call", schema={"tokens": Decimal})
+
+    def test_emitter_falls_back_to_track_event(self):
+        with StubServer() as stub:
+            client = Client("api-key", host=stub.url, sync_mode=True)
+            emit = client.emitter("api_call")
+            emit(42, {"amount": Decimal("1.5")})
+        _, _, _, _, body = stub.requests[0]
+        assert body["customer_id"] == "42"
+        assert body["properties"] == {"amount": 1.5}
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+    @pytest.mark.parametrize("inherit", [True, False])
+    def test_fork_restarts_consumers(self, inherit):
+        with StubServer() as stub:
+            client = Client(
+                "api-key", host=stub.url, send=False, fork_inherit_queue=inherit
+            )
+            # queued, but no consumer thread is running
+            client.send = True
+            client.track_event(customer_id="c1", event_name="before_fork")
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    assert client.consumers[0].is_alive()
+                    client.track_event(customer_id="c1", event_name="after_fork")
+                    client.flush()
+                    client.join()
+                    code = 0
+                finally:
+                    os._exit(code)
+            _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+        events = [e["event_name"] for *_, body in stub.requests for e in body["batch"]]
+        # the parent uploads what was queued before the fork
+        assert Client("api-key", send=False).fork_inherit_queue is False
+        if inherit:
+            assert events == ["before_fork", "after_fork"]
+        else:
+            assert events == ["after_fork"]
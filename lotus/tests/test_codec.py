@@ -0,0 +1,62 @@
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+from dateutil.tz import tzlocal, tzutc
+
+from lotus import codec
+
+BODY = {
+    "$type": "track_event",
+    "customer_id": "customer-1",
+    "event_name": "api_call",
+    "idempotency_id": "7d5b5d36-0b9a-4c43-9d8e-2b43a1d1e5a5",
+    "time_created": datetime(2023, 1, 2, 3, 4, 5, 678, tzinfo=tzutc()),
+    "properties": {
+        "day": date(2023, 1, 2),
+        "local": datetime(2023, 1, 2, 3, 4, 5, tzinfo=tzlocal()),
+        "naive": datetime(2023, 1, 2, 3, 4, 5),
+        "amount": Decimal("12.50"),
+        "count": 3,
+        "ratio": 0.25,
+        "flag": True,
+        "missing": None,
+        "name": "café",
+        "nested": {"tags": ["a", "b"], "values": [1, 2.5, {"deep": [None]}]},
+        1: "int key",
+    },
+}
+
+
+@pytest.mark.parametrize("name", codec.available())
+def test_codecs_match_stdlib(name):
+    assert codec.get_codec(name).dumps(BODY) == codec.JSONCodec().dumps(BODY)
+
+
+@pytest.mark.parametrize("name", codec.available())
+def test_codecs_decode_like_datetime_serializer(name):
+    expected = json.loads(json.dumps(BODY, cls=codec.DatetimeSerializer))
+    assert json.loads(codec.get_codec(name).dumps(BODY)) == expected
+
+
+@pytest.mark.parametrize("name", codec.available())
+def test_codecs_reject_unknown_types(name):
+    with pytest.raises(TypeError):
+        codec.get_codec(name).dumps({"value": object()})
+
+
+def test_orjson_falls_back_on_big_integers():
+    if "orjson" not in codec.available():
+        pytest.skip("orjson is not installed")
+    assert codec.get_codec("orjson").dumps([2**70]) == b"[1180591620717411303424]"
+
+
+def test_set_codec():
+    try:
+        codec.set_codec("json")
+        assert codec.dumps({"a": 1}) == b'{"a":1}'
+    finally:
+        codec.set_codec(codec.available()[0])
+    with pytest.raises(ValueError):
+        codec.set_codec("yaml")
@@ -0,0 +1,131 @@
+import gzip
+import json
+from queue import Queue
+
+import pytest
+
+from lotus import Client
+from lotus.batch import BATCH_SIZE_LIMIT, MAX_MSG_SIZE, Batch
+from lotus.compression import (
+    MAX_RATIO,
+    GzipCompressor,
+    ZstdCompressor,
+    get_compressor,
+)
+from lotus.consumer import Consumer
+from lotus.metrics import Metrics
+from lotus.request import prepare_request
+from lotus.stub_server import StubServer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+needs_zstd = pytest.mark.skipif(zstandard is None, reason="zstandard is missing")
+
+
+def _batch(events):
+    batch = Batch()
+    for n in range(events):
+        batch.add({"customer_id": "customer-%d" % n, "event_name": "api_call"})
+    return batch
+
+
+class TestCompression:
+    def test_gzip_streams_chunks(self):
+        batch = _batch(100)
+        metrics = Metrics()
+        encoding, data = GzipCompressor(level=9).compress(batch.chunks(), metrics)
+        assert encoding == "gzip"
+        assert len(json.loads(gzip.decompress(data))["batch"]) == 100
+        stats = metrics.snapshot()
+        assert stats["compression_ratio"]["min"] > 1
+        assert stats["compress_seconds"]["count"] == 1
+
+    @needs_zstd
+    def test_zstd(self):
+        batch = _batch(100)
+        encoding, data = ZstdCompressor().compress(batch.chunks())
+        assert encoding == "zstd"
+        raw = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        assert json.loads(raw)["batch"] == batch.items
+
+    def test_threshold(self):
+        metrics = Metrics()
+        compressor = GzipCompressor(threshold=1024)
+        assert compressor.compress([b"{}"], metrics) == (None, b"{}")
+        assert metrics.snapshot()["compression_skipped"] == 1
+
+        _, headers, data = prepare_request(
+            "host", "key", body={}, compressor=compressor
+        )
+        assert "Content-Encoding" not in headers
+        _, headers, data = prepare_request("host", "key", gzip=True, body={})
+        assert headers["Content-Encoding"] == "gzip"
+
+    def test_get_compressor(self):
+        assert get_compressor(None) is None
+        assert get_compressor("gzip", level=1).level == 1
+        with pytest.raises(ValueError):
+            get_compressor("brotli")
+
+    @pytest.mark.parametrize(
+        "compression", ["gzip", pytest.param("zstd", marks=needs_zstd)]
+    )
+    def test_client_uploads_compressed_batches(self, compression):
+        with StubServer() as stub:
+            client = Client(
+                "api-key",
+                host=stub.url,
+                compression=compression,
+                compression_threshold=0,
+            )
+            for n in range(10):
+                client.track_event(customer_id="c1", event_name="e", properties={})
+            client.flush()
+            client.join()
+
+        _, path, _, headers, body = stub.requests[0]
+        assert path == "/api/track/"
+        assert headers["Content-Encoding"] == compression
+        assert len(body["batch"]) == 10
+        assert client.stats()["compression_ratio"]["count"] == 1
+
+
+class TestCompressedPacking:
+    def test_ratio_tracks_measurements(self):
+        compressor = GzipCompressor()
+        assert compressor.max_batch_size(BATCH_SIZE_LIMIT) == BATCH_SIZE_LIMIT
+        for _ in range(20):
+            compressor.compress(_batch(1000).chunks())
+        assert compressor.ratio > 5
+        limit = compressor.max_batch_size(BATCH_SIZE_LIMIT)
+        assert BATCH_SIZE_LIMIT * 4 < limit <= BATCH_SIZE_LIMIT * MAX_RATIO
+
+    def test_batches_fill_the_wire_limit(self):
+        queue = Queue()
+        for n in range(40000):
+            queue.put({"customer_id": "customer-%d" % (n % 100), "event_name": "e"})
+        with StubServer() as stub:
+            consumer = Consumer(
+                queue,
+                "api-key",
+                host=stub.url + "/api/track/",
+                flush_at=100000,
+                compressor=GzipCompressor(),
+            )
+            while not queue.empty():
+                assert consumer.upload()
+
+        sizes = [
+            (
+                len(json.dumps(body, separators=(",", ":"))),
+                int(headers["Content-Length"]),
+            )
+            for _, _, _, headers, body in stub.requests
+        ]
+        # the first batch is packed as if uncompressed, later ones fill up
+        assert sizes[0][0] < BATCH_SIZE_LIMIT + MAX_MSG_SIZE
+        assert max(raw for raw, _ in sizes[1:]) > 2 * BATCH_SIZE_LIMIT
+        assert all(wire < 500000 for _, wire in sizes)
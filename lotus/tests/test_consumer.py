@@ -0,0 +1,255 @@
+import json
+import time
+from datetime import datetime
+from queue import Queue
+
+import mock
+from dateutil.tz import tzutc
+
+from lotus import codec
+from lotus.batch import Batch
+from lotus.consumer import MAX_MSG_SIZE, Consumer
+from lotus.request import APIError
+
+
+def _event(n, **properties):
+    return {
+        "$type": "track_event",
+        "customer_id": "customer-%d" % n,
+        "event_name": "test_event",
+        "idempotency_id": "event-%d" % n,
+        "time_created": datetime(2023, 1, 1, tzinfo=tzutc()),
+        "properties": properties,
+    }
+
+
+class TestBatch:
+    def test_encode_matches_json_dumps(self):
+        batch = Batch()
+        items = [_event(n, count=n, nested={"a": [1, 2.5, None]}) for n in range(5)]
+        for item in items:
+            assert batch.add(item)
+
+        data = batch.encode()
+        sent_at = json.loads(data)["sentAt"]
+        assert data == codec.dumps({"batch": items, "sentAt": sent_at})
+
+    def test_rejects_oversized_item(self):
+        batch = Batch()
+        assert not batch.add(_event(0, blob="x" * MAX_MSG_SIZE))
+        assert len(batch) == 0
+        assert batch.size == 0
+
+    def test_full(self):
+        batch = Batch(max_size=200)
+        while not batch.full():
+            assert batch.add(_event(len(batch)))
+        assert batch.size >= 200
+
+
+class TestConsumer:
+    def test_next_limits_batch(self):
+        q = Queue()
+        consumer = Consumer(q, "api-key", flush_at=3)
+        for n in range(5):
+            q.put(_event(n))
+        batch = consumer.next()
+        assert [item["idempotency_id"] for item in batch] == [
+            "event-0",
+            "event-1",
+            "event-2",
+        ]
+
+    def test_next_drops_oversized_item(self):
+        q = Queue()
+        consumer = Consumer(q, "api-key", flush_interval=0.1)
+        q.put(_event(0, blob="x" * MAX_MSG_SIZE))
+        q.put(_event(1))
+        batch = consumer.next()
+        assert len(batch) == 1
+        for _ in batch:
+            q.task_done()
+        # the dropped item was acknowledged, so the queue can be joined
+        q.join()
+
+    def test_upload_sends_encoded_batch(self):
+        q = Queue()
+        consumer = Consumer(q, "api-key", host="http://localhost/api/track/")
+        q.put(_event(0))
+        with mock.patch("lotus.consumer.send") as send:
+            assert consumer.upload()
+        kwargs = send.call_args[1]
+        assert "body" not in kwargs
+        body = json.loads(kwargs["data"])
+        assert body["batch"][0]["idempotency_id"] == "event-0"
+
+    def test_upload_reports_items_on_error(self):
+        q = Queue()
+        on_error = mock.Mock()
+        consumer = Consumer(q, "api-key", retries=0, on_error=on_error)
+        q.put(_event(0))
+        with mock.patch("lotus.consumer.send", side_effect=Exception("boom")):
+            assert not consumer.upload()
+        error, items = on_error.call_args[0]
+        assert str(error) == "boom"
+        assert items == [_event(0)]
+
+
+class TestRetryLane:
+    def test_failing_batches_do_not_stall_new_ones(self):
+        q = Queue()
+        on_error = mock.Mock()
+        consumer = Consumer(
+            q,
+            "api-key",
+            flush_at=10,
+            flush_interval=0.05,
+            retries=3,
+            on_error=on_error,
+            backoff_base=0.2,
+        )
+        delivered = []
+
+        def fake_send(*args, **kwargs):
+            batch = json.loads(kwargs["data"])["batch"]
+            if any(item["properties"].get("poison") for item in batch):
+                raise APIError(503, "unavailable")
+            delivered.extend(item["idempotency_id"] for item in batch)
+
+        with mock.patch("lotus.consumer.send", side_effect=fake_send):
+            consumer.start()
+            start = time.time()
+            for n in range(200):
+                q.put(_event(n, poison=(n % 50 == 0)))
+                time.sleep(0.001)
+            # every healthy event gets through while the poisoned batches
+            # are still backing off
+            deadline = time.time() + 2
+            while len(delivered) < 160 and time.time() < deadline:
+                time.sleep(0.01)
+            assert len(delivered) >= 160
+            assert time.time() - start < 2
+            assert len(consumer.retry_lane) > 0
+
+            q.join()
+            consumer.pause()
+            consumer.join()
+
+        # one poisoned batch per poisoned event
+        assert on_error.call_count == 4
+        for error, items in (call[0] for call in on_error.call_args_list):
+            assert error.status == 503
+            assert any(item["properties"].get("poison") for item in items)
+
+    def test_retried_batch_is_delivered(self):
+        q = Queue()
+        consumer = Consumer(q, "api-key", retries=3, backoff_base=0.01)
+        q.put(_event(0))
+        with mock.patch(
+            "lotus.consumer.send", side_effect=[APIError(500, "oops"), None]
+        ) as send:
+            assert not consumer.upload()
+            q.join()
+        assert send.call_count == 2
+
+    def test_fatal_errors_are_not_retried(self):
+        q = Queue()
+        on_error = mock.Mock()
+        consumer = Consumer(q, "api-key", retries=3, on_error=on_error)
+        q.put(_event(0))
+        with mock.patch("lotus.consumer.send", side_effect=APIError(400, "bad")):
+            assert not consumer.upload()
+        assert on_error.call_count == 1
+        assert len(consumer.retry_lane) == 0
+
+    def test_full_lane_reports_errors_right_away(self):
+        q = Queue()
+        on_error = mock.Mock()
+        consumer = Consumer(
+            q, "api-key", retries=3, on_error=on_error, max_retry_batches=0
+        )
+        q.put(_event(0))
+        with mock.patch("lotus.consumer.send", side_effect=APIError(503, "down")):
+            assert not consumer.upload()
+        assert on_error.call_count == 1
+
+    def test_full_lane_blocks_the_consumer(self):
+        q = Queue()
+        on_error = mock.Mock()
+        consumer = Consumer(
+            q, "api-key", flush_at=1, retries=1, on_error=on_error, max_retry_batches=2
+        )
+        for n in range(3):
+            q.put(_event(n))
+        error = APIError(503, "down", retry_after=0.2)
+        with mock.patch("lotus.consumer.send", side_effect=error):
+            start = time.time()
+            for _ in range(3):
+                assert not consumer.upload()
+            # the third batch waited for the first one's retry
+            assert time.time() - start >= 0.2
+            q.join()
+            consumer.retry_lane.stop()
+        # every batch got its retry before it was reported
+        assert on_error.call_count == 3
+
+
+class TestBisect:
+    def _consumer(self, q, **kwargs):
+        return Consumer(q, "api-key", flush_at=64, flush_interval=0.01, **kwargs)
+
+    def test_rejected_batches_are_split_down_to_bad_events(self):
+        q = Queue()
+        on_error = mock.Mock()
+        dead_letter = mock.Mock()
+        consumer = self._consumer(q, on_error=on_error, dead_letter=dead_letter)
+        for n in range(64):
+            q.put(_event(n, poison=n in (5, 40)))
+        delivered = []
+
+        def fake_send(*args, **kwargs):
+            batch = json.loads(kwargs["data"])["batch"]
+            if any(item["properties"].get("poison") for item in batch):
+                raise APIError(400, "bad event")
+            delivered.extend(item["idempotency_id"] for item in batch)
+
+        with mock.patch("lotus.consumer.send", side_effect=fake_send) as send:
+            assert not consumer.upload()
+
+        assert len(delivered) == 62
+        assert q.unfinished_tasks == 0
+        rejected = [call[0][1] for call in on_error.call_args_list]
+        assert rejected == [[_event(5, poison=True)], [_event(40, poison=True)]]
+        assert [call[0][0].items for call in dead_letter.add.call_args_list] == rejected
+        # 2 bad events among 64: at most 1 + 2 * 2 * log2(64) requests
+        assert send.call_count <= 1 + 2 * 2 * 6
+        assert consumer.metrics.snapshot()["batches_split"] >= 6
+
+    def test_oversized_batches_are_split(self):
+        q = Queue()
+        consumer = self._consumer(q)
+        for n in range(8):
+            q.put(_event(n))
+        sizes = []
+
+        def fake_send(*args, **kwargs):
+            batch = json.loads(kwargs["data"])["batch"]
+            if len(batch) > 2:
+                raise APIError(413, "too large")
+            sizes.append(len(batch))
+
+        with mock.patch("lotus.consumer.send", side_effect=fake_send):
+            consumer.upload()
+        assert sizes == [2, 2, 2, 2]
+        assert q.unfinished_tasks == 0
+
+    def test_other_client_errors_are_not_split(self):
+        q = Queue()
+        on_error = mock.Mock()
+        consumer = self._consumer(q, on_error=on_error)
+        for n in range(8):
+            q.put(_event(n))
+        with mock.patch("lotus.consumer.send", side_effect=APIError(401, "no")) as send:
+            consumer.upload()
+        assert send.call_count == 1
+        assert len(on_error.call_args[0][1]) == 8
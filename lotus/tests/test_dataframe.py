@@ -0,0 +1,145 @@
+import json
+from datetime import datetime
+
+import mock
+import pytest
+
+from lotus import Client
+from lotus.stub_server import StubServer
+
+pd = pytest.importorskip("pandas")
+
+
+@pytest.fixture
+def frame():
+    return pd.DataFrame(
+        {
+            "customer": [1, 2, 3],
+            "event": ["api_call", "api_call", "upload"],
+            "at": pd.to_datetime(
+                ["2023-01-01 10:00", "2023-01-02 00:00", "2023-01-03 00:00"]
+            ),
+            "count": [1, 2, 3],
+            "region": ["US", None, 'quote"d/'],
+            "latency": [0.125, float("nan"), 1.123456789012345],
+        }
+    )
+
+
+def _queued(client):
+    events = []
+    for queue in client.queues:
+        while not queue.empty():
+            events.append(json.loads(queue.get()))
+    return events
+
+
+class TestTrackDataframe:
+    def test_rows_are_queued_encoded(self, frame):
+        client = Client("api-key", send=False)
+        client.send = True
+        queued = client.track_dataframe(
+            frame, customer_col="customer", event_col="event", time_col="at"
+        )
+        assert queued == 3
+        events = _queued(client)
+        assert [e["customer_id"] for e in events] == ["1", "2", "3"]
+        assert events[0]["time_created"] == "2023-01-01T10:00:00.000000Z"
+        assert events[0]["$type"] == "track_event"
+        assert events[0]["properties"] == {
+            "count": 1,
+            "region": "US",
+            "latency": 0.125,
+        }
+        assert events[1]["properties"]["region"] is None
+        assert events[2]["properties"]["region"] == 'quote"d/'
+        assert events[2]["properties"]["latency"] == 1.123456789012345
+        assert len({e["idempotency_id"] for e in events}) == 3
+
+    def test_columns_and_chunks(self, frame):
+        client = Client("api-key", send=False, thread=2)
+        client.send = True
+        frame["id"] = ["a", "b", "c"]
+        queued = client.track_dataframe(
+            frame,
+            customer_col="customer",
+            event_col="event",
+            property_cols=["count"],
+            idempotency_col="id",
+            chunk_size=2,
+        )
+        assert queued == 3
+        events = sorted(_queued(client), key=lambda e: e["idempotency_id"])
+        assert [e["idempotency_id"] for e in events] == ["a", "b", "c"]
+        assert events[0]["properties"] == {"count": 1}
+        datetime.fromisoformat(events[0]["time_created"])
+
+    def test_validation(self, frame):
+        client = Client("api-key", send=False)
+        with pytest.raises(ValueError):
+            client.track_dataframe(frame, customer_col="missing")
+        frame["id"] = ["a", None, float("nan")]
+        with pytest.raises(ValueError, match="2 rows have no id"):
+            client.track_dataframe(
+                frame, customer_col="customer", event_col="event", idempotency_col="id"
+            )
+        frame.loc[1, "at"] = pd.NaT
+        with pytest.raises(ValueError, match="1 rows have no at"):
+            client.track_dataframe(
+                frame, customer_col="customer", event_col="event", time_col="at"
+            )
+        frame["at"] = ["2023-01-01", "2023-01-02", ""]
+        with pytest.raises(ValueError, match="1 rows have no at"):
+            # the bad row is in the last chunk, nothing is queued before
+            client.track_dataframe(
+                frame,
+                customer_col="customer",
+                event_col="event",
+                time_col="at",
+                chunk_size=1,
+            )
+        frame.loc[1, "customer"] = None
+        with pytest.raises(ValueError):
+            client.track_dataframe(frame, customer_col="customer", event_col="event")
+        assert all(queue.empty() for queue in client.queues)
+
+    def test_floats_keep_full_precision(self, frame):
+        client = Client("api-key", send=False)
+        client.send = True
+        frame["ratio"] = [1 / 3, float("inf"), 2 / 3]
+        client.track_dataframe(frame, customer_col="customer", event_col="event")
+        events = _queued(client)
+        assert events[0]["properties"]["ratio"] == 1 / 3
+        assert events[0]["properties"]["latency"] == 0.125
+        assert list(events[0]["properties"]) == [
+            "at",
+            "count",
+            "region",
+            "latency",
+            "ratio",
+        ]
+        assert events[1]["properties"]["latency"] is None
+        assert events[1]["properties"]["ratio"] is None
+        assert events[2]["properties"]["ratio"] == 2 / 3
+
+    def test_arrow_tables(self, frame):
+        pa = pytest.importorskip("pyarrow")
+        client = Client("api-key", send=False)
+        client.send = True
+        table = pa.Table.from_pandas(frame)
+        client.track_dataframe(table, customer_col="customer", event_col="event")
+        assert len(_queued(client)) == 3
+
+    def test_uploads(self, frame):
+        with mock.patch("lotus.consumer.send") as send:
+            client = Client("api-key", host="http://localhost")
+            client.track_dataframe(frame, customer_col="customer", event_col="event")
+            client.flush()
+            client.join()
+        batch = json.loads(send.call_args[1]["data"])["batch"]
+        assert [e["event_name"] for e in batch] == ["api_call", "api_call", "upload"]
+
+        with StubServer() as stub:
+            client = Client("api-key", host=stub.url, sync_mode=True)
+            client.track_dataframe(frame, customer_col="customer", event_col="event")
+        assert len(stub.requests[0][4]["batch"]) == 3
@@ -0,0 +1,119 @@
+import json
+
+import monotonic
+import pytest
+
+from lotus import Client
+from lotus.batch import BATCH_SIZE_LIMIT, Batch
+from lotus.dead_letter import DeadLetterStore
+from lotus.replay import main, replay
+from lotus.request import APIError
+from lotus.stub_server import StubServer
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "dead-letter.db")
+
+
+def _track(client, count):
+    for n in range(count):
+        client.track_event(
+            customer_id="c1", event_name="e", idempotency_id="event-%d" % n
+        )
+    client.flush()
+    client.join()
+
+
+class TestDeadLetter:
+    def test_failed_batches_are_stored_and_replayed(self, path):
+        with StubServer({"/api/track/": (503, {"detail": "down"})}) as stub:
+            client = Client("api-key", host=stub.url, dead_letter=path, max_retries=0)
+            _track(client, 5)
+
+        store = DeadLetterStore(path)
+        (letter,) = store.list()
+        assert letter.status == 503
+        assert letter.attempts == 1
+
+        with StubServer() as stub:
+            assert replay(store, "api-key", host=stub.url) == (1, 0)
+        _, path_, _, _, body = stub.requests[0]
+        assert path_ == "/api/track/"
+        assert [e["idempotency_id"] for e in body["batch"]] == [
+            "event-%d" % n for n in range(5)
+        ]
+        assert len(store) == 0
+
+    def test_failed_replays_stay_in_the_store(self, path):
+        store = DeadLetterStore(path)
+        with StubServer({"/api/track/": (400, {"detail": "bad"})}) as stub:
+            client = Client("api-key", host=stub.url, dead_letter=store)
+            _track(client, 1)
+            assert replay(store, "api-key", host=stub.url) == (0, 1)
+            # skipped, it has been tried twice already
+            assert replay(store, "api-key", host=stub.url, max_attempts=2) == (0, 0)
+        (letter,) = store.list()
+        assert letter.attempts == 2
+        assert letter.status == 400
+
+    def test_cli(self, path, capsys):
+        DeadLetterStore(path)
+        assert main([path, "--list"]) == 0
+        with StubServer() as stub:
+            assert main([path, "--api-key", "api-key", "--host", stub.url]) == 0
+        assert "delivered 0 batches, 0 failed" in capsys.readouterr().out
+
+    def test_large_batches_are_packed_again(self, path):
+        store = DeadLetterStore(path)
+        # a compressed batch may be far over the API's limit uncompressed
+        batch = Batch(max_size=20 * BATCH_SIZE_LIMIT)
+        for n in range(40):
+            batch.add({"idempotency_id": "event-%d" % n, "blob": "x" * 20000})
+        store.add(batch, APIError(503, "down"))
+        with StubServer() as stub:
+            assert replay(store, "api-key", host=stub.url) == (1, 0)
+        sizes = [len(json.dumps(body)) for *_, body in stub.requests]
+        assert len(sizes) == 2
+        assert all(size < 500000 for size in sizes)
+        ids = [e["idempotency_id"] for *_, body in stub.requests for e in body["batch"]]
+        assert ids == ["event-%d" % n for n in range(40)]
+
+    def test_rejected_batches_are_split(self, path):
+        store = DeadLetterStore(path)
+        batch = Batch()
+        for n in range(4):
+            batch.add({"idempotency_id": "event-%d" % n})
+        store.add(batch, APIError(503, "down"))
+
+        def track(method, path, query, body):
+            ids = [e["idempotency_id"] for e in body["batch"]]
+            return (400, {"detail": "bad"}) if "event-2" in ids else (200, {})
+
+        with StubServer({"/api/track/": track}) as stub:
+            assert replay(store, "api-key", host=stub.url) == (0, 1)
+        delivered = [
+            [e["idempotency_id"] for e in body["batch"]] for *_, body in stub.requests
+        ]
+        # the whole batch, its halves, then the rejected half's
+        assert delivered == [
+            ["event-0", "event-1", "event-2", "event-3"],
+            ["event-0", "event-1"],
+            ["event-2", "event-3"],
+            ["event-2"],
+            ["event-3"],
+        ]
+        (letter,) = store.list()
+        assert letter.status == 400
+
+    def test_replays_are_paced(self, path):
+        store = DeadLetterStore(path)
+        for n in range(3):
+            batch = Batch()
+            batch.add({"customer_id": "c1", "idempotency_id": "event-%d" % n})
+            store.add(batch, APIError(503, "down"))
+        with StubServer() as stub:
+            started = monotonic.monotonic()
+            assert replay(store, "api-key", host=stub.url, rate=10, workers=3) == (3, 0)
+        # the first right away, then one every 0.1s
+        assert 0.18 < monotonic.monotonic() - started < 1
@@ -0,0 +1,192 @@
+import json
+
+import mock
+import pytest
+
+from lotus.dead_letter import DeadLetterStore
+from lotus.import_events import Checkpoint, Importer, main, read_csv, read_ndjson
+from lotus.stub_server import StubServer
+
+
+def _events(body_lists):
+    return [event for body in body_lists for event in body]
+
+
+def _uploaded(stub):
+    return _events(body["batch"] for _, _, _, _, body in stub.requests)
+
+
+@pytest.fixture
+def ndjson(tmp_path):
+    path = tmp_path / "events.ndjson"
+    with open(path, "w") as f:
+        for n in range(100):
+            event = {
+                "customer_id": "c%d" % (n % 3),
+                "event_name": "api_call",
+                "time_created": "2023-01-01T00:00:00Z",
+                "tokens": n,
+            }
+            f.write(json.dumps(event) + "\n")
+    return str(path)
+
+
+class TestImportEvents:
+    def test_ndjson(self, ndjson, tmp_path):
+        checkpoint = str(tmp_path / "checkpoint")
+        with StubServer() as stub:
+            argv = [ndjson, "--api-key", "key", "--host", stub.url]
+            argv += ["--checkpoint", checkpoint, "--batch-events", "30"]
+            assert main(argv) == 0
+        assert len(stub.requests) == 4
+        events = _uploaded(stub)
+        assert sorted(e["properties"]["tokens"] for e in events) == list(range(100))
+        assert events[0]["customer_id"] == "c0"
+        assert events[0]["time_created"] == "2023-01-01T00:00:00Z"
+
+        with open(checkpoint) as f:
+            state = json.load(f)
+        assert state["events"] == 100
+        assert state["done"] == []
+        assert state["offset"] == len(open(ndjson, "rb").read())
+
+    def test_csv(self, tmp_path):
+        path = tmp_path / "events.csv"
+        path.write_text(
+            "user,name,time,tokens,note\n"
+            'c1,api_call,2023-01-01,5,"two\nlines"\n'
+            "c2,api_call,2023-01-02,1.5,\n"
+        )
+        with open(path, "rb") as f:
+            rows = list(read_csv(f, 0))
+        assert [(start, end) for start, end, _ in rows] == [(27, 64), (64, 92)]
+        assert rows[0][2]["note"] == "two\nlines"
+        assert rows[1][2]["tokens"] == "1.5"
+        assert rows[1][2]["note"] is None
+
+        with StubServer() as stub:
+            importer = Importer(
+                "key",
+                host=stub.url,
+                customer_col="user",
+                event_col="name",
+                time_col="time",
+                property_cols=["tokens"],
+            )
+            with open(path, "rb") as f:
+                importer.run(read_csv(f, 0))
+        events = _uploaded(stub)
+        assert [e["properties"] for e in events] == [{"tokens": 5}, {"tokens": 1.5}]
+        assert importer.uploaded == 2
+
+    def test_csv_ids_stay_strings(self, tmp_path):
+        path = tmp_path / "events.csv"
+        path.write_text(
+            "customer_id,event_name,time_created,idempotency_id,tokens\n"
+            "007,api_call,2023-01-01,1e5,007\n"
+        )
+        with StubServer() as stub:
+            with open(path, "rb") as f:
+                Importer("key", host=stub.url).run(read_csv(f, 0))
+        (event,) = _uploaded(stub)
+        assert event["customer_id"] == "007"
+        assert event["idempotency_id"] == "1e5"
+        assert event["properties"] == {"tokens": 7}
+
+    def test_resume(self, ndjson, tmp_path):
+        with open(ndjson, "rb") as f:
+            offsets = [start for start, _, _ in read_ndjson(f, 0)]
+        # the first 10 rows and rows 50 to 59 were uploaded before a crash
+        checkpoint = Checkpoint(str(tmp_path / "checkpoint"))
+        checkpoint.complete(offsets[0], offsets[10], 10)
+        checkpoint.complete(offsets[50], offsets[60], 10)
+        assert checkpoint.offset == offsets[10]
+
+        with StubServer() as stub:
+            importer = Importer("key", host=stub.url, checkpoint=checkpoint)
+            with open(ndjson, "rb") as f:
+                importer.run(read_ndjson(f, checkpoint.offset))
+        tokens = sorted(e["properties"]["tokens"] for e in _uploaded(stub))
+        assert tokens == list(range(10, 50)) + list(range(60, 100))
+        assert checkpoint.done == {}
+        assert Checkpoint(checkpoint.path).events == 100
+
+    def test_idempotency_ids_are_stable(self, ndjson):
+        ids = []
+        for _ in range(2):
+            with StubServer() as stub:
+                importer = Importer("key", host=stub.url, id_prefix="events")
+                with open(ndjson, "rb") as f:
+                    importer.run(read_ndjson(f, 0))
+            ids.append(sorted(e["idempotency_id"] for e in _uploaded(stub)))
+        assert ids[0] == ids[1]
+        assert len(set(ids[0])) == 100
+
+    def test_oversized_rows_are_skipped(self, tmp_path):
+        path = tmp_path / "events.ndjson"
+        row = '{"customer_id": "c1", "event_name": "e", "time_created": "2023"%s}\n'
+        path.write_text(row % (', "blob": "%s"' % ("x" * 600000)) + row % "")
+        checkpoint = Checkpoint(str(tmp_path / "checkpoint"))
+        with StubServer() as stub:
+            importer = Importer("key", host=stub.url, checkpoint=checkpoint)
+            with open(path, "rb") as f:
+                importer.run(read_ndjson(f, 0))
+        assert (importer.uploaded, importer.invalid) == (1, 1)
+        assert checkpoint.offset == len(path.read_bytes())
+
+    def test_upload_errors_are_raised(self, ndjson):
+        importer = Importer("key", host="http://localhost")
+        with mock.patch.object(importer, "upload", side_effect=RuntimeError("bug")):
+            with open(ndjson, "rb") as f:
+                with pytest.raises(RuntimeError):
+                    importer.run(read_ndjson(f, 0))
+
+    def test_idempotency_ids_differ_between_files(self, tmp_path):
+        ids = []
+        for name in ("a", "b"):
+            path = tmp_path / name / "events.ndjson"
+            path.parent.mkdir()
+            path.write_text(
+                '{"customer_id": "%s", "event_name": "e", "time_created": "2023"}\n'
+                % name
+            )
+            with StubServer() as stub:
+                with open(path, "rb") as f:
+                    Importer("key", host=stub.url).run(read_ndjson(f, 0))
+            ids.extend(e["idempotency_id"] for e in _uploaded(stub))
+        assert len(set(ids)) == 2
+
+    def test_failures(self, ndjson, tmp_path):
+        store = DeadLetterStore(str(tmp_path / "dead-letter.db"))
+        with StubServer({"/api/track/": (400, {"detail": "bad"})}) as stub:
+            # failed batches are not checkpointed without a dead letter store
+            importer = Importer("key", host=stub.url, batch_events=50)
+            with open(ndjson, "rb") as f:
+                importer.run(read_ndjson(f, 0))
+            assert importer.failed == 100
+            assert importer.checkpoint.offset == 0
+
+            importer = Importer(
+                "key", host=stub.url, batch_events=50, dead_letter=store
+            )
+            with open(ndjson, "rb") as f:
+                importer.run(read_ndjson(f, 0))
+        assert len(store) == 2
+        assert importer.checkpoint.offset > 0
+
+    def test_invalid_rows_are_skipped(self, tmp_path):
+        path = tmp_path / "events.ndjson"
+        path.write_text(
+            '{"customer_id": "c1", "event_name": "e", "time_created": "2023"}\n'
+            '{"customer_id": "c1"}\n'
+            '{"customer_id": "c2", "event_name": \n'
+            "[1, 2]\n"
+            '{"customer_id": "c3", "event_name": "e", "time_created": "2023"}\n'
+        )
+        with StubServer() as stub:
+            importer = Importer("key", host=stub.url)
+            with open(path, "rb") as f:
+                importer.run(read_ndjson(f, 0))
+        assert (importer.uploaded, importer.invalid) == (2, 3)
+        assert [e["customer_id"] for e in _uploaded(stub)] == ["c1", "c3"]
+        assert importer.checkpoint.offset == len(path.read_bytes())
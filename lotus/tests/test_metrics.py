@@ -0,0 +1,95 @@
+from queue import Full
+
+import mock
+
+from lotus import Client
+from lotus.metrics import SIZE_BOUNDS, Histogram, Metrics, TimedQueue
+from lotus.request import APIError
+from lotus.spool import SpoolQueue
+
+
+class TestMetrics:
+    def test_histogram_percentiles(self):
+        histogram = Histogram(SIZE_BOUNDS)
+        for n in range(1, 101):
+            histogram.observe(n)
+        stats = histogram.snapshot()
+        assert stats["count"] == 100
+        assert stats["min"] == 1 and stats["max"] == 100
+        assert stats["mean"] == 50.5
+        assert stats["p50"] == 64
+        assert stats["p99"] == 100
+
+    def test_snapshot_merges_counters_and_histograms(self):
+        metrics = Metrics()
+        metrics.incr("enqueued")
+        metrics.incr("enqueued", 2)
+        metrics.observe("upload_seconds", 0.01)
+        stats = metrics.snapshot()
+        assert stats["enqueued"] == 3
+        assert stats["upload_seconds"]["count"] == 1
+
+    def test_oldest_age(self, tmp_path):
+        for queue in (TimedQueue(), SpoolQueue(str(tmp_path / "queue.db"))):
+            assert queue.oldest_age() is None
+            with mock.patch("monotonic.monotonic", return_value=100.0):
+                queue.put({"n": 1})
+            with mock.patch("monotonic.monotonic", return_value=102.0):
+                queue.put({"n": 2})
+            with mock.patch("monotonic.monotonic", return_value=105.0):
+                assert queue.oldest_age() == 5.0
+                queue.get()
+                assert queue.oldest_age() == 3.0
+                queue.get()
+                assert queue.oldest_age() is None
+
+
+class TestClientStats:
+    def test_stats_cover_the_pipeline(self):
+        with mock.patch("lotus.consumer.send") as send:
+            client = Client("api-key", host="http://localhost", flush_at=10)
+            for n in range(25):
+                client.track_event(
+                    customer_id="c1", event_name="test_event", properties={"n": n}
+                )
+            client.flush()
+            client.join()
+
+        assert send.call_count == 3
+        stats = client.stats()
+        assert stats["enqueued"] == 25
+        assert stats["events_uploaded"] == 25
+        assert stats["batch_events"]["count"] == 3
+        assert stats["batch_events"]["max"] == 10
+        assert stats["batch_bytes"]["sum"] > 0
+        assert stats["upload_seconds"]["count"] == 3
+        assert stats["queue_depth"] == 0
+        assert stats["oldest_event_age"] is None
+
+    def test_drops_and_retries(self):
+        client = Client("api-key", send=False)
+        client.send = True
+        with mock.patch.object(client.queue, "put", side_effect=Full):
+            assert client.track_event(customer_id="c1", event_name="e")[0] is False
+        assert client.stats()["dropped"] == 1
+
+        consumer = client.consumers[0]
+        consumer.backoff_base = 0
+        with mock.patch("lotus.consumer.send", side_effect=APIError(500, "error")):
+            client.queue.put({"customer_id": "c1"})
+            consumer.upload()
+            consumer.retry_lane.stop()
+        stats = client.stats()
+        assert 1 <= stats["retries"] < consumer.retries
+        assert stats["events_failed"] == 1
+        assert stats["upload_seconds"]["count"] == stats["retries"] + 1
+        assert stats["batch_events"]["count"] == 1
+
+    def test_stats_callback(self):
+        reports = []
+        client = Client(
+            "api-key", send=False, stats_callback=reports.append, stats_interval=60
+        )
+        client.join()
+        assert len(reports) == 1
+        assert reports[0]["queue_depth"] == 0
@@ -0,0 +1,148 @@
+import threading
+import time
+from email.utils import formatdate
+
+import mock
+import monotonic
+import pytest
+
+from lotus import Client
+from lotus.ratelimit import RateLimiter
+from lotus.request import APIError, check_response
+from lotus.stub_server import StubServer
+
+
+def _response(status, headers):
+    return mock.Mock(status_code=status, headers=headers, json=lambda: {})
+
+
+class TestRetryAfter:
+    def test_seconds(self):
+        with pytest.raises(APIError) as info:
+            check_response(_response(429, {"Retry-After": "2"}))
+        assert info.value.retry_after == 2
+
+    def test_http_date(self):
+        with pytest.raises(APIError) as info:
+            check_response(
+                _response(
+                    503, {"Retry-After": formatdate(time.time() + 30, usegmt=True)}
+                )
+            )
+        assert 25 < info.value.retry_after <= 30
+
+    def test_missing(self):
+        for status, headers in ((429, {}), (500, {"Retry-After": "2"})):
+            with pytest.raises(APIError) as info:
+                check_response(_response(status, headers))
+            assert info.value.retry_after is None
+
+
+class TestRateLimiter:
+    def test_requests_per_second(self):
+        limiter = RateLimiter(requests_per_second=20, burst=0)
+        started = monotonic.monotonic()
+        for _ in range(11):
+            limiter.acquire()
+        assert 0.45 < monotonic.monotonic() - started < 0.8
+
+    def test_bytes_per_second(self):
+        limiter = RateLimiter(bytes_per_second=10000, burst=0.1)
+        started = monotonic.monotonic()
+        limiter.acquire(1000)
+        assert monotonic.monotonic() - started < 0.05
+        limiter.acquire(3000)
+        assert 0.25 < monotonic.monotonic() - started < 0.5
+        # the bucket is empty again
+        assert limiter.acquire(1000, block=False) == pytest.approx(0.1, abs=0.02)
+
+    def test_one_request_goes_first_after_a_pause(self):
+        limiter = RateLimiter()
+        limiter.pause(0.2)
+        started = monotonic.monotonic()
+        times = []
+
+        def request():
+            limiter.acquire()
+            times.append(monotonic.monotonic() - started)
+            time.sleep(0.1)
+            limiter.release()
+
+        threads = [threading.Thread(target=request) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        times.sort()
+        assert times[0] >= 0.2
+        # the others waited for the first one's answer
+        assert times[1] - times[0] >= 0.1
+        assert times[2] - times[1] < 0.05
+
+    def test_retry_after_pauses(self):
+        limiter = RateLimiter()
+        limiter.release(APIError(429, "rate limited", retry_after=0.2))
+        assert limiter.acquire() >= 0.2
+        # the first request after the pause failed again
+        limiter.release(APIError(429, "rate limited", retry_after=0.1))
+        limiter.release(APIError(500, "error"))
+        assert limiter.acquire() >= 0.1
+
+    def test_retry_after_is_capped(self):
+        limiter = RateLimiter(max_pause=0.1)
+        limiter.release(APIError(429, "rate limited", retry_after=3600))
+        assert limiter.acquire() < 0.2
+
+    def test_invalid_rates(self):
+        with pytest.raises(ValueError):
+            RateLimiter(requests_per_second=0)
+
+
+class TestClientRateLimit:
+    def test_blocking_calls_wait_for_retry_after(self):
+        with StubServer(throttle_rate=1, retry_after=0.3) as stub:
+            client = Client("api-key", host=stub.url)
+            with pytest.raises(APIError) as info:
+                client.list_plans()
+            assert info.value.retry_after == 0.3
+            stub.throttle_rate = 0
+            started = monotonic.monotonic()
+            client.list_plans()
+            assert monotonic.monotonic() - started >= 0.25
+        assert client.stats()["rate_limit_pauses"] == 1
+
+    def test_consumers_share_the_pause(self):
+        with StubServer(throttle_rate=1, retry_after=0.3) as stub:
+            times = []
+            respond = stub.respond
+
+            def timed(*args):
+                times.append(monotonic.monotonic())
+                try:
+                    return respond(*args)
+                finally:
+                    stub.throttle_rate = 0
+
+            stub.respond = timed
+            client = Client(
+                "api-key", host=stub.url, thread=4, flush_interval=0.01, max_retries=3
+            )
+            client.track_event(customer_id="c0", event_name="e")
+            while not client.stats().get("rate_limit_pauses"):
+                time.sleep(0.01)
+            for n in range(1, 20):
+                client.track_event(customer_id="c%d" % n, event_name="e")
+            client.flush()
+        stats = client.stats()
+        assert stats["events_uploaded"] == 20
+        assert stats["retries"] == 1
+        assert all(t - times[0] >= 0.3 for t in times[1:])
+
+    def test_requests_per_second(self):
+        with StubServer() as stub:
+            client = Client("api-key", host=stub.url, requests_per_second=10)
+            started = monotonic.monotonic()
+            for _ in range(13):
+                client.list_plans()
+            # a burst of 10 requests, then 10 per second
+            assert monotonic.monotonic() - started >= 0.25
@@ -0,0 +1,98 @@
+import errno
+import json
+import os
+import uuid
+from queue import Empty, Full
+
+import pytest
+
+from lotus import Client
+from lotus.shared_queue import SharedQueue
+from lotus.stub_server import StubServer
+
+
+@pytest.fixture
+def queue(request, tmp_path):
+    queue = SharedQueue(
+        "lotus-test-%s" % uuid.uuid4().hex[:12],
+        size=getattr(request, "param", 4096),
+        create=True,
+        lock_path=str(tmp_path / "lock"),
+    )
+    yield queue
+    queue.close()
+    queue.unlink()
+
+
+class TestSharedQueue:
+    def test_put_and_get_wrap_around_the_ring(self, queue):
+        expected = []
+        for n in range(2000):
+            item = {"n": n, "pad": "x" * (n % 50)}
+            queue.put(item)
+            expected.append(item)
+            if len(expected) > 20:
+                assert json.loads(queue.get()) == expected.pop(0)
+        while expected:
+            assert json.loads(queue.get(block=False)) == expected.pop(0)
+        with pytest.raises(Empty):
+            queue.get(timeout=0.01)
+        assert queue.qsize() == 0
+
+    def test_full(self, queue):
+        queued = queue.put_many([b"x" * 100] * 100)
+        assert 0 < queued < 100
+        with pytest.raises(Full):
+            queue.put(b"x" * 100)
+        queue.get()
+        queue.put(b"x" * 100)
+
+    def test_symlinked_lock_file_is_refused(self, queue, tmp_path):
+        os.symlink(str(tmp_path / "target"), str(tmp_path / "link"))
+        with pytest.raises(OSError) as excinfo:
+            SharedQueue(queue.name, lock_path=str(tmp_path / "link"))
+        assert excinfo.value.errno == errno.ELOOP
+        assert not (tmp_path / "target").exists()
+
+    def test_attach_by_name(self, queue):
+        other = SharedQueue(queue.name, lock_path=queue.lock_path)
+        other.put({"a": 1})
+        assert queue.qsize() == 1
+        assert json.loads(queue.get()) == {"a": 1}
+        other.close()
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+    @pytest.mark.parametrize("queue", [1 << 20], indirect=True)
+    def test_workers_share_one_uploader(self, queue):
+        with StubServer() as stub:
+            client = Client(
+                "api-key",
+                host=stub.url,
+                shared_queue=queue,
+                shared_queue_upload=True,
+                flush_interval=0.2,
+            )
+            pids = []
+            for worker in range(4):
+                pid = os.fork()
+                if pid == 0:
+                    code = 1
+                    try:
+                        assert client.consumers == []
+                        for n in range(10):
+                            client.track_event(
+                                customer_id="c%d" % worker, event_name="e"
+                            )
+                        client.flush()
+                        code = 0
+                    finally:
+                        os._exit(code)
+                pids.append(pid)
+            for pid in pids:
+                _, status = os.waitpid(pid, 0)
+                assert os.waitstatus_to_exitcode(status) == 0
+            client.flush()
+            client.join()
+        events = [e for *_, body in stub.requests for e in body["batch"]]
+        assert len(events) == 40
+        assert len(stub.requests) < 4
@@ -0,0 +1,152 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from queue import Empty
+
+import mock
+import pytest
+
+from lotus import Client
+from lotus.consumer import Consumer
+from lotus.request import APIError
+from lotus.spool import SpoolQueue
+
+
+def _event(n):
+    return {"customer_id": "customer-%d" % n, "idempotency_id": "event-%d" % n}
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "queue.db")
+
+
+class TestSpoolQueue:
+    def test_get_returns_encoded_items_in_order(self, path):
+        q = SpoolQueue(path)
+        for n in range(3):
+            q.put(_event(n))
+        assert q.qsize() == 3
+        entries = [q.get(block=False) for _ in range(3)]
+        assert [json.loads(e.data) for e in entries] == [_event(n) for n in range(3)]
+        assert q.qsize() == 0
+        with pytest.raises(Empty):
+            q.get(block=False)
+
+    def test_unacknowledged_items_are_replayed(self, path):
+        q = SpoolQueue(path)
+        for n in range(5):
+            q.put(_event(n))
+        entries = [q.get(block=False) for _ in range(5)]
+        q.ack([e.rowid for e in entries[:2]])
+        q.sync()
+
+        replayed = SpoolQueue(path)
+        assert replayed.qsize() == 3
+        assert replayed.unfinished_tasks == 3
+        entries = [replayed.get(block=False) for _ in range(3)]
+        assert [json.loads(e.data) for e in entries] == [_event(n) for n in (2, 3, 4)]
+
+    def test_uncommitted_items_are_written_by_sync(self, path):
+        q = SpoolQueue(path, commit_every=100, commit_interval=60)
+        q.put(_event(0))
+        assert SpoolQueue(path).qsize() == 0
+        q.sync()
+        assert SpoolQueue(path).qsize() == 1
+
+    def test_idle_items_are_committed_in_the_background(self, path):
+        q = SpoolQueue(path, commit_every=100, commit_interval=0.05)
+        q.put(_event(0))
+        q.put(_event(1))
+        deadline = time.time() + 2
+        while SpoolQueue(path).qsize() < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert SpoolQueue(path).qsize() == 2
+
+
+class TestSpooledConsumer:
+    def test_uploaded_batches_are_removed(self, path):
+        q = SpoolQueue(path)
+        q.put(_event(0))
+        consumer = Consumer(q, "api-key", flush_interval=0.1)
+        with mock.patch("lotus.consumer.send"):
+            assert consumer.upload()
+        assert SpoolQueue(path).qsize() == 0
+
+    def test_failed_batches_are_kept_for_replay(self, path):
+        q = SpoolQueue(path)
+        q.put(_event(0))
+        consumer = Consumer(q, "api-key", flush_interval=0.1, retries=0)
+        with mock.patch("lotus.consumer.send", side_effect=APIError(503, "down")):
+            assert not consumer.upload()
+        q.join()
+        assert SpoolQueue(path).qsize() == 1
+
+    def test_rejected_batches_are_removed(self, path):
+        q = SpoolQueue(path)
+        q.put(_event(0))
+        consumer = Consumer(q, "api-key", flush_interval=0.1, retries=0)
+        with mock.patch("lotus.consumer.send", side_effect=APIError(400, "bad")):
+            assert not consumer.upload()
+        assert SpoolQueue(path).qsize() == 0
+
+    def test_client_spools_and_replays(self, tmp_path):
+        spool_dir = str(tmp_path / "spool")
+        client = Client("api-key", send=False, spool_dir=spool_dir, thread=2)
+        # with send=False nothing is queued, so fill the shards directly
+        for n in range(10):
+            client._shard(str(n)).put(_event(n))
+        client.join()
+        assert os.path.exists(os.path.join(spool_dir, "queue-1.db"))
+
+        with mock.patch("lotus.consumer.send") as send:
+            client = Client(
+                "api-key", host="http://localhost", spool_dir=spool_dir, thread=2
+            )
+            client.flush()
+            client.join()
+        uploaded = [
+            e
+            for call in send.call_args_list
+            for e in json.loads(call[1]["data"])["batch"]
+        ]
+        assert sorted(e["idempotency_id"] for e in uploaded) == sorted(
+            "event-%d" % n for n in range(10)
+        )
+
+    def test_client_replays_the_spools_of_exited_children(self, tmp_path):
+        spool_dir = tmp_path / "spool"
+        spool_dir.mkdir()
+        exited = subprocess.Popen([sys.executable, "-c", "pass"])
+        exited.wait()
+        for pid, first in ((exited.pid, 0), (os.getpid(), 10)):
+            q = SpoolQueue(str(spool_dir / ("queue-1-%d.db" % pid)))
+            for n in range(first, first + 3):
+                q.put(_event(n))
+            q.sync()
+
+        client = Client("api-key", send=False, spool_dir=str(spool_dir), thread=2)
+        assert client.queues[0].qsize() == 0
+        replayed = [json.loads(client.queues[1].get().data) for _ in range(3)]
+        assert replayed == [_event(n) for n in range(3)]
+        names = os.listdir(str(spool_dir))
+        assert "queue-1-%d.db" % exited.pid not in names
+        # the live process keeps its own
+        assert "queue-1-%d.db" % os.getpid() in names
+
+    def test_client_replays_shards_it_no_longer_runs(self, tmp_path):
+        spool_dir = str(tmp_path / "spool")
+        client = Client("api-key", send=False, spool_dir=spool_dir, thread=3)
+        for n in range(3):
+            client.queues[n].put(_event(n))
+        client.join()
+
+        client = Client("api-key", send=False, spool_dir=spool_dir, thread=1)
+        replayed = [json.loads(client.queue.get().data) for _ in range(3)]
+        assert sorted(e["idempotency_id"] for e in replayed) == [
+            "event-%d" % n for n in range(3)
+        ]
+        assert sorted(os.listdir(spool_dir))[0] == "queue-0.db"
+        assert not [name for name in os.listdir(spool_dir) if "queue-2" in name]
@@ -0,0 +1,53 @@
+import pytest
+import requests
+
+from lotus import Client
+from lotus.request import APIError
+from lotus.stub_server import StubServer
+
+
+@pytest.fixture
+def stub():
+    with StubServer() as server:
+        yield server
+
+
+class TestStubServer:
+    def test_answers_every_client_operation(self, stub):
+        client = Client("api-key", host=stub.url, sync_mode=True, gzip=True)
+        assert client.track_event(customer_id="c1", event_name="e")
+        assert client.list_customers()[0]["customer_id"] == "customer-1"
+        assert client.get_customer(customer_id="c1")["customer_id"] == "c1"
+        client.create_customer(customer_id="c2", customer_name="C", email="a@b.co")
+        assert client.list_credits(customer_id="c1")[0]["credit_id"] == "credit-1"
+        client.create_credit(customer_id="c1", amount=10, currency_code="USD")
+        client.list_subscriptions(customer_id="c1")
+        client.cancel_subscription(subscription_id="s1")
+        assert len(client.list_plans()) == 1
+        assert client.get_plan(plan_id="p1")["plan_id"] == "plan-1"
+        client.get_customer_metric_access(customer_id="c1", metric_id="m1")
+        client.get_customer_feature_access(customer_id="c1", feature_name="f")
+        assert client.check_feature_access(customer_id="c1", feature_id="f1")["access"]
+        assert client.check_metric_access(customer_id="c1", metric_id="m1")["access"]
+
+        _, path, _, _, body = stub.requests[0]
+        assert path == "/api/track/"
+        assert body["event_name"] == "e"
+
+    def test_errors_and_throttling(self):
+        with StubServer(error_rate=1) as stub:
+            client = Client("api-key", host=stub.url, sync_mode=True)
+            with pytest.raises(APIError) as exc:
+                client.get_plan(plan_id="p1")
+            assert exc.value.status == 500
+
+        with StubServer(throttle_rate=1, retry_after=3) as stub:
+            res = requests.get(stub.url + "/api/plans/")
+            assert res.status_code == 429
+            assert res.headers["Retry-After"] == "3"
+
+    def test_latency(self):
+        with StubServer(latency=0.1, record=False) as stub:
+            res = requests.get(stub.url + "/api/ping/")
+        assert res.elapsed.total_seconds() >= 0.1
+        assert stub.requests == []
@@ -0,0 +1,93 @@
+import os
+import stat
+import tempfile
+from decimal import Decimal
+
+import pytest
+
+from lotus.utils import clean, runtime_dir
+
+
+class Unsupported(object):
+    pass
+
+
+class TestClean:
+    def test_clean_values_are_not_copied(self):
+        properties = {"a": 1, "b": [1, "x", None], "c": {"d": 1.5, "e": True}}
+        cleaned = clean(properties)
+        assert cleaned is properties
+        assert cleaned["b"] is properties["b"]
+
+    def test_only_changed_containers_are_copied(self):
+        properties = {"a": {"b": Decimal("1.5")}, "c": {"d": 1}, "e": (1, 2)}
+        cleaned = clean(properties)
+        assert cleaned == {"a": {"b": 1.5}, "c": {"d": 1}, "e": [1, 2]}
+        assert properties["a"]["b"] == Decimal("1.5")
+        assert cleaned["c"] is properties["c"]
+
+    def test_copy(self):
+        properties = {"a": 1, "b": [1, {"c": 2}], "d": {"e": [3]}, "f": (4,)}
+        cleaned = clean(properties, copy=True)
+        assert cleaned == {"a": 1, "b": [1, {"c": 2}], "d": {"e": [3]}, "f": [4]}
+        assert cleaned is not properties
+        assert cleaned["b"] is not properties["b"]
+        assert cleaned["b"][1] is not properties["b"][1]
+        assert cleaned["d"]["e"] is not properties["d"]["e"]
+        flat = {"a": 1}
+        assert clean(flat, copy=True) == flat
+        assert clean(flat, copy=True) is not flat
+
+    def test_unsupported_values_are_dropped(self):
+        properties = {"a": Unsupported(), "b": [1, [Unsupported()]], "c": {"d": 1}}
+        assert clean(properties) == {"c": {"d": 1}}
+        with pytest.raises(TypeError):
+            clean([Unsupported()])
+
+    def test_deep_nesting(self):
+        properties = value = {}
+        for _ in range(5000):
+            value["next"] = value = {"n": Decimal(1)}
+        cleaned = clean(properties)
+        for _ in range(5000):
+            cleaned = cleaned["next"]
+            assert cleaned["n"] == 1.0
+
+    def test_circular_reference(self):
+        properties = {"a": []}
+        properties["a"].append(properties)
+        with pytest.raises(ValueError):
+            clean(properties)
+
+
+class TestRuntimeDir:
+    def test_xdg_runtime_dir(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+        assert runtime_dir() == str(tmp_path)
+
+    def test_private_directory_is_created(self, monkeypatch, tmp_path):
+        monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+        monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+        path = runtime_dir()
+        assert path == str(tmp_path / ("lotus-%d" % os.getuid()))
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+        assert runtime_dir() == path
+
+    def test_shared_directory_is_refused(self, monkeypatch, tmp_path):
+        monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+        monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+        path = tmp_path / ("lotus-%d" % os.getuid())
+        path.mkdir()
+        path.chmod(0o777)
+        with pytest.raises(PermissionError):
+            runtime_dir()
+
+    def test_symlink_is_refused(self, monkeypatch, tmp_path):
+        monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+        monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+        (tmp_path / "elsewhere").mkdir(mode=0o700)
+        os.symlink(
+            str(tmp_path / "elsewhere"), str(tmp_path / ("lotus-%d" % os.getuid()))
+        )
+        with pytest.raises(PermissionError):
+            runtime_dir()
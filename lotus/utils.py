@@ -1,5 +1,9 @@
 import logging
 import numbers
+import os
+import stat
+import tempfile
+import uuid
 from datetime import date, datetime
 from decimal import Decimal
 from enum import Enum
@@ -38,45 +42,205 @@ def guess_timezone(dt):
     return dt
 
 
+def runtime_dir(create=True):
+    """Return a directory only the current user can use, for sockets and locks.
+
+    That is `$XDG_RUNTIME_DIR` when set, or else a `lotus-<uid>` directory
+    in the temporary directory, created with mode 0700 when `create` is
+    set. PermissionError is raised if the latter exists but belongs to
+    another user, or others may write to it.
+    """
+    path = os.environ.get("XDG_RUNTIME_DIR")
+    if path and os.path.isdir(path):
+        return path
+    path = os.path.join(tempfile.gettempdir(), "lotus-%d" % os.getuid())
+    if not create:
+        return path
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or info.st_mode & 0o077
+    ):
+        raise PermissionError("%s is not a private directory" % path)
+    return path
+
+
 def remove_trailing_slash(host):
     if host.endswith("/"):
         return host[:-1]
     return host
 
 
-def clean(item):
+# how `clean` treats a value, looked up by its exact type
+_PLAIN, _DECIMAL, _DICT, _MAPPING, _LIST, _SEQUENCE, _OTHER = range(7)
+_KINDS = {
+    str: _PLAIN,
+    bool: _PLAIN,
+    int: _PLAIN,
+    float: _PLAIN,
+    type(None): _PLAIN,
+    datetime: _PLAIN,
+    date: _PLAIN,
+    Decimal: _DECIMAL,
+    dict: _DICT,
+    list: _LIST,
+    tuple: _SEQUENCE,
+    set: _SEQUENCE,
+}
+_PLAIN_TYPES = frozenset(t for t, kind in _KINDS.items() if kind is _PLAIN)
+
+
+def _kind(item):
+    kind = _KINDS.get(type(item))
+    if kind is not None:
+        return kind
     if isinstance(item, Decimal):
-        return float(item)
+        kind = _DECIMAL
     elif isinstance(
         item, (six.string_types, bool, numbers.Number, datetime, date, type(None))
     ):
-        return item
+        kind = _PLAIN
     elif isinstance(item, (set, list, tuple)):
-        return _clean_list(item)
+        kind = _SEQUENCE
     elif isinstance(item, dict):
-        return _clean_dict(item)
+        kind = _MAPPING
     else:
+        kind = _OTHER
+    _KINDS[type(item)] = kind
+    return kind
+
+
+def clean(item, copy=False):
+    """Return `item` with its values converted to types JSON can encode.
+
+    Decimals become floats, sets and tuples lists, and bytes strings. Dict
+    values that cannot be converted are dropped with a warning. Lists and
+    dicts that need no change are returned as they are rather than copied,
+    so the result may share them with `item`, and changes the caller makes
+    to them later show in the result. With `copy`, every list and dict is
+    copied, so that the result shares none with `item`.
+    """
+    kind = _KINDS.get(type(item))
+    if kind is None:
+        kind = _kind(item)
+    if kind is _PLAIN:
+        return item
+    if kind is _DECIMAL:
+        return float(item)
+    if kind is _OTHER:
         return _coerce_unicode(item)
+    if kind is _DICT and _PLAIN_TYPES.issuperset(map(type, item.values())):
+        return dict(item) if copy else item
+    return _clean_container(item, kind, copy)
 
 
-def _clean_list(list_):
-    return [clean(item) for item in list_]
+class _Frame(object):
+    """A list or dict being cleaned, `copy` is set once a value changes.
 
+    With `always_copy`, it is set from the start.
+    """
 
-def _clean_dict(dict_):
-    data = {}
-    for k, v in six.iteritems(dict_):
-        try:
-            data[k] = clean(v)
-        except TypeError:
-            log.warning(
-                "Dictionary values must be serializeable to "
-                'JSON "%s" value %s of type %s is unsupported.',
-                k,
-                v,
-                type(v),
-            )
-    return data
+    __slots__ = ("source", "is_dict", "values", "copy", "key")
+
+    def __init__(self, source, kind, key, always_copy=False):
+        self.source = source
+        self.is_dict = kind in (_DICT, _MAPPING)
+        self.key = key
+        if kind is _DICT:
+            self.copy = dict(source) if always_copy else None
+            self.values = iter(source.items())
+        elif kind is _MAPPING:
+            self.copy = dict(source)
+            self.values = iter(source.items())
+        elif kind is _LIST:
+            self.copy = list(source) if always_copy else None
+            self.values = enumerate(source)
+        else:
+            self.copy = list(source)
+            self.values = enumerate(self.copy)
+
+    def set(self, key, value):
+        if self.copy is None:
+            self.copy = dict(self.source) if self.is_dict else list(self.source)
+        self.copy[key] = value
+
+    def drop(self, key):
+        if self.copy is None:
+            self.copy = dict(self.source)
+        del self.copy[key]
+
+    def result(self):
+        return self.source if self.copy is None else self.copy
+
+
+def _clean_container(root, kind, copy=False):
+    # an explicit stack, nested values can be deeper than the recursion limit
+    stack = [_Frame(root, kind, None, copy)]
+    path = {id(root)}
+    while stack:
+        frame = stack[-1]
+        for key, value in frame.values:
+            kind = _KINDS.get(type(value))
+            if kind is None:
+                kind = _kind(value)
+            if kind is _PLAIN:
+                continue
+            if kind is _DECIMAL:
+                frame.set(key, float(value))
+            elif kind is _OTHER:
+                try:
+                    frame.set(key, _coerce_unicode(value))
+                except TypeError:
+                    if not _unwind(stack, path, key, value):
+                        raise
+                    break
+            elif kind is _DICT and _PLAIN_TYPES.issuperset(map(type, value.values())):
+                if copy:
+                    frame.set(key, dict(value))
+            elif kind is _LIST and _PLAIN_TYPES.issuperset(map(type, value)):
+                if copy:
+                    frame.set(key, list(value))
+            else:
+                if id(value) in path:
+                    raise ValueError("Circular reference detected")
+                path.add(id(value))
+                stack.append(_Frame(value, kind, key, copy))
+                break
+        else:
+            stack.pop()
+            path.discard(id(frame.source))
+            if not stack:
+                return frame.result()
+            if frame.copy is not None:
+                stack[-1].set(frame.key, frame.copy)
+
+
+def _unwind(stack, path, key, value):
+    """Drop the value that failed to convert from the closest dict.
+
+    Lists between the value and the dict are dropped whole, as when the
+    error went up the recursive calls. Return False if there is no dict.
+    """
+    while not stack[-1].is_dict:
+        frame = stack.pop()
+        path.discard(id(frame.source))
+        if not stack:
+            return False
+        key, value = frame.key, frame.source
+    log.warning(
+        "Dictionary values must be serializeable to "
+        'JSON "%s" value %s of type %s is unsupported.',
+        key,
+        value,
+        type(value),
+    )
+    stack[-1].drop(key)
+    return True
 
 
 def _coerce_unicode(cmplx):
@@ -95,3 +259,45 @@ class HTTPMethod(Enum):
     POST = "POST"
     PATCH = "PATCH"
     DELETE = "DELETE"
+
+
+def uuid4_strings(chunk=1 << 16):
+    """Yield unique ids shaped like `str(uuid.uuid4())`, several times cheaper.
+
+    Each id is the first groups of a random UUID4, drawn again every `chunk`
+    ids, followed by a counter, like the ids of `Emitter`.
+    """
+    while True:
+        template = str(uuid.uuid4())[:24] + "%012x"
+        yield from map(template.__mod__, range(chunk))
+
+
+def put_many(queue, items, block=False):
+    """Put `items` on `queue`, taking its lock once while they fit.
+
+    Without `block`, return how many of them fit, the rest are not queued.
+    With `block`, wait for room until every item is queued. Queues may
+    define `_put_many` to put several items faster than with `_put`, and
+    queues that are not `Queue`s, like `SharedQueue`, their own `put_many`.
+    """
+    if hasattr(queue, "put_many"):
+        return queue.put_many(items, block=block)
+    queued = 0
+    with queue.not_full:
+        while True:
+            chunk = items[queued:] if queued else items
+            if queue.maxsize > 0:
+                chunk = chunk[: max(queue.maxsize - queue._qsize(), 0)]
+            _put_many = getattr(queue, "_put_many", None)
+            if _put_many is not None:
+                _put_many(chunk)
+            else:
+                for item in chunk:
+                    queue._put(item)
+            if chunk:
+                queued += len(chunk)
+                queue.unfinished_tasks += len(chunk)
+                queue.not_empty.notify()
+            if not block or queued == len(items):
+                return queued
+            queue.not_full.wait()
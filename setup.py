@@ -27,6 +27,13 @@ install_requires = [
 
 tests_require = ["mock>=2.0.0", "python-dotenv>=0.21.0"]
 
+extras_require = {
+    "orjson": ["orjson>=3.0"],
+    "async": ["httpx>=0.23"],
+    "zstd": ["zstandard>=0.15"],
+    "dataframe": ["pandas>=1.0"],
+}
+
 setup(
     name="lotus-python",
     version=VERSION,
@@ -40,6 +47,7 @@ setup(
     license="MIT License",
     install_requires=install_requires,
     tests_require=tests_require,
+    extras_require=extras_require,
     description="Integrate Lotus into any python application.",
     long_description=long_description,
     classifiers=[